@@ -0,0 +1,89 @@
+"""Memory, disk and recall trade-offs of the embedding storage formats.
+
+Generates a fixed-seed synthetic corpus, encodes it in every format supported by
+modules.embedding_storage and reports, per format:
+
+- bson_bytes_per_doc: size of the encoded embedding fields inside a BSON document
+  (what Mongo stores on disk and pulls into its cache on every scan)
+- python_bytes_per_doc: size of the decoded value as pymongo hands it back
+- recall_at_k: overlap with exact float32 top-k, without and with float32 rescoring
+- decode_ms: time to decode the whole corpus into a float32 matrix
+
+    python benchmarks/embedding_storage_benchmark.py --docs 20000 --dim 384 --k 3 > storage.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bson
+import numpy as np
+from modules.embedding_storage import STORAGE_FORMATS, QUANTIZED_FORMATS, encode_embedding, decode_embedding
+
+def python_size(value):
+    if isinstance(value, list):
+        return sys.getsizeof(value) + sum(sys.getsizeof(x) for x in value)
+    return sys.getsizeof(value)
+
+def top_k(matrix, query, k):
+    scores = matrix @ query
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+def recall(found, expected):
+    return len(set(found.tolist()) & set(expected.tolist())) / len(expected)
+
+def run(args):
+    rng = np.random.default_rng(args.seed)
+    corpus = rng.normal(size=(args.docs, args.dim)).astype(np.float32)
+    corpus /= np.linalg.norm(corpus, axis=1, keepdims=True)
+    # Queries near corpus points, like real questions near their answer chunks
+    picks = rng.integers(0, args.docs, size=args.queries)
+    queries = corpus[picks] + rng.normal(scale=0.05, size=(args.queries, args.dim)).astype(np.float32)
+    expected = [top_k(corpus, query, args.k) for query in queries]
+
+    results = {"docs": args.docs, "dim": args.dim, "k": args.k, "queries": args.queries, "seed": args.seed, "formats": {}}
+    for storage_format in STORAGE_FORMATS:
+        encoded = [encode_embedding(vector, storage_format) for vector in corpus]
+        bson_bytes = np.mean([len(bson.encode(fields)) for fields in encoded[:1000]])
+        python_bytes = np.mean([python_size(fields["embeddings"]) for fields in encoded[:1000]])
+
+        start = time.perf_counter()
+        decoded = np.stack([decode_embedding(fields) for fields in encoded])
+        decode_ms = (time.perf_counter() - start) * 1000
+
+        plain = []
+        rescored = []
+        for query, truth in zip(queries, expected):
+            plain.append(recall(top_k(decoded, query, args.k), truth))
+            if storage_format in QUANTIZED_FORMATS:
+                candidates = top_k(decoded, query, args.k * args.rescore_factor)
+                exact = corpus[candidates] @ query
+                rescored.append(recall(candidates[np.argsort(-exact)[:args.k]], truth))
+
+        results["formats"][storage_format] = {
+            "bson_bytes_per_doc": float(bson_bytes),
+            "python_bytes_per_doc": float(python_bytes),
+            # Quantized formats also keep a float32 copy in the rescoring side collection
+            "rescore_bytes_per_doc": args.dim * 4 if storage_format in QUANTIZED_FORMATS else 0,
+            "decode_ms": decode_ms,
+            "recall_at_k": float(np.mean(plain)),
+            "recall_at_k_rescored": float(np.mean(rescored)) if rescored else None
+        }
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--docs", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--rescore-factor", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=42)
+    print(json.dumps(run(parser.parse_args()), indent=2))
+
+if __name__ == "__main__":
+    main()
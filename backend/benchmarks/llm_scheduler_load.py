@@ -0,0 +1,144 @@
+"""Exercise the LLM scheduler against a local fake Groq server.
+
+Serves an OpenAI-compatible chat completions app in-process (over httpx's ASGI
+transport) that answers after --latency seconds and returns 429 (with
+Retry-After) for a share of requests, points the real ChatGroq client at it,
+and fires bursts of concurrent chain calls through query_handlers._run_chain:
+
+  identical   every call has the same prompt; expect one answered upstream
+              request (429s before it are retries of that same request)
+  distinct    every call has its own prompt; expect at most LLM_MAX_CONCURRENCY
+              upstream requests at once and rejections once the queue is full
+
+Both bursts also check that upstream requests in flight never exceeded the
+scheduler's max_concurrency. Exits with status 1 if any check fails.
+
+    python benchmarks/llm_scheduler_load.py --calls 200 --latency 0.2 --error-rate 0.1
+"""
+import os
+import sys
+import time
+import json
+import random
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from langchain.chains import LLMChain
+from langchain.prompts import PromptTemplate
+from langchain_groq import ChatGroq
+from modules.llm_scheduler import LLMOverloaded, get_llm_scheduler
+from modules.query_handlers import _run_chain
+from modules.metrics import render_metrics
+
+class FakeGroq:
+    """Counts requests, answered requests and the most requests it ever served at once"""
+    def __init__(self, latency, error_rate):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self.rate_limited = 0
+        self.answered = 0
+        self.active = 0
+        self.peak = 0
+
+    def app(self):
+        app = FastAPI()
+
+        @app.post("/openai/v1/chat/completions")
+        async def completions(request: Request):
+            body = await request.json()
+            self.requests += 1
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+            try:
+                if random.random() < self.error_rate:
+                    self.rate_limited += 1
+                    return JSONResponse(status_code=429, headers={"retry-after": "0.05"},
+                                        content={"error": {"message": "Rate limit reached", "type": "tokens"}})
+                await asyncio.sleep(self.latency)
+            finally:
+                self.active -= 1
+            self.answered += 1
+            prompt = body["messages"][-1]["content"]
+            return {
+                "id": f"fake-{self.requests}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body["model"],
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": f"Answer to: {prompt.strip()[-40:]}"}}],
+                "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15}
+            }
+
+        return app
+
+async def burst(chain, calls, identical):
+    outcomes = {"ok": 0, "rejected": 0, "failed": 0}
+    latencies = []
+
+    async def call(i):
+        start = time.perf_counter()
+        question = "What is the refund policy?" if identical else f"Question number {i}?"
+        try:
+            await _run_chain(chain, {"question": question})
+            outcomes["ok"] += 1
+            latencies.append(time.perf_counter() - start)
+        except LLMOverloaded:
+            outcomes["rejected"] += 1
+        except Exception:
+            outcomes["failed"] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(call(i) for i in range(calls)))
+    latencies.sort()
+    return {
+        **outcomes,
+        "elapsed_s": round(time.perf_counter() - start, 3),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 1) if latencies else None,
+        "p99_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 1) if latencies else None
+    }
+
+async def run(args):
+    fake = FakeGroq(args.latency, args.error_rate)
+    http_client = httpx.AsyncClient(transport=httpx.ASGITransport(app=fake.app()))
+    llm = ChatGroq(groq_api_key="fake", groq_api_base="http://fake-groq", http_async_client=http_client,
+                   model_name="fake-model", max_retries=0)
+    chain = LLMChain(llm=llm, prompt=PromptTemplate(template="{question}", input_variables=["question"]))
+    scheduler = get_llm_scheduler()
+    print(f"max_concurrency={scheduler.max_concurrency} max_queue={scheduler.max_queue} "
+          f"queue_timeout={scheduler.queue_timeout}s")
+    failures = []
+    # Identical runs first, before there are enough latency samples to hedge (a hedge is a second request)
+    for mode in ("identical", "distinct"):
+        fake.requests = fake.rate_limited = fake.answered = fake.peak = 0
+        result = await burst(chain, args.calls, mode == "identical")
+        result.update(upstream_requests=fake.requests, upstream_429=fake.rate_limited,
+                      upstream_answered=fake.answered, upstream_peak_concurrency=fake.peak)
+        print(f"{mode:>9}: {json.dumps(result)}")
+        if mode == "identical" and fake.answered != 1:
+            failures.append(f"{args.calls} identical calls made {fake.answered} answered upstream requests, expected 1")
+        if fake.peak > scheduler.max_concurrency:
+            failures.append(f"{mode}: {fake.peak} upstream requests in flight, limit is {scheduler.max_concurrency}")
+    await http_client.aclose()
+    if args.metrics:
+        print("".join(line + "\n" for line in render_metrics().splitlines() if line.startswith("ragbot_llm")))
+    return failures
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=200, help="concurrent calls per burst")
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds per fake completion")
+    parser.add_argument("--error-rate", type=float, default=0.1, help="share of requests answered with 429")
+    parser.add_argument("--metrics", action="store_true", help="print the scheduler metrics afterwards")
+    failures = asyncio.run(run(parser.parse_args()))
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main_cli()
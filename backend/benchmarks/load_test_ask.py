@@ -0,0 +1,104 @@
+"""Load test for /ask/ against a stubbed retriever and LLM.
+
+Runs the FastAPI app in-process and fires batches of concurrent requests at
+increasing concurrency levels. The stub retriever blocks (like the embedding
+forward pass and pymongo call it stands in for) and the stub LLM awaits (like a
+Groq round-trip), so throughput should scale with concurrency until the query
+worker pool is saturated.
+
+    python benchmarks/load_test_ask.py --concurrency 1 4 16 64 --llm-latency 0.5
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Every request asks a distinct question; caching would hide the behaviour under test
+os.environ["ANSWER_CACHE_BACKEND"] = "none"
+
+import httpx
+import main
+
+class StubRetriever:
+    def __init__(self, latency):
+        self.latency = latency
+
+    def embed_query(self, query):
+        return [1.0, float(len(query))]
+
+    def get_relevant_documents(self, query, query_embedding=None, filters=None, deadline=None):
+        time.sleep(self.latency)
+        return [{"content": f"Stub context for {query}", "source": "stub.pdf", "page": 1,
+                 "document_type": "pdf", "similarity": 0.9}]
+
+class StubChain:
+    def __init__(self, latency):
+        self.latency = latency
+
+    async def arun(self, **kwargs):
+        await asyncio.sleep(self.latency)
+        return f"Stub answer to {kwargs['question']}"
+
+def install_stubs(retrieval_latency, llm_latency):
+    chain = {
+        "document_chain": StubChain(llm_latency),
+        "general_chain": StubChain(llm_latency),
+        "retriever": StubRetriever(retrieval_latency)
+    }
+    main.get_llm_chain = lambda collection: chain
+
+async def run_level(client, concurrency, requests_per_user):
+    latencies = []
+    rejected = 0
+
+    async def user(user_id):
+        nonlocal rejected
+        for i in range(requests_per_user):
+            start = time.perf_counter()
+            response = await client.post("/ask/", data={"question": f"user {user_id} question {i}"})
+            if response.status_code == 503:
+                # Shed by the LLM scheduler's admission control (LLM_MAX_QUEUE)
+                rejected += 1
+                continue
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(user(u) for u in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "rejected": rejected,
+        "throughput_rps": len(latencies) / elapsed,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+    }
+
+async def run(args):
+    install_stubs(args.retrieval_latency, args.llm_latency)
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://loadtest") as client:
+        results = []
+        for concurrency in args.concurrency:
+            result = await run_level(client, concurrency, args.requests_per_user)
+            results.append(result)
+            print(f"users={result['concurrency']:>4}  requests={result['requests']:>5}  rejected={result['rejected']:>4}  "
+                  f"throughput={result['throughput_rps']:8.1f} req/s  "
+                  f"p50={result['p50_ms']:7.1f} ms  p99={result['p99_ms']:7.1f} ms")
+        return results
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--requests-per-user", type=int, default=5)
+    parser.add_argument("--retrieval-latency", type=float, default=0.02, help="seconds of blocking work per retrieval")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="seconds per stubbed LLM call")
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,271 @@
+"""Reproducible ingestion and retrieval benchmark on synthetic corpora.
+
+For every corpus size this generates fixed-seed clustered unit embeddings (so
+runs are comparable across commits), then measures:
+
+- ingest: chunks/s through _store_documents_in_mongodb, embeddings stubbed
+- retrieval: p50/p99 latency and recall@k against exact numpy search, for each
+  vector index backend ("exact", "hnsw") and the cursor scan ("scan"), plus the
+  $reduce pipeline ("mongo") when running against a real MongoDB
+- ask: end-to-end /ask/ latency through the FastAPI app with a stubbed LLM
+
+It runs against mongomock by default, or a real MongoDB with --mongo-url (use
+that for 1M chunks; mongomock keeps every document as Python objects).
+
+    python benchmarks/retrieval_benchmark.py --sizes 10000 100000 --output bench.json
+    python benchmarks/retrieval_benchmark.py --sizes 1000000 --mongo-url mongodb://localhost:27017/ \\
+        --storage-format float32 --output bench-1m.json
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000], help="corpus sizes in chunks, e.g. 10000 100000 1000000")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--clusters", type=int, default=256, help="topics the synthetic chunks are drawn around")
+    parser.add_argument("--spread", type=float, default=1.0, help="noise norm around each topic; higher is harder for ANN")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--backends", nargs="+", default=["exact", "hnsw", "scan", "mongo"])
+    parser.add_argument("--mongo-url", default=None, help="real MongoDB to benchmark against (default: mongomock)")
+    parser.add_argument("--storage-format", default=None, help="EMBEDDING_STORAGE_FORMAT for the ingested corpus")
+    parser.add_argument("--ask-requests", type=int, default=100)
+    parser.add_argument("--ask-concurrency", type=int, default=8)
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="seconds per stubbed LLM call")
+    parser.add_argument("--keep", action="store_true", help="keep the benchmark collections afterwards")
+    parser.add_argument("--output", default=None, help="write the JSON report here instead of stdout")
+    return parser.parse_args()
+
+args = parse_args()
+
+# Configuration is read at import time, so set it before importing the app
+os.environ["ANSWER_CACHE_BACKEND"] = "none"
+os.environ["METRICS_ENABLED"] = "false"
+if args.storage_format:
+    os.environ["EMBEDDING_STORAGE_FORMAT"] = args.storage_format
+
+import numpy as np
+import httpx
+import modules.database as database
+import modules.load_vectorstore as load_vectorstore
+from langchain.schema import Document
+from modules.embedding_storage import EMBEDDING_STORAGE_FORMAT
+from modules.llm import HybridRetriever
+from modules.vector_index import build_index, hnswlib
+import main
+
+def percentile(latencies, q):
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))] * 1000
+
+def latency_summary(latencies):
+    return {"p50_ms": percentile(latencies, 0.5), "p99_ms": percentile(latencies, 0.99), "mean_ms": float(np.mean(latencies)) * 1000}
+
+# Random stream for queries, distinct from every corpus block stream
+QUERY_STREAM = 2 ** 40
+
+class SyntheticCorpus:
+    """Unit vectors scattered around random topic centroids, generated in blocks from a fixed seed"""
+    def __init__(self, size, dim, clusters, seed, spread=1.0, block=10000):
+        self.size = size
+        self.dim = dim
+        self.block = block
+        self.seed = seed
+        self.noise = spread / np.sqrt(dim)
+        self.centroids = self._unit(np.random.default_rng(seed).normal(size=(clusters, dim)))
+
+    @staticmethod
+    def _unit(matrix):
+        matrix = np.asarray(matrix, dtype=np.float32)
+        return matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+
+    def block_vectors(self, start):
+        # Seeded per block, so any block can be regenerated without the ones before it
+        rng = np.random.default_rng((self.seed, start))
+        count = min(self.block, self.size - start)
+        topics = rng.integers(0, len(self.centroids), size=count)
+        return self._unit(self.centroids[topics] + rng.normal(scale=self.noise, size=(count, self.dim)))
+
+    def vectors(self):
+        return np.concatenate([self.block_vectors(start) for start in range(0, self.size, self.block)])
+
+    def queries(self, count):
+        # Same queries for every corpus size
+        rng = np.random.default_rng((self.seed, QUERY_STREAM))
+        topics = rng.integers(0, len(self.centroids), size=count)
+        return self._unit(self.centroids[topics] + rng.normal(scale=self.noise, size=(count, self.dim)))
+
+class StubEmbeddings:
+    """Stands in for the sentence-transformer: "chunk <i>" and "query <j>" map to precomputed vectors"""
+    def __init__(self, corpus, queries):
+        self.corpus = corpus
+        self.queries = queries
+        self._block_start = None
+        self._block = None
+
+    def _chunk_vector(self, i):
+        start = i - i % self.corpus.block
+        if start != self._block_start:
+            self._block_start, self._block = start, self.corpus.block_vectors(start)
+        return self._block[i - start]
+
+    def embed_documents(self, texts):
+        return [self._chunk_vector(int(text.split()[1])).tolist() for text in texts]
+
+    def embed_query(self, text):
+        return self.queries[int(text.split()[1])].tolist()
+
+class StubChain:
+    def __init__(self, latency):
+        self.latency = latency
+
+    async def arun(self, **kwargs):
+        await asyncio.sleep(self.latency)
+        return f"Stub answer to {kwargs['question']}"
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def bench_ingest(collection, corpus, embeddings):
+    load_vectorstore.get_embeddings = lambda: embeddings
+    # Every chunk goes to the benchmark collection, whatever shard its source hashes to
+    load_vectorstore.get_shard_collection = lambda source: collection
+    texts = (
+        Document(page_content=f"chunk {i} about topic", metadata={"source": f"bench/{i // 1000}.pdf", "page": i % 1000})
+        for i in range(corpus.size)
+    )
+    start = time.perf_counter()
+    stored = load_vectorstore._store_documents_in_mongodb(texts, "pdf")
+    elapsed = time.perf_counter() - start
+    return {"chunks": stored, "seconds": elapsed, "chunks_per_second": stored / elapsed if elapsed else 0.0}
+
+def exact_top_k(vectors, ids, queries, k):
+    truth = []
+    for query in queries:
+        scores = vectors @ query
+        top = np.argpartition(-scores, k - 1)[:k]
+        truth.append({ids[i] for i in top})
+    return truth
+
+def bench_search(search, queries, truth, k):
+    latencies, recalls = [], []
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        results = search(query)
+        latencies.append(time.perf_counter() - start)
+        recalls.append(len({doc["_id"] for doc in results[:k]} & expected) / k)
+    return {**latency_summary(latencies), "recall_at_k": float(np.mean(recalls))}
+
+def bench_retrieval(collection, corpus, queries, embeddings, backends, k, real_mongo):
+    # Ground truth over what was stored (quantized formats are scored against the original vectors)
+    ids = [doc["_id"] for doc in collection.find({}, {"_id": 1}).sort("_id", 1)]
+    truth = exact_top_k(corpus.vectors(), ids, queries, k)
+    results, indexes = {}, {}
+    for backend in backends:
+        if backend in ("exact", "hnsw"):
+            if backend == "hnsw" and hnswlib is None:
+                results[backend] = {"skipped": "hnswlib is not installed"}
+                continue
+            start = time.perf_counter()
+            index = build_index(collection, backend)
+            build_seconds = time.perf_counter() - start
+            indexes[backend] = index
+            search = lambda q, index=index: load_vectorstore.similarity_search("", collection, embeddings, k, index, q.tolist())
+            results[backend] = {"build_seconds": build_seconds, **bench_search(search, queries, truth, k)}
+        elif backend == "scan":
+            search = lambda q: load_vectorstore._scan_search(q.tolist(), collection, k)
+            results[backend] = bench_search(search, queries, truth, k)
+        elif backend == "mongo":
+            if not real_mongo or EMBEDDING_STORAGE_FORMAT != "array":
+                results[backend] = {"skipped": "needs a real MongoDB and array storage"}
+                continue
+            search = lambda q: load_vectorstore.similarity_search("", collection, embeddings, k, None, q.tolist())
+            results[backend] = bench_search(search, queries, truth, k)
+    return results, indexes
+
+async def bench_ask(collection, embeddings, index, requests, concurrency, llm_latency, k, real_mongo):
+    # $text needs a real MongoDB; mongomock only supports the vector path
+    mode = None if real_mongo else "vector"
+    retriever = HybridRetriever(collection, embeddings, k=k, vector_index=index, **({"mode": mode} if mode else {}))
+    chain = {"document_chain": StubChain(llm_latency), "general_chain": StubChain(llm_latency), "retriever": retriever}
+    main.get_llm_chain = lambda collection: chain
+
+    latencies = []
+    questions = iter(range(requests))
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        async def user():
+            for j in questions:
+                start = time.perf_counter()
+                response = await client.post("/ask/", data={"question": f"query {j % len(embeddings.queries)}"})
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(user() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return {"requests": len(latencies), "concurrency": concurrency, "throughput_rps": len(latencies) / elapsed, **latency_summary(latencies)}
+
+def run_size(size, real_mongo):
+    corpus = SyntheticCorpus(size, args.dim, args.clusters, args.seed, args.spread)
+    queries = corpus.queries(args.queries)
+    embeddings = StubEmbeddings(corpus, queries)
+    collection = database.get_collection(f"bench_{size}_{args.dim}_{args.seed}")
+    collection.drop()
+    try:
+        ingest = bench_ingest(collection, corpus, embeddings)
+        print(f"[{size}] ingest {ingest['chunks_per_second']:.0f} chunks/s", file=sys.stderr)
+        retrieval, indexes = bench_retrieval(collection, corpus, queries, embeddings, args.backends, args.k, real_mongo)
+        for backend, result in retrieval.items():
+            print(f"[{size}] {backend}: {result}", file=sys.stderr)
+        index = indexes.get("hnsw") or indexes.get("exact")
+        ask = asyncio.run(bench_ask(collection, embeddings, index, args.ask_requests, args.ask_concurrency, args.llm_latency, args.k, real_mongo))
+        print(f"[{size}] /ask/ p50={ask['p50_ms']:.1f} ms p99={ask['p99_ms']:.1f} ms", file=sys.stderr)
+        return {"size": size, "ingest": ingest, "retrieval": retrieval, "ask": ask}
+    finally:
+        if not args.keep:
+            collection.drop()
+            collection.database[f"{collection.name}_full_vectors"].drop()
+
+def main_cli():
+    real_mongo = args.mongo_url is not None
+    if real_mongo:
+        from pymongo import MongoClient
+        database._client = MongoClient(args.mongo_url)
+    else:
+        import mongomock
+        database._client = mongomock.MongoClient()
+
+    report = {
+        "commit": git_commit(),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "mongo": "mongodb" if real_mongo else "mongomock",
+        "storage_format": EMBEDDING_STORAGE_FORMAT,
+        "params": {key: value for key, value in vars(args).items() if key not in ("output", "mongo_url")},
+        "results": [run_size(size, real_mongo) for size in args.sizes]
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,202 @@
+"""Scatter-gather retrieval over sharded chunk collections vs one collection.
+
+Spreads --size random unit embeddings over --shards chunk collections by
+source hash (database.get_shard_collection), each shard on its own client,
+and keeps a copy of every chunk in one reference collection. Some vectors are
+copied onto chunks of other sources, so equal similarities meet across shards.
+Then, for --queries queries (half of them copies of a duplicated vector):
+
+- checks the merged top k against a brute-force ranking of the reference
+  collection, ordered by (-similarity, _id)
+- measures recall@k of the merged top k against an unsharded exact search
+  of the reference collection
+- checks the merged ranking is the same when the shards are listed in
+  another order
+- reports latency of one-collection search vs scatter-gather, and each
+  shard's own latency from ragbot_shard_search_duration_seconds
+
+It runs one in-memory mongomock client per shard by default, or real mongod
+instances with --mongo-urls (one per shard, or fewer to share them round-robin).
+mongomock shards all run in this interpreter and fetch documents with Python
+scans, so their latencies show the merge overhead rather than any speedup.
+
+Exits with status 1 when recall@k is below --min-recall, when any merged
+score differs from brute force, or when reordering the shards changes a ranking.
+
+    python benchmarks/sharded_retrieval_benchmark.py --size 40000 --shards 4 --k 10
+    python benchmarks/sharded_retrieval_benchmark.py --mongo-urls mongodb://localhost:27017,mongodb://localhost:27018
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return {
+        "p50_ms": round(samples[len(samples) // 2] * 1000, 2),
+        "p99_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000, 2)
+    }
+
+def shard_latencies(search):
+    """Mean latency per shard for one search kind, read back from the metrics endpoint text"""
+    from modules.metrics import render_metrics
+    totals = {}
+    pattern = re.compile(r'ragbot_shard_search_duration_seconds_(sum|count)\{search="([^"]+)",shard="([^"]+)"\} (\S+)')
+    for line in render_metrics().splitlines():
+        match = pattern.match(line)
+        if match and match.group(2) == search:
+            totals.setdefault(match.group(3), {})[match.group(1)] = float(match.group(4))
+    return {
+        shard: {"calls": int(values["count"]), "mean_ms": round(values["sum"] / values["count"] * 1000, 2)}
+        for shard, values in sorted(totals.items()) if values.get("count")
+    }
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--shards", type=int, default=4)
+    parser.add_argument("--sources", type=int, default=200, help="distinct source paths the chunks belong to")
+    parser.add_argument("--duplicates", type=int, default=50, help="vectors copied onto chunks of another source")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--min-recall", type=float, default=1.0, help="fail below this recall@k against the unsharded search")
+    parser.add_argument("--mongo-urls", default=None, help="comma-separated mongod URLs for the shards (default: mongomock)")
+    args = parser.parse_args()
+
+    collection_name = f"shard_bench_{os.getpid()}"
+    os.environ["SHARD_COUNT"] = str(args.shards)
+    os.environ["COLLECTION_NAME"] = collection_name
+    os.environ.setdefault("VECTOR_INDEX_BACKEND", "exact")
+    urls = args.mongo_urls or ",".join(f"mongodb://shard{i}.invalid" for i in range(args.shards))
+    os.environ["SHARD_MONGODB_URLS"] = urls
+
+    import numpy as np
+    import modules.database as database
+    if args.mongo_urls:
+        from pymongo import MongoClient
+        database._client = MongoClient(urls.split(",")[0])
+    else:
+        import mongomock
+        # mongomock edits the projection dict it is given in place (pymongo does not), which races
+        # when shards searched in parallel share load_vectorstore.RESULT_PROJECTION
+        find = mongomock.Collection.find
+        mongomock.Collection.find = lambda self, filter=None, projection=None, *rest, **kwargs: find(
+            self, filter, dict(projection) if projection else projection, *rest, **kwargs
+        )
+        database._client = mongomock.MongoClient()
+        # One in-memory server per shard stands in for separate mongod instances
+        for url in urls.split(","):
+            database._shard_clients[url] = mongomock.MongoClient()
+    from bson import ObjectId
+    from logger import logger
+    logger.setLevel(logging.INFO)
+    from modules.database import get_database, get_shard_collection, get_shard_collections
+    from modules.load_vectorstore import similarity_search
+    from modules.sharding import sharded_similarity_search
+    from modules.vector_index import get_vector_index
+
+    shards = get_shard_collections()
+    reference = get_database()[f"{collection_name}_reference"]
+    rng = np.random.default_rng(42)
+    vectors = rng.normal(size=(args.size, args.dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    duplicated = rng.choice(args.size, size=args.duplicates, replace=False)
+    # Copies go to chunks of a different source, so they usually land on another shard
+    copies = rng.choice(args.size, size=args.duplicates, replace=False)
+    vectors[copies] = vectors[duplicated]
+    ids = [ObjectId() for _ in range(args.size)]
+    sources = [f"./uploaded_documents/bench-{i % args.sources}.pdf" for i in range(args.size)]
+
+    report = {"size": args.size, "dim": args.dim, "shards": args.shards, "k": args.k}
+    try:
+        by_shard = {}
+        docs = []
+        for doc_id, source, vector in zip(ids, sources, vectors):
+            doc = {"_id": doc_id, "content": "", "source": source, "page": 0, "document_type": "pdf",
+                   "embeddings": vector.tolist(), "metadata": {"source": source}}
+            docs.append(doc)
+            by_shard.setdefault(get_shard_collection(source).full_name, []).append(doc)
+        for shard in shards:
+            shard_docs = by_shard.get(shard.full_name, [])
+            if shard_docs:
+                shard.insert_many(shard_docs)
+        reference.insert_many(docs)
+        report["chunks_per_shard"] = {shard.name: len(by_shard.get(shard.full_name, [])) for shard in shards}
+
+        start = time.perf_counter()
+        reference_index = get_vector_index(reference)
+        for shard in shards:
+            get_vector_index(shard)
+        report["index_build_s"] = round(time.perf_counter() - start, 3)
+
+        queries = rng.normal(size=(args.queries, args.dim)).astype(np.float32)
+        queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+        # Half the queries sit exactly on a duplicated vector, so the top hits tie
+        queries[: args.queries // 2] = vectors[duplicated[rng.integers(0, args.duplicates, args.queries // 2)]]
+
+        single_latency, sharded_latency = [], []
+        exact, same_scores, order_independent = 0, 0, 0
+        recalls = []
+        shuffled = list(shards)
+        for query in queries:
+            # Brute force over every vector; ties ordered by _id like merge_shard_results
+            scores = vectors @ query
+            expected = sorted(range(args.size), key=lambda i: (-scores[i], str(ids[i])))[: args.k]
+
+            start = time.perf_counter()
+            unsharded = similarity_search(None, reference, None, args.k, reference_index, query)
+            single_latency.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            merged = sharded_similarity_search(None, shards, None, args.k, query)
+            sharded_latency.append(time.perf_counter() - start)
+
+            random.shuffle(shuffled)
+            reordered = sharded_similarity_search(None, shuffled, None, args.k, query)
+
+            exact += [doc["_id"] for doc in merged] == [ids[i] for i in expected]
+            same_scores += np.allclose([doc["similarity"] for doc in merged], scores[expected], atol=1e-5)
+            order_independent += [doc["_id"] for doc in merged] == [doc["_id"] for doc in reordered]
+            # A hit tied with the unsharded k-th score is as good as the one it displaced
+            cutoff = min(doc["similarity"] for doc in unsharded)
+            unsharded_ids = {doc["_id"] for doc in unsharded}
+            hits = sum(doc["_id"] in unsharded_ids or abs(doc["similarity"] - cutoff) <= 1e-6 for doc in merged)
+            recalls.append(hits / len(unsharded))
+
+        report["correctness"] = {
+            "queries": args.queries,
+            "same_ids_and_order_as_brute_force": exact,
+            "same_scores_as_brute_force": same_scores,
+            "same_order_with_shards_reordered": order_independent,
+            "recall_at_k_vs_unsharded": round(float(np.mean(recalls)), 4)
+        }
+        report["latency"] = {"one_collection": percentiles(single_latency), "scatter_gather": percentiles(sharded_latency)}
+        report["per_shard_latency"] = shard_latencies("vector")
+    finally:
+        for shard in shards:
+            shard.drop()
+        reference.drop()
+    print(json.dumps(report, indent=2))
+
+    correctness = report["correctness"]
+    failures = []
+    if correctness["recall_at_k_vs_unsharded"] < args.min_recall:
+        failures.append(f"recall@{args.k} {correctness['recall_at_k_vs_unsharded']} is below {args.min_recall}")
+    if correctness["same_scores_as_brute_force"] != args.queries:
+        failures.append(f"{args.queries - correctness['same_scores_as_brute_force']} queries merged wrong scores")
+    if correctness["same_order_with_shards_reordered"] != args.queries:
+        failures.append(f"{args.queries - correctness['same_order_with_shards_reordered']} rankings changed with shard order")
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main_cli()
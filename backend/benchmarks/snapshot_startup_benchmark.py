@@ -0,0 +1,125 @@
+"""Cold start and per-worker memory: vector index built from Mongo vs a mapped corpus snapshot.
+
+Fills a collection with --size random unit embeddings, then measures:
+
+- mongo: building an ExactIndex from the collection (what every worker did
+  before), in this process: seconds and anonymous memory added
+- export: writing the snapshot with corpus_snapshot.export_snapshot
+- mmap: --workers separate processes each mapping the snapshot and running
+  --queries searches; seconds to open, and RSS / PSS / anonymous memory of each
+  (PSS splits the shared page-cache pages between the processes mapping them)
+
+It runs against mongomock by default, or a real MongoDB with --mongo-url.
+
+    python benchmarks/snapshot_startup_benchmark.py --size 200000 --dim 384 --workers 4
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def memory_kb():
+    """VmRSS, RssAnon and RssFile from /proc/self/status, Pss from smaps_rollup (Linux only)"""
+    values = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            key, _, rest = line.partition(":")
+            if key in ("VmRSS", "RssAnon", "RssFile"):
+                values[key] = int(rest.split()[0])
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    values["Pss"] = int(line.split()[1])
+    except FileNotFoundError:
+        pass
+    return values
+
+def mmap_worker(snapshot_dir, queries, k, results, ready, go):
+    import numpy as np
+    from modules.corpus_snapshot import Snapshot, read_manifest
+    from modules.vector_index import MappedIndex
+
+    start = time.perf_counter()
+    index = MappedIndex(Snapshot(snapshot_dir, read_manifest(snapshot_dir)))
+    opened = time.perf_counter() - start
+    rng = np.random.default_rng(os.getpid())
+    start = time.perf_counter()
+    index.search_batch(rng.normal(size=(queries, index.dim)).astype(np.float32), k)
+    searched = time.perf_counter() - start
+    # Measure once every worker has touched all pages, so PSS reflects the sharing
+    ready.set()
+    go.wait()
+    results.put({"open_s": round(opened, 4), "search_s": round(searched, 4), **memory_kb()})
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=50000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--queries", type=int, default=64)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--mongo-url", default=None, help="real MongoDB to benchmark against (default: mongomock)")
+    args = parser.parse_args()
+
+    os.environ.setdefault("CORPUS_SNAPSHOT_DIR", tempfile.mkdtemp(prefix="snapshot-bench-"))
+    import numpy as np
+    import modules.database as database
+    if args.mongo_url:
+        from pymongo import MongoClient
+        database._client = MongoClient(args.mongo_url)
+    else:
+        import mongomock
+        database._client = mongomock.MongoClient()
+    from modules.database import get_database
+    from modules.corpus_snapshot import export_snapshot, snapshot_directory
+    from modules.vector_index import ExactIndex, _fill_index
+
+    collection = get_database()[f"snapshot_bench_{os.getpid()}"]
+    rng = np.random.default_rng(42)
+    for start in range(0, args.size, 10000):
+        vectors = rng.normal(size=(min(10000, args.size - start), args.dim)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        collection.insert_many([{"content": "", "embeddings": vector.tolist()} for vector in vectors])
+
+    report = {"size": args.size, "dim": args.dim, "workers": args.workers}
+    try:
+        before = memory_kb()
+        start = time.perf_counter()
+        index = ExactIndex()
+        _fill_index(index, collection)
+        after = memory_kb()
+        report["mongo"] = {"build_s": round(time.perf_counter() - start, 3),
+                           "anon_added_kb": after["RssAnon"] - before["RssAnon"]}
+        del index
+
+        start = time.perf_counter()
+        export_snapshot(collection)
+        report["export_s"] = round(time.perf_counter() - start, 3)
+
+        context = multiprocessing.get_context("spawn")
+        results, go = context.Queue(), context.Event()
+        readies = [context.Event() for _ in range(args.workers)]
+        workers = [
+            context.Process(target=mmap_worker, args=(snapshot_directory(collection), args.queries, args.k, results, ready, go))
+            for ready in readies
+        ]
+        for worker in workers:
+            worker.start()
+        for ready in readies:
+            ready.wait()
+        go.set()
+        report["mmap"] = [results.get() for _ in workers]
+        for worker in workers:
+            worker.join()
+    finally:
+        collection.drop()
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,4 +1,13 @@
 import logging
+from contextvars import ContextVar
+
+# Id of the HTTP request being served, "-" outside of one (set by the request middleware)
+request_id_var = ContextVar("request_id", default="-")
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
 
 def setup_logger(name="ragbot"):
     logger = logging.getLogger(name)
@@ -7,9 +16,10 @@ def setup_logger(name="ragbot"):
     # console handler
     ch = logging.StreamHandler()
     ch.setLevel(logging.DEBUG)
+    ch.addFilter(RequestIdFilter())
     
     # formatter 
-    formatter = logging.Formatter("[%(asctime)s] [%(levelname)s] - %(message)s ")
+    formatter = logging.Formatter("[%(asctime)s] [%(levelname)s] [%(request_id)s] - %(message)s ")
     ch.setFormatter(formatter)
     
     if not logger.hasHandlers():
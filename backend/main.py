@@ -1,16 +1,54 @@
 from fastapi import FastAPI, Form, Request, Query, UploadFile, File, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
+from contextlib import asynccontextmanager
 from typing import List, Optional
-from modules.load_vectorstore import load_vectorstore, load_json_data
+from modules.load_vectorstore import save_uploaded_files, delete_chunks, build_filter, UploadTooLarge
 from modules.llm import get_llm_chain
-from modules.query_handlers import query_chain
-from modules.database import get_mongo_client, get_collection
+from modules.query_handlers import query_chain, stream_query_chain, batch_query_chain
+from modules.llm_scheduler import LLMOverloaded, get_llm_scheduler
+from modules.deadline import request_deadline
+from modules.database import get_mongo_client, get_collection, get_shard_collections
 from modules.admin_handlers import AdminHandler
-from logger import logger
+from modules.answer_cache import get_answer_cache, invalidate_answer_cache
+from modules.document_registry import find_files, unregister_file
+from modules.jobs import enqueue_ingest_job, get_job, resume_ingest_jobs
+from modules.resources import warm_up, shutdown
+from modules.vector_index import refresh_snapshot
+from modules.sharding import sharded_corpus_stats
+from modules.chat_history import append_turn, append_messages, get_context_window, get_history_page
+from modules.workers import run_in_query_pool, run_in_upload_pool, submit_background, shutdown_workers
+from modules.metrics import HTTP_DURATION, METRICS_ENABLED, render_metrics
+from logger import logger, request_id_var
 import os
+import json
+import asyncio
+import time
+import uuid
 
-app = FastAPI(title="Universal Chatbot")
+# Largest whole upload request (all files of a batch together); 0 disables the check
+UPLOAD_MAX_REQUEST_BYTES = int(os.environ.get("UPLOAD_MAX_REQUEST_BYTES", str(2 * 1024 * 1024 * 1024)))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Created on this event loop, so worker threads (chat summaries) can hand it calls
+    get_llm_scheduler()
+    # Load models, clients and the vector index once for the whole process
+    try:
+        warm_up()
+        get_llm_chain(get_collection())
+    except Exception:
+        logger.exception("Error warming up shared resources")
+    try:
+        resume_ingest_jobs()
+    except Exception:
+        logger.exception("Error resuming ingestion jobs")
+    yield
+    # Off the event loop: background summaries still need it for their LLM calls while the pools drain
+    await asyncio.to_thread(shutdown_workers)
+    shutdown()
+
+app = FastAPI(title="Universal Chatbot", lifespan=lifespan)
 
 # CORS middleware for React frontend
 app.add_middleware(
@@ -32,6 +70,59 @@ async def catch_exception_middleware(request: Request, call_next):
         logger.exception("UNHANDLED EXCEPTION ...")
         return JSONResponse(status_code=500, content={"error": str(exc)})
 
+@app.middleware("http")
+async def upload_size_middleware(request: Request, call_next):
+    # Refuse oversized upload requests from Content-Length, before the body is read
+    if request.url.path.startswith("/admin/upload") and UPLOAD_MAX_REQUEST_BYTES:
+        content_length = request.headers.get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > UPLOAD_MAX_REQUEST_BYTES:
+            return JSONResponse(status_code=413, content={"error": f"Upload exceeds {UPLOAD_MAX_REQUEST_BYTES} bytes"})
+    return await call_next(request)
+
+@app.middleware("http")
+async def request_context_middleware(request: Request, call_next):
+    # Tag every log line of this request and time it per route
+    request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex[:16]
+    token = request_id_var.set(request_id)
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        response.headers["X-Request-ID"] = request_id
+        return response
+    finally:
+        if METRICS_ENABLED:
+            # Route templates keep label cardinality bounded (/admin/jobs/{job_id}, not every id)
+            route = getattr(request.scope.get("route"), "path", "unmatched")
+            HTTP_DURATION.observe(request.method, route, str(status), value=time.perf_counter() - start)
+        request_id_var.reset(token)
+
+def _save_and_enqueue(files, doc_type):
+    file_paths, file_hashes = save_uploaded_files(files)
+    return enqueue_ingest_job(doc_type, file_paths, file_hashes)
+
+def _delete_documents_for_file(filename):
+    """Delete every chunk of the registered file(s) with this exact filename or source path"""
+    deleted_count = 0
+    # A bare filename can match sources on several shards
+    for collection in get_shard_collections():
+        deleted = 0
+        for entry in find_files(collection, filename):
+            ids = [doc["_id"] for doc in collection.find({"source": entry["_id"]}, {"_id": 1})]
+            deleted += delete_chunks(collection, ids)
+            unregister_file(collection, entry["_id"])
+        if deleted:
+            refresh_snapshot(collection)
+        deleted_count += deleted
+    if deleted_count:
+        invalidate_answer_cache()
+    return deleted_count
+
+def _get_document_stats():
+    # Maintained counters; no scan of the chunk collection
+    return sharded_corpus_stats(get_shard_collections())
+
 # Admin endpoints for document management
 @app.post("/admin/upload_pdfs/")
 async def admin_upload_pdfs(files: List[UploadFile] = File(...), admin_key: str = Form(...)):
@@ -40,11 +131,12 @@ async def admin_upload_pdfs(files: List[UploadFile] = File(...), admin_key: str
             raise HTTPException(status_code=403, detail="Invalid admin key")
         
         logger.info(f"Admin uploading {len(files)} PDF files")
-        result = load_vectorstore(files)
-        logger.info("PDF documents added to MongoDB")
-        return {"message": "PDF files processed and vectorstore updated", "count": len(files)}
+        job_id = await run_in_upload_pool(_save_and_enqueue, files, "pdf")
+        return {"message": "PDF files queued for processing", "count": len(files), "job_id": job_id}
     except HTTPException:
         raise
+    except UploadTooLarge as e:
+        return JSONResponse(status_code=413, content={"error": str(e)})
     except Exception as e:
         logger.exception("Error during admin PDF upload")
         return JSONResponse(status_code=500, content={"error": str(e)})
@@ -56,30 +148,48 @@ async def admin_upload_json(files: List[UploadFile] = File(...), admin_key: str
             raise HTTPException(status_code=403, detail="Invalid admin key")
         
         logger.info(f"Admin uploading {len(files)} JSON files")
-        result = load_json_data(files)
-        logger.info("JSON documents added to MongoDB")
-        return {"message": "JSON files processed and vectorstore updated", "count": len(files)}
+        job_id = await run_in_upload_pool(_save_and_enqueue, files, "json")
+        return {"message": "JSON files queued for processing", "count": len(files), "job_id": job_id}
     except HTTPException:
         raise
+    except UploadTooLarge as e:
+        return JSONResponse(status_code=413, content={"error": str(e)})
     except Exception as e:
         logger.exception("Error during admin JSON upload")
         return JSONResponse(status_code=500, content={"error": str(e)})
 
+@app.get("/admin/jobs/{job_id}")
+async def admin_get_job(job_id: str, admin_key: str = Query(...)):
+    try:
+        if not admin.verify_admin_key(admin_key):
+            raise HTTPException(status_code=403, detail="Invalid admin key")
+        
+        job = await run_in_query_pool(get_job, job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Job not found")
+        
+        job["job_id"] = job.pop("_id")
+        return job
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Error getting ingestion job")
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
 @app.delete("/admin/delete_file/")
 async def admin_delete_file(filename: str = Query(...), admin_key: str = Query(...)):
     try:
         if not admin.verify_admin_key(admin_key):
             raise HTTPException(status_code=403, detail="Invalid admin key")
         
-        collection = get_collection()
-        result = collection.delete_many({"source": {"$regex": filename, "$options": "i"}})
+        deleted_count = await run_in_query_pool(_delete_documents_for_file, filename)
         
-        logger.info(f"Admin deleted {result.deleted_count} documents for filename: {filename}")
+        logger.info(f"Admin deleted {deleted_count} documents for filename: {filename}")
         
         return {
-            "message": f"Deleted {result.deleted_count} documents",
+            "message": f"Deleted {deleted_count} documents",
             "filename": filename,
-            "deleted_count": result.deleted_count
+            "deleted_count": deleted_count
         }
     except HTTPException:
         raise
@@ -93,44 +203,156 @@ async def admin_get_stats(admin_key: str = Query(...)):
         if not admin.verify_admin_key(admin_key):
             raise HTTPException(status_code=403, detail="Invalid admin key")
         
-        collection = get_collection()
-        total_docs = collection.count_documents({})
-        pdf_docs = collection.count_documents({"source": {"$regex": r"\.pdf$", "$options": "i"}})
-        json_docs = collection.count_documents({"source": {"$regex": r"\.json$", "$options": "i"}})
-        
-        return {
-            "total_documents": total_docs,
-            "pdf_documents": pdf_docs,
-            "json_documents": json_docs
-        }
+        return await run_in_query_pool(_get_document_stats)
     except HTTPException:
         raise
     except Exception as e:
         logger.exception("Error getting admin stats")
         return JSONResponse(status_code=500, content={"error": str(e)})
 
+@app.get("/admin/cache_stats/")
+async def admin_get_cache_stats(admin_key: str = Query(...)):
+    try:
+        if not admin.verify_admin_key(admin_key):
+            raise HTTPException(status_code=403, detail="Invalid admin key")
+        
+        cache = get_answer_cache()
+        if cache is None:
+            return {"enabled": False}
+        return {"enabled": True, **await run_in_query_pool(cache.stats)}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Error getting answer cache stats")
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
 # Public user endpoint
 @app.post("/ask/")
-async def ask_questions(question: str = Form(...)):
+async def ask_questions(
+    question: str = Form(...),
+    sources: Optional[List[str]] = Form(None),
+    document_type: Optional[str] = Form(None),
+    created_after: Optional[float] = Form(None),
+    created_before: Optional[float] = Form(None),
+    session_id: Optional[str] = Form(None)
+):
+    # The answer is due ASK_DEADLINE_SECONDS after the request arrives
+    deadline = request_deadline()
     try:
         logger.info(f"User query: {question}")
         
         # Get MongoDB collection
         collection = get_collection()
         
-        # Create chain with MongoDB collection
-        chain = get_llm_chain(collection)
-        result = query_chain(chain, question)
+        # Optional metadata filters, applied before vectors are scored
+        filters = build_filter(sources, document_type, created_after, created_before)
+        
+        # Create chain with MongoDB collection (first call may build the vector index)
+        chain = await run_in_query_pool(get_llm_chain, collection)
+        history = await run_in_query_pool(get_context_window, session_id)
+        result = await query_chain(chain, question, filters, history, deadline)
+        if session_id:
+            submit_background(append_turn, session_id, question, result)
         logger.info("Query successful...")
         return result
+    except LLMOverloaded as e:
+        logger.warning(f"Rejected question, LLM is saturated: {e}")
+        return JSONResponse(status_code=503, content={"error": str(e)}, headers={"Retry-After": "1"})
     except Exception as e:
         logger.exception("Error processing question")
         return JSONResponse(status_code=500, content={"error": str(e)})
 
+@app.post("/ask_stream/")
+async def ask_questions_stream(
+    request: Request,
+    question: str = Form(...),
+    sources: Optional[List[str]] = Form(None),
+    document_type: Optional[str] = Form(None),
+    created_after: Optional[float] = Form(None),
+    created_before: Optional[float] = Form(None),
+    session_id: Optional[str] = Form(None)
+):
+    try:
+        logger.info(f"User query (streaming): {question}")
+        
+        filters = build_filter(sources, document_type, created_after, created_before)
+        collection = get_collection()
+        chain = await run_in_query_pool(get_llm_chain, collection)
+        history = await run_in_query_pool(get_context_window, session_id)
+    except Exception as e:
+        logger.exception("Error preparing streaming answer")
+        return JSONResponse(status_code=500, content={"error": str(e)})
+    
+    async def events():
+        # NDJSON: one event per line; the client disconnecting stops generation
+        stream = stream_query_chain(chain, question, filters, history)
+        answer = {"response": "", "sources": [], "response_type": None}
+        try:
+            async for event in stream:
+                if await request.is_disconnected():
+                    logger.info("Client disconnected, cancelling generation")
+                    break
+                if event["type"] == "meta":
+                    answer.update(sources=event["sources"], response_type=event["response_type"])
+                elif event["type"] == "token":
+                    answer["response"] += event["content"]
+                elif event["type"] == "done" and session_id:
+                    submit_background(append_turn, session_id, question, answer)
+                yield json.dumps(event) + "\n"
+        finally:
+            await stream.aclose()
+    
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+@app.post("/ask_batch/")
+async def ask_batch(payload: dict, admin_key: str = Query(...)):
+    """Answer a list of questions for evaluation and bulk FAQ jobs.
+
+    Body: {"questions": [...], plus optional sources, document_type,
+    created_after, created_before}. Streams one NDJSON line per question as it
+    completes, with its index in the request.
+    """
+    try:
+        if not admin.verify_admin_key(admin_key):
+            raise HTTPException(status_code=403, detail="Invalid admin key")
+        
+        questions = payload.get("questions")
+        if not isinstance(questions, list) or not all(isinstance(q, str) and q.strip() for q in questions):
+            return JSONResponse(status_code=400, content={"error": "questions must be a list of non-empty strings"})
+        
+        filters = build_filter(payload.get("sources"), payload.get("document_type"),
+                               payload.get("created_after"), payload.get("created_before"))
+        chain = await run_in_query_pool(get_llm_chain, get_collection())
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Error preparing batch answers")
+        return JSONResponse(status_code=500, content={"error": str(e)})
+    
+    async def events():
+        # Client disconnecting closes the generator, which cancels the remaining questions
+        stream = batch_query_chain(chain, questions, filters)
+        try:
+            async for result in stream:
+                yield json.dumps(result) + "\n"
+        finally:
+            await stream.aclose()
+    
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
 @app.get("/chat_history/")
-async def get_chat_history():
+async def get_chat_history(
+    session_id: Optional[str] = Query(None),
+    before: Optional[str] = Query(None),
+    limit: int = Query(50)
+):
     try:
-        return {"history": []}
+        if not session_id:
+            return {"history": [], "next_cursor": None}
+        history, next_cursor = await run_in_query_pool(get_history_page, session_id, before, limit)
+        return {"history": history, "next_cursor": next_cursor}
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
     except Exception as e:
         logger.exception("Error getting chat history")
         return JSONResponse(status_code=500, content={"error": str(e)})
@@ -138,11 +360,22 @@ async def get_chat_history():
 @app.post("/save_chat/")
 async def save_chat(chat_data: dict):
     try:
-        return {"message": "Chat saved successfully"}
+        session_id = chat_data.get("session_id")
+        messages = chat_data.get("messages", [])
+        if not session_id:
+            return JSONResponse(status_code=400, content={"error": "session_id is required"})
+        # Appended after the response is sent
+        submit_background(append_messages, session_id, messages)
+        return {"message": "Chat saved successfully", "messages": len(messages)}
     except Exception as e:
         logger.exception("Error saving chat")
         return JSONResponse(status_code=500, content={"error": str(e)})
 
+@app.get("/metrics")
+async def metrics():
+    """Stage latency histograms and counters in Prometheus text format"""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
 @app.get("/test")
 async def test():
     return {"message": "Universal Chatbot is running successfully..."}
\ No newline at end of file
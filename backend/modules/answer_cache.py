@@ -0,0 +1,246 @@
+import os
+import re
+import time
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+import numpy as np
+from dotenv import load_dotenv
+from pymongo import ASCENDING
+from modules.database import get_collection
+from logger import logger
+
+load_dotenv()
+
+# "memory" (per process), "mongo" (shared by all workers) or "none"
+ANSWER_CACHE_BACKEND = os.environ.get("ANSWER_CACHE_BACKEND", "memory").lower()
+ANSWER_CACHE_TTL = int(os.environ.get("ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get("ANSWER_CACHE_MAX_ENTRIES", "1024"))
+# Cosine similarity a new question needs with a cached one to reuse its answer
+ANSWER_CACHE_SIMILARITY_THRESHOLD = float(os.environ.get("ANSWER_CACHE_SIMILARITY_THRESHOLD", "0.95"))
+ANSWER_CACHE_COLLECTION_NAME = os.environ.get("ANSWER_CACHE_COLLECTION_NAME", "answer_cache")
+
+def normalize_question(question):
+    """Lowercase, drop punctuation and collapse whitespace so trivial rewordings share a key"""
+    question = re.sub(r"[^\w\s]", " ", question.lower())
+    return " ".join(question.split())
+
+def _unit(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+class AnswerCache:
+    """Two-tier answer cache: exact normalized question, then query-embedding similarity"""
+    def __init__(self, ttl=ANSWER_CACHE_TTL, max_entries=ANSWER_CACHE_MAX_ENTRIES,
+                 similarity_threshold=ANSWER_CACHE_SIMILARITY_THRESHOLD):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        # Answers are only served for the corpus version they were produced from
+        self.corpus_version = 0
+        self._stats_lock = threading.Lock()
+        self._stats = {"exact_hits": 0, "semantic_hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def get_exact(self, question):
+        """Return the cached response for the normalized question, or None"""
+        response = self._get_exact(normalize_question(question))
+        if response is not None:
+            self._count("exact_hits")
+        return response
+
+    def get_similar(self, query_embedding):
+        """Return the cached response for the most similar question above the threshold, or None.
+
+        Called after get_exact missed, so a None here is what counts as a miss.
+        """
+        response = None
+        if self.similarity_threshold <= 1.0:
+            response = self._get_similar(_unit(query_embedding))
+        self._count("semantic_hits" if response is not None else "misses")
+        return response
+
+    def put(self, question, query_embedding, response):
+        embedding = _unit(query_embedding) if query_embedding is not None else None
+        self._put(normalize_question(question), embedding, response)
+
+    def set_corpus_version(self, version):
+        """Stop serving answers produced before the corpus changed, including changes made by other processes"""
+        self.corpus_version = version
+
+    def invalidate(self):
+        """Drop every cached answer, e.g. after the document corpus changed"""
+        self._clear()
+        self._count("invalidations")
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        lookups = stats["exact_hits"] + stats["semantic_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["exact_hits"] + stats["semantic_hits"]) / lookups if lookups else 0.0
+        stats["entries"] = self._size()
+        stats["backend"] = type(self).__name__
+        return stats
+
+    def _count(self, name, amount=1):
+        with self._stats_lock:
+            self._stats[name] += amount
+
+    def _get_exact(self, key):
+        raise NotImplementedError
+
+    def _get_similar(self, embedding):
+        raise NotImplementedError
+
+    def _put(self, key, embedding, response):
+        raise NotImplementedError
+
+    def _clear(self):
+        raise NotImplementedError
+
+    def _size(self):
+        raise NotImplementedError
+
+class MemoryAnswerCache(AnswerCache):
+    """Per-process cache backed by an OrderedDict in LRU order"""
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def _live_entry(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry["expires_at"] <= now or entry["corpus_version"] != self.corpus_version:
+            del self._entries[key]
+            return None
+        return entry
+
+    def _get_exact(self, key):
+        with self._lock:
+            entry = self._live_entry(key, time.time())
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry["response"]
+
+    def _get_similar(self, embedding):
+        with self._lock:
+            now = time.time()
+            keys = [key for key in list(self._entries) if self._live_entry(key, now) and self._entries[key]["embedding"] is not None]
+            if not keys:
+                return None
+            matrix = np.stack([self._entries[key]["embedding"] for key in keys])
+            scores = matrix @ embedding
+            best = int(np.argmax(scores))
+            if scores[best] < self.similarity_threshold:
+                return None
+            self._entries.move_to_end(keys[best])
+            return self._entries[keys[best]]["response"]
+
+    def _put(self, key, embedding, response):
+        with self._lock:
+            self._entries[key] = {
+                "embedding": embedding,
+                "response": response,
+                "corpus_version": self.corpus_version,
+                "expires_at": time.time() + self.ttl
+            }
+            self._entries.move_to_end(key)
+            evicted = 0
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                evicted += 1
+        if evicted:
+            self._count("evictions", evicted)
+
+    def _clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _size(self):
+        return len(self._entries)
+
+class MongoAnswerCache(AnswerCache):
+    """Cache shared across workers, stored in a MongoDB collection with a TTL index"""
+    def __init__(self, collection_name=ANSWER_CACHE_COLLECTION_NAME, **kwargs):
+        super().__init__(**kwargs)
+        self.collection = get_collection(collection_name)
+        self.collection.create_index("expires_at", expireAfterSeconds=0)
+        self.collection.create_index([("last_used", ASCENDING)])
+
+    def _get_exact(self, key):
+        now = datetime.now(timezone.utc)
+        entry = self.collection.find_one_and_update(
+            {"_id": key, "corpus_version": self.corpus_version, "expires_at": {"$gt": now}},
+            {"$set": {"last_used": now}},
+            {"response": 1}
+        )
+        return entry["response"] if entry else None
+
+    def _get_similar(self, embedding):
+        now = datetime.now(timezone.utc)
+        entries = list(self.collection.find(
+            {"corpus_version": self.corpus_version, "expires_at": {"$gt": now}, "embedding": {"$ne": None}},
+            {"embedding": 1}
+        ).limit(self.max_entries))
+        if not entries:
+            return None
+        matrix = np.asarray([entry["embedding"] for entry in entries], dtype=np.float32)
+        scores = matrix @ embedding
+        best = int(np.argmax(scores))
+        if scores[best] < self.similarity_threshold:
+            return None
+        entry = self.collection.find_one_and_update(
+            {"_id": entries[best]["_id"]}, {"$set": {"last_used": now}}, {"response": 1}
+        )
+        return entry["response"] if entry else None
+
+    def _put(self, key, embedding, response):
+        now = datetime.now(timezone.utc)
+        # expires_at must be a BSON date for the TTL monitor to purge it
+        self.collection.replace_one({"_id": key}, {
+            "embedding": embedding.tolist() if embedding is not None else None,
+            "response": response,
+            "corpus_version": self.corpus_version,
+            "last_used": now,
+            "expires_at": now + timedelta(seconds=self.ttl)
+        }, upsert=True)
+        overflow = self.collection.count_documents({}) - self.max_entries
+        if overflow > 0:
+            stale = [entry["_id"] for entry in self.collection.find({}, {"_id": 1}).sort("last_used", ASCENDING).limit(overflow)]
+            self.collection.delete_many({"_id": {"$in": stale}})
+            self._count("evictions", len(stale))
+
+    def _clear(self):
+        self.collection.delete_many({})
+
+    def _size(self):
+        return self.collection.estimated_document_count()
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_answer_cache():
+    """Get the process-wide answer cache, or None when caching is disabled"""
+    global _cache
+    if ANSWER_CACHE_BACKEND == "none":
+        return None
+    with _cache_lock:
+        if _cache is None:
+            if ANSWER_CACHE_BACKEND == "mongo":
+                _cache = MongoAnswerCache()
+            elif ANSWER_CACHE_BACKEND == "memory":
+                _cache = MemoryAnswerCache()
+            else:
+                raise ValueError(f"Unknown answer cache backend: {ANSWER_CACHE_BACKEND}")
+            logger.info(f"Answer cache enabled ({type(_cache).__name__})")
+        return _cache
+
+def invalidate_answer_cache():
+    """Invalidate cached answers after the document corpus changed"""
+    cache = get_answer_cache()
+    if cache is not None:
+        cache.invalidate()
+        logger.info("Answer cache invalidated")
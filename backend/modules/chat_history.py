@@ -0,0 +1,228 @@
+import os
+import threading
+from datetime import datetime, timezone
+from bson import ObjectId
+from bson.errors import InvalidId
+from dotenv import load_dotenv
+from pymongo import ASCENDING, DESCENDING
+from modules.context_builder import count_tokens
+from modules.database import get_collection
+from modules.resources import get_llm
+from modules.llm_scheduler import get_llm_scheduler
+from logger import logger
+
+load_dotenv()
+
+CHAT_HISTORY_COLLECTION_NAME = os.environ.get("CHAT_HISTORY_COLLECTION_NAME", "chat_history")
+CHAT_SESSIONS_COLLECTION_NAME = os.environ.get("CHAT_SESSIONS_COLLECTION_NAME", "chat_sessions")
+# Prompt tokens allowed for the running summary plus the most recent turns
+CHAT_HISTORY_TOKEN_BUDGET = int(os.environ.get("CHAT_HISTORY_TOKEN_BUDGET", "1024"))
+# Tokens the running summary of older turns is allowed to grow to
+CHAT_SUMMARY_TOKEN_BUDGET = int(os.environ.get("CHAT_SUMMARY_TOKEN_BUDGET", "256"))
+CHAT_HISTORY_PAGE_SIZE = int(os.environ.get("CHAT_HISTORY_PAGE_SIZE", "50"))
+# Longest single message kept in the prompt window
+MAX_MESSAGE_TOKENS = 400
+
+SUMMARY_PROMPT = """
+Summarize the conversation below for an assistant that will continue it.
+Keep names, numbers, decisions and open questions. Use at most {max_words} words.
+
+Previous summary:
+{summary}
+
+New messages:
+{messages}
+
+Summary:
+"""
+
+_indexes_ready = False
+_indexes_lock = threading.Lock()
+# One summarizer per session at a time
+_summarizing = set()
+_summarizing_lock = threading.Lock()
+
+def get_history_collection():
+    collection = get_collection(CHAT_HISTORY_COLLECTION_NAME)
+    _ensure_indexes(collection)
+    return collection
+
+def get_sessions_collection():
+    return get_collection(CHAT_SESSIONS_COLLECTION_NAME)
+
+def _ensure_indexes(collection):
+    global _indexes_ready
+    if _indexes_ready:
+        return
+    with _indexes_lock:
+        if not _indexes_ready:
+            # Cursor paging walks _id within a session; created_at serves time-range queries
+            collection.create_index([("session_id", ASCENDING), ("_id", DESCENDING)])
+            collection.create_index([("session_id", ASCENDING), ("created_at", DESCENDING)])
+            _indexes_ready = True
+
+def _format_message(doc):
+    return f"{'User' if doc['role'] == 'user' else 'Assistant'}: {doc['content']}"
+
+def _truncate(text, max_tokens):
+    if count_tokens(text) <= max_tokens:
+        return text
+    return text[:max_tokens * 4].rstrip() + " ..."
+
+def append_messages(session_id, messages):
+    """Store {"role", "content", ...} messages for a session, then fold old turns into the summary.
+
+    Meant to run on a background worker, off the response path.
+    """
+    if not session_id or not messages:
+        return
+    now = datetime.now(timezone.utc)
+    docs = [
+        {
+            "session_id": session_id,
+            "role": message.get("role", "user"),
+            "content": message.get("content", ""),
+            "sources": message.get("sources", []),
+            "response_type": message.get("response_type"),
+            "created_at": now
+        }
+        for message in messages
+        if message.get("content")
+    ]
+    if not docs:
+        return
+    try:
+        get_history_collection().insert_many(docs, ordered=True)
+        get_sessions_collection().update_one(
+            {"_id": session_id},
+            {"$set": {"updated_at": now}, "$setOnInsert": {"created_at": now, "summary": "", "summarized_until": None}},
+            upsert=True
+        )
+        summarize_session(session_id)
+    except Exception:
+        logger.exception(f"Error appending chat history for session {session_id}")
+
+def append_turn(session_id, question, response):
+    """Store one question and the response dict returned by query_chain"""
+    append_messages(session_id, [
+        {"role": "user", "content": question},
+        {
+            "role": "assistant",
+            "content": response.get("response", ""),
+            "sources": response.get("sources", []),
+            "response_type": response.get("response_type")
+        }
+    ])
+
+def get_history_page(session_id, before=None, limit=CHAT_HISTORY_PAGE_SIZE):
+    """Return (messages oldest first, cursor for the previous page or None).
+
+    Pages walk backwards from the newest message; pass the returned cursor as
+    before to get the page preceding this one.
+    """
+    query = {"session_id": session_id}
+    if before:
+        try:
+            query["_id"] = {"$lt": ObjectId(before)}
+        except (InvalidId, TypeError):
+            raise ValueError(f"Invalid history cursor: {before}")
+    limit = max(1, min(limit, CHAT_HISTORY_PAGE_SIZE * 4))
+    docs = list(
+        get_history_collection()
+        .find(query, {"session_id": 0})
+        .sort("_id", DESCENDING)
+        .limit(limit + 1)
+    )
+    next_cursor = str(docs[limit - 1]["_id"]) if len(docs) > limit else None
+    docs = docs[:limit]
+    docs.reverse()
+    for doc in docs:
+        doc["id"] = str(doc.pop("_id"))
+        doc["created_at"] = doc["created_at"].isoformat()
+    return docs, next_cursor
+
+def _unsummarized_query(session_id, session):
+    query = {"session_id": session_id}
+    if session and session.get("summarized_until"):
+        query["_id"] = {"$gt": session["summarized_until"]}
+    return query
+
+def _recent_messages(session_id, session, budget):
+    """Newest unsummarized messages that fit in budget tokens, oldest first, plus whether older ones were left out"""
+    recent = []
+    used = 0
+    cursor = (
+        get_history_collection()
+        .find(_unsummarized_query(session_id, session), {"role": 1, "content": 1})
+        .sort("_id", DESCENDING)
+    )
+    for doc in cursor:
+        doc["content"] = _truncate(doc["content"], MAX_MESSAGE_TOKENS)
+        tokens = count_tokens(_format_message(doc))
+        if used + tokens > budget:
+            return list(reversed(recent)), True
+        recent.append(doc)
+        used += tokens
+    return list(reversed(recent)), False
+
+def get_context_window(session_id, token_budget=CHAT_HISTORY_TOKEN_BUDGET):
+    """Conversation context for the prompt: running summary plus as many recent turns as fit the budget"""
+    if not session_id:
+        return ""
+    session = get_sessions_collection().find_one({"_id": session_id})
+    if session is None:
+        return ""
+    summary = _truncate(session.get("summary", ""), CHAT_SUMMARY_TOKEN_BUDGET)
+    recent, _ = _recent_messages(session_id, session, token_budget - count_tokens(summary))
+    parts = []
+    if summary:
+        parts.append(f"Summary of earlier conversation: {summary}")
+    parts.extend(_format_message(doc) for doc in recent)
+    return "\n".join(parts)
+
+def summarize_session(session_id, token_budget=CHAT_HISTORY_TOKEN_BUDGET):
+    """Fold turns that no longer fit the recent window into the session's running summary"""
+    with _summarizing_lock:
+        if session_id in _summarizing:
+            return
+        _summarizing.add(session_id)
+    try:
+        sessions = get_sessions_collection()
+        session = sessions.find_one({"_id": session_id})
+        if session is None:
+            return
+        summary = session.get("summary", "")
+        budget = token_budget - count_tokens(summary)
+        _, overflow = _recent_messages(session_id, session, budget)
+        if not overflow:
+            return
+        # Keep half the budget as recent turns so summarization runs every few turns, not every turn
+        recent, _ = _recent_messages(session_id, session, budget // 2)
+        query = _unsummarized_query(session_id, session)
+        if recent:
+            query.setdefault("_id", {})["$lt"] = recent[0]["_id"]
+        older = list(get_history_collection().find(query, {"role": 1, "content": 1}).sort("_id", ASCENDING))
+        if not older:
+            return
+
+        prompt = SUMMARY_PROMPT.format(
+            max_words=CHAT_SUMMARY_TOKEN_BUDGET * 3 // 4,
+            summary=summary or "(none)",
+            messages="\n".join(_format_message({**doc, "content": _truncate(doc["content"], MAX_MESSAGE_TOKENS)}) for doc in older)
+        )
+        # Through the scheduler, which caps concurrent Groq calls and retries rate limits
+        llm = get_llm()
+        new_summary = get_llm_scheduler().run_threadsafe(("summary", prompt), lambda: llm.ainvoke(prompt)).content.strip()
+        sessions.update_one(
+            {"_id": session_id},
+            {"$set": {
+                "summary": _truncate(new_summary, CHAT_SUMMARY_TOKEN_BUDGET),
+                "summarized_until": older[-1]["_id"]
+            }}
+        )
+        logger.debug(f"Summarized {len(older)} messages of session {session_id}")
+    except Exception:
+        logger.exception(f"Error summarizing chat session {session_id}")
+    finally:
+        with _summarizing_lock:
+            _summarizing.discard(session_id)
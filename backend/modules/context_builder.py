@@ -0,0 +1,162 @@
+import os
+import re
+import math
+from dotenv import load_dotenv
+from logger import logger
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+load_dotenv()
+
+# Prompt tokens spent on retrieved passages; about what the old 3 chunks x 800 chars cost, so packing
+# spends the same prompt on better passages rather than on a larger prompt
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "600"))
+# Passages sharing at least this fraction of word trigrams with a higher-ranked one are dropped
+NEAR_DUPLICATE_THRESHOLD = float(os.environ.get("NEAR_DUPLICATE_THRESHOLD", "0.8"))
+# A chunk this small is kept whole rather than cut into sentences
+MIN_PASSAGE_TOKENS = 48
+# Share of a matching sentence's score given to its neighbours, which often complete it
+NEIGHBOUR_WEIGHT = 0.25
+
+STOPWORDS = frozenset("""
+a an and are as at be but by can do does for from has have how i if in is it its of on or so
+that the their there these this to was what when where which who why will with you your
+""".split())
+
+_encoding = None
+
+def load_encoding():
+    """Load tiktoken's cl100k_base once, at startup: the first load may download its BPE file.
+
+    If tiktoken is missing or the load fails (offline), count_tokens keeps using its estimate.
+    """
+    global _encoding
+    if tiktoken is None or _encoding is not None:
+        return _encoding
+    try:
+        _encoding = tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logger.warning(f"Could not load the cl100k_base token encoding, estimating token counts: {e}")
+    return _encoding
+
+def count_tokens(text):
+    """Token count with tiktoken's cl100k_base (close to the llama 3 tokenizer) or a 4 chars/token estimate.
+
+    Never loads the encoding itself, so a request does no network I/O; see load_encoding.
+    """
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return (len(text) + 3) // 4
+
+def _terms(text):
+    return [word for word in re.findall(r"\w+", text.lower()) if len(word) > 2 and word not in STOPWORDS]
+
+def split_sentences(text, line_based=False):
+    """Split a chunk into sentences; JSON (line_based) chunks split per line"""
+    if line_based:
+        return [line.strip() for line in text.splitlines() if line.strip()]
+    # PDF text breaks lines mid-sentence; keep blank lines as paragraph breaks
+    text = re.sub(r"(?<!\n)\n(?!\n)", " ", text)
+    return [sentence.strip() for sentence in re.split(r"(?<=[.!?])\s+|\n{2,}", text) if sentence.strip()]
+
+def _shingles(text):
+    words = re.findall(r"\w+", text.lower())
+    return {tuple(words[i:i + 3]) for i in range(max(len(words) - 2, 1))}
+
+def _near_duplicate(shingles, kept):
+    for other in kept:
+        overlap = len(shingles & other)
+        if overlap and overlap / min(len(shingles), len(other)) >= NEAR_DUPLICATE_THRESHOLD:
+            return True
+    return False
+
+def _select_sentences(sentences, scores, budget):
+    """Highest-scoring sentences that fit in budget tokens, returned in document order.
+
+    When any sentence matches the question, sentences with no score are left out.
+    """
+    scores = [
+        score + NEIGHBOUR_WEIGHT * ((scores[i - 1] if i else 0) + (scores[i + 1] if i + 1 < len(scores) else 0))
+        for i, score in enumerate(scores)
+    ]
+    candidates = range(len(sentences))
+    if any(scores):
+        candidates = [i for i in candidates if scores[i] > 0]
+    chosen, used = [], 0
+    for i in sorted(candidates, key=lambda i: (-scores[i], i)):
+        tokens = count_tokens(sentences[i])
+        if used + tokens > budget:
+            continue
+        chosen.append(i)
+        used += tokens
+    chosen.sort()
+    parts = []
+    for position, i in enumerate(chosen):
+        # Mark skipped text so the model does not read across the gap as one sentence
+        if position and i != chosen[position - 1] + 1:
+            parts.append("...")
+        parts.append(sentences[i])
+    return " ".join(parts), used
+
+def pack_passages(docs, question=None, token_budget=CONTEXT_TOKEN_BUDGET):
+    """Pack the most relevant text of ranked docs into token_budget tokens.
+
+    Docs are taken in rank order; near-duplicates of earlier ones are skipped.
+    Each doc gets an equal share of what is left of the budget (unused tokens
+    roll over to later docs); a doc that does not fit its share contributes its
+    sentences with the most question terms, weighted by rarity across the
+    retrieved text. Returns a list of (doc, passage) pairs.
+    """
+    candidates = []
+    kept_shingles = []
+    for doc in docs:
+        content = doc.get("content", "")
+        if not content.strip():
+            continue
+        shingles = _shingles(content)
+        if _near_duplicate(shingles, kept_shingles):
+            continue
+        kept_shingles.append(shingles)
+        candidates.append((doc, split_sentences(content, line_based=doc.get("document_type") == "json")))
+
+    # Inverse document frequency over every retrieved sentence
+    sentence_terms = [[set(_terms(sentence)) for sentence in sentences] for _, sentences in candidates]
+    total = sum(len(terms) for terms in sentence_terms) or 1
+    frequency = {}
+    for terms in sentence_terms:
+        for sentence in terms:
+            for term in sentence:
+                frequency[term] = frequency.get(term, 0) + 1
+    query_terms = set(_terms(question or ""))
+
+    packed = []
+    seen_sentences = set()
+    remaining = token_budget
+    for position, (doc, sentences) in enumerate(candidates):
+        share = remaining // (len(candidates) - position)
+        if share <= 0:
+            break
+        # Drop sentences repeated within the chunk or already included from another passage
+        unique = []
+        for sentence, terms in zip(sentences, sentence_terms[position]):
+            key = sentence.lower()
+            if key not in seen_sentences:
+                seen_sentences.add(key)
+                unique.append((sentence, terms))
+        if not unique:
+            continue
+        text = " ".join(sentence for sentence, _ in unique)
+        tokens = count_tokens(text)
+        if tokens > share and share >= MIN_PASSAGE_TOKENS:
+            scores = [sum(math.log(total / frequency[term]) for term in terms & query_terms) for _, terms in unique]
+            text, tokens = _select_sentences([sentence for sentence, _ in unique], scores, share)
+        elif tokens > share:
+            continue
+        if not text:
+            continue
+        packed.append((doc, text))
+        remaining -= tokens
+    return packed
@@ -0,0 +1,262 @@
+import os
+import json
+import time
+import argparse
+from contextlib import contextmanager
+import numpy as np
+from bson import ObjectId
+from dotenv import load_dotenv
+from modules.document_registry import get_corpus_version, changes_since
+from modules.embedding_storage import EMBEDDING_PROJECTION, decode_embedding
+from logger import logger
+
+load_dotenv()
+
+# Where snapshots are written; one subdirectory per chunk collection
+CORPUS_SNAPSHOT_DIR = os.environ.get("CORPUS_SNAPSHOT_DIR", "./corpus_snapshots")
+# Deltas kept before the next update rewrites the whole snapshot instead
+CORPUS_SNAPSHOT_MAX_DELTAS = int(os.environ.get("CORPUS_SNAPSHOT_MAX_DELTAS", "20"))
+# A writer lock older than this is assumed to belong to a crashed process
+SNAPSHOT_LOCK_STALE_SECONDS = 3600
+EXPORT_BATCH_SIZE = 5000
+MANIFEST_NAME = "manifest.json"
+# Chunk ids are stored as the 12 raw bytes of their ObjectId, sorted, so lookups are a binary search
+ID_DTYPE = np.dtype("S12")
+
+class Snapshot:
+    """An opened snapshot: memory-mapped vectors and ids plus the deltas written after it.
+
+    vectors is a read-only (count x dim) float32 np.memmap and ids the matching
+    sorted S12 ids; every process opening the same files shares their pages
+    through the OS page cache. deltas is a list of (added_ids, added_vectors,
+    removed_ids) to apply on top, oldest first, and version the corpus version
+    the whole reflects.
+    """
+    def __init__(self, directory, manifest):
+        self.directory = directory
+        self.manifest = manifest
+        self.count = manifest["count"]
+        self.dim = manifest["dim"]
+        if self.count:
+            self.vectors = np.memmap(os.path.join(directory, manifest["vectors"]), dtype=np.float32, mode="r",
+                                     shape=(self.count, self.dim))
+            self.ids = np.memmap(os.path.join(directory, manifest["ids"]), dtype=ID_DTYPE, mode="r", shape=(self.count,))
+        else:
+            self.vectors = np.empty((0, self.dim or 0), dtype=np.float32)
+            self.ids = np.empty(0, dtype=ID_DTYPE)
+        self.deltas = [_read_delta(os.path.join(directory, delta["file"])) for delta in manifest["deltas"]]
+        self.version = manifest["deltas"][-1]["to"] if manifest["deltas"] else manifest["version"]
+
+def encode_ids(ids):
+    return np.array([doc_id.binary for doc_id in ids], dtype=ID_DTYPE)
+
+def decode_id(raw):
+    # numpy drops trailing zero bytes of S12 values
+    return ObjectId(bytes(raw).ljust(12, b"\0"))
+
+def snapshot_directory(collection):
+    return os.path.join(CORPUS_SNAPSHOT_DIR, collection.full_name)
+
+def read_manifest(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST_NAME), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def _write_manifest(directory, manifest):
+    path = os.path.join(directory, MANIFEST_NAME)
+    with open(path + ".part", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    # Readers see either the old manifest or the new one, never a partial file
+    os.replace(path + ".part", path)
+
+def _read_delta(path):
+    with np.load(path) as delta:
+        return (
+            [decode_id(raw) for raw in delta["added_ids"]],
+            delta["added_vectors"],
+            [decode_id(raw) for raw in delta["removed_ids"]]
+        )
+
+@contextmanager
+def _writer_lock(directory):
+    """Yield True if this process may write the snapshot, False if another writer holds it"""
+    path = os.path.join(directory, ".lock")
+    try:
+        if time.time() - os.path.getmtime(path) > SNAPSHOT_LOCK_STALE_SECONDS:
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        yield False
+        return
+    try:
+        os.write(fd, str(os.getpid()).encode())
+        os.close(fd)
+        yield True
+    finally:
+        os.remove(path)
+
+def open_snapshot(collection):
+    """Open the collection's snapshot with its deltas, or None if none has been exported"""
+    directory = snapshot_directory(collection)
+    for attempt in range(3):
+        manifest = read_manifest(directory)
+        if manifest is None:
+            return None
+        try:
+            return Snapshot(directory, manifest)
+        except FileNotFoundError:
+            # A concurrent export replaced the files this manifest named; read the new one
+            if attempt == 2:
+                raise
+
+def export_snapshot(collection):
+    """Write every chunk embedding to a new snapshot and drop the deltas.
+
+    Embeddings are streamed from Mongo in _id order straight to disk, so memory
+    use does not grow with the corpus. Returns the manifest, or None if another
+    process is already writing.
+    """
+    directory = snapshot_directory(collection)
+    os.makedirs(directory, exist_ok=True)
+    with _writer_lock(directory) as acquired:
+        if not acquired:
+            logger.info(f"Another process is writing the snapshot of {collection.full_name}")
+            return None
+        return _export_locked(collection, directory)
+
+def _export_locked(collection, directory):
+    start = time.time()
+    # Changes committed during the scan are in the change log and replayed on open
+    version = get_corpus_version(collection, max_age=0)
+    vectors_name, ids_name = f"vectors-{version}.f32", f"ids-{version}.bin"
+    count, dim = 0, None
+    with open(os.path.join(directory, vectors_name + ".part"), "wb") as vectors_file, \
+            open(os.path.join(directory, ids_name + ".part"), "wb") as ids_file:
+        ids, vectors = [], []
+
+        def flush():
+            nonlocal dim
+            matrix = np.asarray(vectors, dtype=np.float32)
+            if dim is None:
+                dim = matrix.shape[1]
+            elif matrix.shape[1] != dim:
+                raise ValueError(f"Expected {dim}-dim embeddings, got {matrix.shape[1]}")
+            vectors_file.write(matrix.tobytes())
+            ids_file.write(encode_ids(ids).tobytes())
+            ids.clear()
+            vectors.clear()
+
+        cursor = collection.find({"embeddings": {"$exists": True}}, EMBEDDING_PROJECTION).sort("_id", 1)
+        for doc in cursor.batch_size(EXPORT_BATCH_SIZE):
+            if not isinstance(doc["_id"], ObjectId):
+                raise ValueError(f"Snapshots need ObjectId chunk ids, found {doc['_id']!r}")
+            ids.append(doc["_id"])
+            vectors.append(decode_embedding(doc))
+            count += 1
+            if len(ids) >= EXPORT_BATCH_SIZE:
+                flush()
+        if ids:
+            flush()
+    for name in (vectors_name, ids_name):
+        os.replace(os.path.join(directory, name + ".part"), os.path.join(directory, name))
+
+    manifest = {
+        "version": version,
+        "count": count,
+        "dim": dim,
+        "vectors": vectors_name,
+        "ids": ids_name,
+        "created_at": time.time(),
+        "deltas": []
+    }
+    _write_manifest(directory, manifest)
+    _remove_unreferenced(directory, manifest)
+    logger.info(f"Exported snapshot of {count} embeddings from {collection.full_name} "
+                f"at corpus version {version} in {time.time() - start:.1f}s")
+    return manifest
+
+def _remove_unreferenced(directory, manifest):
+    """Delete files of older snapshots; processes that still map them keep their pages until they close"""
+    keep = {MANIFEST_NAME, ".lock", manifest["vectors"], manifest["ids"]} | {delta["file"] for delta in manifest["deltas"]}
+    for name in os.listdir(directory):
+        if name not in keep and not name.endswith(".part"):
+            os.remove(os.path.join(directory, name))
+
+def update_snapshot(collection):
+    """Write a delta with the chunks added and removed since the snapshot's version.
+
+    Falls back to a full export when there is no snapshot yet, the change log
+    no longer reaches back far enough, or CORPUS_SNAPSHOT_MAX_DELTAS deltas
+    have piled up. Returns the manifest, or None if another process is writing.
+    """
+    directory = snapshot_directory(collection)
+    os.makedirs(directory, exist_ok=True)
+    with _writer_lock(directory) as acquired:
+        if not acquired:
+            return None
+        manifest = read_manifest(directory)
+        if manifest is None or len(manifest["deltas"]) >= CORPUS_SNAPSHOT_MAX_DELTAS:
+            return _export_locked(collection, directory)
+        since = manifest["deltas"][-1]["to"] if manifest["deltas"] else manifest["version"]
+        changes = changes_since(collection, since)
+        if changes is None:
+            logger.warning(f"Change log of {collection.full_name} no longer reaches the snapshot, exporting again")
+            return _export_locked(collection, directory)
+        if not changes:
+            return manifest
+
+        # Net effect of the changes, in order
+        added, removed = {}, set()
+        for change in changes:
+            for doc_id in change["ids"]:
+                if change["op"] == "remove":
+                    added.pop(doc_id, None)
+                    removed.add(doc_id)
+                else:
+                    added[doc_id] = None
+                    removed.discard(doc_id)
+        if len(added) > manifest["count"] // 2:
+            # Bulk ingests are cheaper to map as part of a fresh snapshot than to load as a delta
+            return _export_locked(collection, directory)
+        added = list(added)
+        docs = []
+        for start in range(0, len(added), EXPORT_BATCH_SIZE):
+            docs.extend(collection.find(
+                {"_id": {"$in": added[start:start + EXPORT_BATCH_SIZE]}, "embeddings": {"$exists": True}}, EMBEDDING_PROJECTION
+            ))
+        version = changes[-1]["version"]
+        name = f"delta-{since}-{version}.npz"
+        with open(os.path.join(directory, name + ".part"), "wb") as f:
+            np.savez(
+                f,
+                added_ids=encode_ids([doc["_id"] for doc in docs]),
+                added_vectors=np.asarray([decode_embedding(doc) for doc in docs], dtype=np.float32).reshape(len(docs), -1),
+                removed_ids=encode_ids(sorted(removed))
+            )
+        os.replace(os.path.join(directory, name + ".part"), os.path.join(directory, name))
+        manifest["deltas"].append({"file": name, "from": since, "to": version, "added": len(docs), "removed": len(removed)})
+        _write_manifest(directory, manifest)
+        logger.info(f"Wrote snapshot delta {name}: {len(docs)} added, {len(removed)} removed")
+        return manifest
+
+if __name__ == "__main__":
+    # Usage (from backend/): python -m modules.corpus_snapshot export|update|info
+    from modules.database import get_shard_collections
+
+    parser = argparse.ArgumentParser(description="Memory-mapped corpus snapshots for VECTOR_INDEX_BACKEND=mmap")
+    parser.add_argument("command", choices=["export", "update", "info"])
+    args = parser.parse_args()
+
+    # One snapshot per shard
+    for collection in get_shard_collections():
+        if args.command == "export":
+            print(json.dumps(export_snapshot(collection), indent=2))
+        elif args.command == "update":
+            print(json.dumps(update_snapshot(collection), indent=2))
+        else:
+            print(json.dumps(read_manifest(snapshot_directory(collection)), indent=2))
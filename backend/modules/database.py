@@ -1,4 +1,6 @@
 import os
+import hashlib
+import threading
 from pymongo import MongoClient
 from dotenv import load_dotenv
 from logger import logger
@@ -8,15 +10,31 @@ load_dotenv()
 MONGODB_URL = os.environ.get("MONGODB_URL", "mongodb://localhost:27017/")
 DATABASE_NAME = os.environ.get("DATABASE_NAME", "ragbot_db")
 COLLECTION_NAME = os.environ.get("COLLECTION_NAME", "documents")
+MONGODB_MAX_POOL_SIZE = int(os.environ.get("MONGODB_MAX_POOL_SIZE", "50"))
+# Chunk collections the corpus is partitioned over by source hash; 1 keeps every chunk in COLLECTION_NAME.
+# Changing it moves most sources to another shard, so re-ingest after changing it
+SHARD_COUNT = int(os.environ.get("SHARD_COUNT", "1"))
+# Comma-separated MongoDB URLs the shards are placed on round-robin; empty keeps them all on MONGODB_URL
+SHARD_MONGODB_URLS = [url.strip() for url in os.environ.get("SHARD_MONGODB_URLS", "").split(",") if url.strip()]
+
+_client = None
+_shard_clients = {}
+_client_lock = threading.Lock()
 
 def get_mongo_client():
-    """Get MongoDB client connection"""
-    try:
-        client = MongoClient(MONGODB_URL)
-        return client
-    except Exception as e:
-        logger.error(f"Error connecting to MongoDB: {e}")
-        raise
+    """Get the process-wide MongoDB client (one connection pool shared by all requests)"""
+    global _client
+    if _client is not None:
+        return _client
+    with _client_lock:
+        if _client is None:
+            try:
+                _client = MongoClient(MONGODB_URL, maxPoolSize=MONGODB_MAX_POOL_SIZE)
+                logger.info("MongoDB client created")
+            except Exception as e:
+                logger.error(f"Error connecting to MongoDB: {e}")
+                raise
+        return _client
 
 def get_database():
     """Get MongoDB database"""
@@ -28,29 +46,86 @@ def get_collection(collection_name=COLLECTION_NAME):
     db = get_database()
     return db[collection_name]
 
+def _get_shard_client(url):
+    """One client (and connection pool) per shard URL, created on first use"""
+    client = _shard_clients.get(url)
+    if client is not None:
+        return client
+    with _client_lock:
+        if url not in _shard_clients:
+            _shard_clients[url] = MongoClient(url, maxPoolSize=MONGODB_MAX_POOL_SIZE)
+            logger.info(f"MongoDB shard client created for {url}")
+        return _shard_clients[url]
+
+def get_shard_collections():
+    """Every chunk collection, in shard order; [get_collection()] when SHARD_COUNT is 1"""
+    if SHARD_COUNT <= 1:
+        return [get_collection()]
+    shards = []
+    for index in range(SHARD_COUNT):
+        client = _get_shard_client(SHARD_MONGODB_URLS[index % len(SHARD_MONGODB_URLS)]) if SHARD_MONGODB_URLS else get_mongo_client()
+        # Names stay distinct across instances, so per-collection state (corpus version, indexes) never collides
+        shards.append(client[DATABASE_NAME][f"{COLLECTION_NAME}_shard{index}"])
+    return shards
+
+def shard_number(key):
+    """Shard a source path (or any other partition key) belongs to; stable across processes and restarts"""
+    if SHARD_COUNT <= 1:
+        return 0
+    digest = hashlib.blake2b(str(key).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % SHARD_COUNT
+
+def get_shard_collection(key):
+    """The chunk collection holding every chunk of a source"""
+    return get_shard_collections()[shard_number(key)]
+
 def create_indexes():
     """Create indexes for better performance"""
     try:
-        collection = get_collection()
-        
-        # Create text index for full-text search
-        collection.create_index([("content", "text")])
-        
-        # Create index on source field
-        collection.create_index("source")
-        
-        # Create index on embeddings if using vector search
-        collection.create_index("embeddings")
-        
+        for collection in get_shard_collections():
+            _create_chunk_indexes(collection)
         logger.info("MongoDB indexes created successfully")
     except Exception as e:
         logger.error(f"Error creating indexes: {e}")
 
+def _create_chunk_indexes(collection):
+    """Indexes every chunk collection (each shard) needs"""
+    # Create text index for full-text search
+    collection.create_index([("content", "text")])
+    
+    # Create index on source field
+    collection.create_index("source")
+    
+    # Content-hash lookups for incremental re-ingestion
+    collection.create_index([("source", 1), ("content_hash", 1)])
+    collection.create_index([("source", 1), ("file_hash", 1)])
+    
+    # Lets similarity_search tell whether any embedding is stored packed
+    collection.create_index("embedding_format", sparse=True)
+    
+    # Metadata prefilters for retrieval (source / document_type plus a created_at range)
+    collection.create_index([("source", 1), ("created_at", 1)])
+    collection.create_index([("document_type", 1), ("created_at", 1)])
+    
+    # Lets an interrupted ingestion job find the chunks it stored
+    collection.create_index("job_id", sparse=True)
+
 def close_connection():
-    """Close MongoDB connection"""
-    try:
-        client = get_mongo_client()
-        client.close()
-        logger.info("MongoDB connection closed")
-    except Exception as e:
-        logger.error(f"Error closing MongoDB connection: {e}")
\ No newline at end of file
+    """Close the shared MongoDB client, any shard clients and their connection pools"""
+    global _client
+    with _client_lock:
+        for url, client in _shard_clients.items():
+            try:
+                client.close()
+            except Exception as e:
+                logger.error(f"Error closing MongoDB connection to shard {url}: {e}")
+        _shard_clients.clear()
+        if _client is None:
+            return
+        try:
+            _client.close()
+            logger.info("MongoDB connection closed")
+        except Exception as e:
+            logger.error(f"Error closing MongoDB connection: {e}")
+        finally:
+            _client = None
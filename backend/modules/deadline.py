@@ -0,0 +1,42 @@
+import os
+import time
+import asyncio
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# End-to-end budget for one /ask/ request; 0 disables deadlines
+ASK_DEADLINE_SECONDS = float(os.environ.get("ASK_DEADLINE_SECONDS", "20"))
+# Share of the remaining budget retrieval (query embedding, cache lookup, search) may use
+RETRIEVAL_BUDGET_SHARE = float(os.environ.get("RETRIEVAL_BUDGET_SHARE", "0.25"))
+# Share of the remaining budget the lexical fallback may use after retrieval overran
+LEXICAL_FALLBACK_SHARE = float(os.environ.get("LEXICAL_FALLBACK_SHARE", "0.1"))
+
+class Deadline:
+    """A point in time (monotonic clock) by which some work has to finish"""
+    def __init__(self, seconds):
+        self.end = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.end - time.monotonic())
+
+    def expired(self):
+        return time.monotonic() >= self.end
+
+    def max_time_ms(self):
+        """Remaining time as a Mongo maxTimeMS (at least 1, since 0 means no limit)"""
+        return max(1, int(self.remaining() * 1000))
+
+    def share(self, fraction):
+        """A deadline for one stage: fraction of the remaining time, never past this one"""
+        return Deadline(self.remaining() * fraction)
+
+def request_deadline():
+    """Deadline for a new /ask/ request, or None when ASK_DEADLINE_SECONDS is 0"""
+    return Deadline(ASK_DEADLINE_SECONDS) if ASK_DEADLINE_SECONDS > 0 else None
+
+async def within(deadline, awaitable):
+    """Await awaitable, raising asyncio.TimeoutError once deadline passes (no limit for None)"""
+    if deadline is None:
+        return await awaitable
+    return await asyncio.wait_for(awaitable, deadline.remaining())
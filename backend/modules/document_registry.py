@@ -0,0 +1,203 @@
+import os
+import time
+import threading
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError
+from modules.database import get_database
+from logger import logger
+
+load_dotenv()
+
+CORPUS_STATE_COLLECTION_NAME = os.environ.get("CORPUS_STATE_COLLECTION_NAME", "corpus_state")
+# How long chunk-level changes are kept for other processes to replay; laggards rebuild instead
+CORPUS_CHANGE_LOG_TTL = int(os.environ.get("CORPUS_CHANGE_LOG_TTL", str(7 * 24 * 3600)))
+# How stale a process's view of the corpus version may be
+CORPUS_VERSION_POLL_SECONDS = float(os.environ.get("CORPUS_VERSION_POLL_SECONDS", "1.0"))
+# Chunk ids per change log entry, keeps entries far below the 16 MB document limit
+CHANGE_IDS_PER_ENTRY = 10000
+
+_versions = {}
+_versions_lock = threading.Lock()
+
+def get_registry_collection(collection):
+    """One entry per ingested file, keyed by its stored source path"""
+    return collection.database[f"{collection.name}_registry"]
+
+def get_changes_collection(collection):
+    """Ordered log of chunk ids added and removed, one entry per corpus version"""
+    return collection.database[f"{collection.name}_changes"]
+
+def get_corpus_state_collection():
+    """Corpus version and maintained chunk/file counters, one document per chunk collection"""
+    return get_database()[CORPUS_STATE_COLLECTION_NAME]
+
+def create_registry_indexes(collection):
+    get_registry_collection(collection).create_index("filename_lower")
+    changes = get_changes_collection(collection)
+    changes.create_index("version", unique=True)
+    changes.create_index("at", expireAfterSeconds=CORPUS_CHANGE_LOG_TTL)
+
+def record_change(collection, op, ids):
+    """Bump the corpus version once per batch of added ("add") or removed ("remove") chunk ids"""
+    ids = list(ids)
+    version = None
+    for start in range(0, len(ids), CHANGE_IDS_PER_ENTRY):
+        version = _append_change(collection, op, ids[start:start + CHANGE_IDS_PER_ENTRY])
+    if version is not None:
+        with _versions_lock:
+            _versions[collection.name] = (version, time.monotonic())
+    return version
+
+def _append_change(collection, op, ids):
+    """Insert the next change log entry and return its version.
+
+    The version is one past the newest entry (or the stored version, once
+    every entry has expired) and is claimed by the insert itself through the
+    unique index, so concurrent writers retry instead of leaving a gap. The
+    corpus version follows with $max.
+    """
+    changes = get_changes_collection(collection)
+    state_collection = get_corpus_state_collection()
+    while True:
+        last = changes.find_one({}, {"version": 1}, sort=[("version", DESCENDING)])
+        state = state_collection.find_one({"_id": collection.name}, {"version": 1})
+        version = max(last["version"] if last else 0, state.get("version", 0) if state else 0) + 1
+        try:
+            changes.insert_one({"version": version, "op": op, "ids": ids, "at": datetime.now(timezone.utc)})
+            break
+        except DuplicateKeyError:
+            # Another writer took this version first
+            continue
+    state_collection.update_one({"_id": collection.name}, {"$max": {"version": version}}, upsert=True)
+    return version
+
+def get_corpus_version(collection, max_age=CORPUS_VERSION_POLL_SECONDS):
+    """Current corpus version, read from Mongo at most once per max_age seconds per process"""
+    now = time.monotonic()
+    with _versions_lock:
+        cached = _versions.get(collection.name)
+    if cached is not None and now - cached[1] < max_age:
+        return cached[0]
+    state = get_corpus_state_collection().find_one({"_id": collection.name}, {"version": 1})
+    version = state.get("version", 0) if state else 0
+    with _versions_lock:
+        _versions[collection.name] = (version, now)
+    return version
+
+def changes_since(collection, version):
+    """Change log entries after version, oldest first, or None if some have already expired"""
+    changes = list(get_changes_collection(collection).find({"version": {"$gt": version}}).sort("version", ASCENDING))
+    if changes and changes[0]["version"] != version + 1:
+        return None
+    if not changes and get_corpus_version(collection, max_age=0) > version:
+        # Every entry past version has expired
+        return None
+    return changes
+
+def _apply_counts(collection, *deltas):
+    """$inc the per-type counters by (document_type, chunks, files) deltas"""
+    increments = {}
+    for doc_type, chunks, files in deltas:
+        increments[f"chunks.{doc_type}"] = increments.get(f"chunks.{doc_type}", 0) + chunks
+        increments[f"files.{doc_type}"] = increments.get(f"files.{doc_type}", 0) + files
+    increments = {key: value for key, value in increments.items() if value}
+    if increments:
+        get_corpus_state_collection().update_one({"_id": collection.name}, {"$inc": increments}, upsert=True)
+
+def register_file(collection, source, doc_type, file_hash):
+    """Record a file's current chunk count and hash after ingestion and adjust the corpus counters"""
+    chunk_count = collection.count_documents({"source": source})
+    now = time.time()
+    previous = get_registry_collection(collection).find_one_and_update(
+        {"_id": source},
+        {
+            "$set": {
+                "filename": os.path.basename(source),
+                "filename_lower": os.path.basename(source).lower(),
+                "document_type": doc_type,
+                "file_hash": file_hash,
+                "chunk_count": chunk_count,
+                "updated_at": now
+            },
+            "$setOnInsert": {"created_at": now}
+        },
+        upsert=True
+    )
+    if previous is None:
+        _apply_counts(collection, (doc_type, chunk_count, 1))
+    else:
+        _apply_counts(collection, (previous["document_type"], -previous["chunk_count"], -1), (doc_type, chunk_count, 1))
+
+def unregister_file(collection, source):
+    """Drop a file from the registry after its chunks were deleted"""
+    previous = get_registry_collection(collection).find_one_and_delete({"_id": source})
+    if previous is not None:
+        _apply_counts(collection, (previous["document_type"], -previous["chunk_count"], -1))
+
+def find_files(collection, filename):
+    """Registry entries whose filename or stored source path matches exactly (filename case-insensitively)"""
+    registry = get_registry_collection(collection)
+    entry = registry.find_one({"_id": filename})
+    if entry is not None:
+        return [entry]
+    return list(registry.find({"filename_lower": os.path.basename(filename).lower()}))
+
+def corpus_stats(collection):
+    """Chunk and file counts per document type plus the corpus version, without touching the chunks"""
+    state = get_corpus_state_collection().find_one({"_id": collection.name}) or {}
+    chunks = state.get("chunks", {})
+    files = state.get("files", {})
+    return {
+        "total_documents": sum(chunks.values()),
+        "pdf_documents": chunks.get("pdf", 0),
+        "json_documents": chunks.get("json", 0),
+        "total_files": sum(files.values()),
+        "files_by_type": files,
+        "corpus_version": state.get("version", 0)
+    }
+
+def rebuild_registry(collection):
+    """Recreate the registry and counters from the chunks themselves (one aggregation over the collection)"""
+    registry = get_registry_collection(collection)
+    registry.delete_many({})
+    now = time.time()
+    chunks, files = {}, {}
+    entries = []
+    for group in collection.aggregate([
+        {"$group": {
+            "_id": "$source",
+            "document_type": {"$first": "$document_type"},
+            "file_hash": {"$first": "$file_hash"},
+            "chunk_count": {"$sum": 1}
+        }}
+    ], allowDiskUse=True):
+        doc_type = group.get("document_type") or "unknown"
+        entries.append({
+            "_id": group["_id"],
+            "filename": os.path.basename(group["_id"] or ""),
+            "filename_lower": os.path.basename(group["_id"] or "").lower(),
+            "document_type": doc_type,
+            "file_hash": group.get("file_hash"),
+            "chunk_count": group["chunk_count"],
+            "created_at": now,
+            "updated_at": now
+        })
+        chunks[doc_type] = chunks.get(doc_type, 0) + group["chunk_count"]
+        files[doc_type] = files.get(doc_type, 0) + 1
+    if entries:
+        registry.insert_many(entries)
+    get_corpus_state_collection().update_one(
+        {"_id": collection.name},
+        {"$set": {"chunks": chunks, "files": files}, "$setOnInsert": {"version": 0}},
+        upsert=True
+    )
+    logger.info(f"Rebuilt document registry for {collection.full_name}: {len(entries)} files")
+    return len(entries)
+
+def ensure_registry(collection):
+    """Build the registry once for corpora ingested before it existed"""
+    create_registry_indexes(collection)
+    if get_corpus_state_collection().find_one({"_id": collection.name, "chunks": {"$exists": True}}) is None:
+        rebuild_registry(collection)
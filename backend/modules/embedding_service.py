@@ -0,0 +1,210 @@
+import os
+import base64
+import asyncio
+import argparse
+import threading
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+import numpy as np
+import requests
+from fastapi import FastAPI, HTTPException
+from dotenv import load_dotenv
+from modules.metrics import Counter, register
+from logger import logger
+
+load_dotenv()
+
+# "local" loads the model in every web worker; "remote" sends texts to one shared embedding worker
+EMBEDDING_BACKEND = os.environ.get("EMBEDDING_BACKEND", "local").lower()
+EMBEDDING_SERVICE_URL = os.environ.get("EMBEDDING_SERVICE_URL", "http://127.0.0.1:8100")
+EMBEDDING_SERVICE_TIMEOUT = float(os.environ.get("EMBEDDING_SERVICE_TIMEOUT", "30"))
+# Distinct query strings whose embeddings are kept; 0 disables the cache
+QUERY_EMBEDDING_CACHE_SIZE = int(os.environ.get("QUERY_EMBEDDING_CACHE_SIZE", "2048"))
+# Embedding worker: texts per forward pass, and how long the first request waits for company
+EMBEDDING_MAX_BATCH = int(os.environ.get("EMBEDDING_MAX_BATCH", "64"))
+EMBEDDING_MAX_WAIT_MS = float(os.environ.get("EMBEDDING_MAX_WAIT_MS", "5"))
+
+QUERY_EMBEDDING_CACHE = register(Counter(
+    "ragbot_query_embedding_cache_total", "Query embedding cache lookups", ["result"]
+))
+
+def encode_vectors(vectors):
+    """Pack a list of vectors as base64 float32, about a quarter the size of JSON floats"""
+    matrix = np.asarray(vectors, dtype=np.float32)
+    return {"dim": int(matrix.shape[1]) if matrix.ndim == 2 else 0, "data": base64.b64encode(matrix.tobytes()).decode("ascii")}
+
+def decode_vectors(payload):
+    matrix = np.frombuffer(base64.b64decode(payload["data"]), dtype=np.float32)
+    return matrix.reshape(-1, payload["dim"]).tolist() if payload["dim"] else []
+
+class CachedEmbeddings:
+    """Wraps an embeddings model with a bounded LRU cache of query embeddings"""
+    def __init__(self, model, max_entries=QUERY_EMBEDDING_CACHE_SIZE):
+        self.model = model
+        self.max_entries = max_entries
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def embed_query(self, text):
+        if self.max_entries <= 0:
+            return self.model.embed_query(text)
+        with self._lock:
+            vector = self._cache.get(text)
+            if vector is not None:
+                self._cache.move_to_end(text)
+        if vector is not None:
+            QUERY_EMBEDDING_CACHE.inc("hit")
+            return list(vector)
+        QUERY_EMBEDDING_CACHE.inc("miss")
+        vector = self.model.embed_query(text)
+        with self._lock:
+            self._cache[text] = tuple(vector)
+            self._cache.move_to_end(text)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return vector
+
+    def embed_queries(self, texts):
+        """Embed many queries: cached ones from the cache, the rest in one embed_documents call"""
+        texts = list(texts)
+        vectors = [None] * len(texts)
+        if self.max_entries > 0:
+            with self._lock:
+                for i, text in enumerate(texts):
+                    vector = self._cache.get(text)
+                    if vector is not None:
+                        self._cache.move_to_end(text)
+                        vectors[i] = list(vector)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        QUERY_EMBEDDING_CACHE.inc("hit", amount=len(texts) - len(missing))
+        if not missing:
+            return vectors
+        QUERY_EMBEDDING_CACHE.inc("miss", amount=len(missing))
+        for i, vector in zip(missing, self.model.embed_documents([texts[i] for i in missing])):
+            vectors[i] = vector
+        if self.max_entries > 0:
+            with self._lock:
+                for i in missing:
+                    self._cache[texts[i]] = tuple(vectors[i])
+                    self._cache.move_to_end(texts[i])
+                while len(self._cache) > self.max_entries:
+                    self._cache.popitem(last=False)
+        return vectors
+
+    def embed_documents(self, texts):
+        return self.model.embed_documents(texts)
+
+class RemoteEmbeddings:
+    """Client for the shared embedding worker (python -m modules.embedding_service)"""
+    def __init__(self, url=EMBEDDING_SERVICE_URL, timeout=EMBEDDING_SERVICE_TIMEOUT):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _session(self):
+        # requests.Session is not thread-safe; one keep-alive session per thread
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+        response = self._session().post(f"{self.url}/embed", json={"texts": list(texts)}, timeout=self.timeout)
+        response.raise_for_status()
+        return decode_vectors(response.json())
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+class MicroBatcher:
+    """Collects concurrent embedding requests into one forward pass.
+
+    The first request in a batch waits at most max_wait seconds for others;
+    requests arriving while a pass is running form the next batch.
+    """
+    def __init__(self, model, max_batch=EMBEDDING_MAX_BATCH, max_wait=EMBEDDING_MAX_WAIT_MS / 1000):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = asyncio.Queue()
+
+    async def embed(self, texts):
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((texts, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            size = len(batch[0][0])
+            deadline = loop.time() + self.max_wait
+            while size < self.max_batch:
+                try:
+                    item = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                batch.append(item)
+                size += len(item[0])
+
+            texts = [text for item_texts, _ in batch for text in item_texts]
+            try:
+                vectors = await loop.run_in_executor(None, self.model.embed_documents, texts)
+            except Exception as e:
+                logger.exception(f"Error embedding a batch of {len(texts)} texts")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            offset = 0
+            for item_texts, future in batch:
+                if not future.done():
+                    future.set_result(vectors[offset:offset + len(item_texts)])
+                offset += len(item_texts)
+            logger.debug(f"Embedded {len(texts)} texts from {len(batch)} requests in one pass")
+
+def create_app(model):
+    """FastAPI app of the embedding worker; one process serves every web worker"""
+    batcher = MicroBatcher(model)
+
+    @asynccontextmanager
+    async def lifespan(app):
+        task = asyncio.create_task(batcher.run())
+        yield
+        task.cancel()
+
+    app = FastAPI(title="Embedding worker", lifespan=lifespan)
+
+    @app.post("/embed")
+    async def embed(payload: dict):
+        texts = payload.get("texts")
+        if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+            raise HTTPException(status_code=400, detail="texts must be a list of strings")
+        return encode_vectors(await batcher.embed(texts))
+
+    @app.get("/health")
+    async def health():
+        return {"status": "ok", "queued": batcher._queue.qsize()}
+
+    return app
+
+if __name__ == "__main__":
+    # Usage (from backend/): python -m modules.embedding_service --port 8100
+    # then run the web workers with EMBEDDING_BACKEND=remote
+    import uvicorn
+    from modules.resources import create_local_embeddings
+
+    parser = argparse.ArgumentParser(description="Shared embedding worker with micro-batching")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    args = parser.parse_args()
+
+    uvicorn.run(create_app(create_local_embeddings()), host=args.host, port=args.port, workers=1)
@@ -0,0 +1,165 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from bson.binary import Binary
+from dotenv import load_dotenv
+from pymongo import UpdateOne
+from logger import logger
+
+load_dotenv()
+
+# "array" (BSON doubles, the original format), "float32" (packed BinData),
+# "int8" (scalar quantized) or "binary" (one sign bit per dimension)
+EMBEDDING_STORAGE_FORMAT = os.environ.get("EMBEDDING_STORAGE_FORMAT", "array").lower()
+# Quantized formats score RESCORE_FACTOR * k candidates, then rerank them with float32 vectors
+RESCORE_FACTOR = int(os.environ.get("RESCORE_FACTOR", "4"))
+
+STORAGE_FORMATS = ("array", "float32", "int8", "binary")
+QUANTIZED_FORMATS = ("int8", "binary")
+
+# Fields needed to decode a stored embedding
+EMBEDDING_PROJECTION = {"embeddings": 1, "embedding_format": 1, "embedding_scale": 1, "embedding_dim": 1}
+
+def encode_embedding(vector, storage_format=EMBEDDING_STORAGE_FORMAT):
+    """Return the document fields that store a vector in the given format"""
+    if storage_format == "array":
+        return {"embeddings": [float(x) for x in vector]}
+    vector = np.asarray(vector, dtype=np.float32)
+    if storage_format == "float32":
+        return {"embeddings": Binary(vector.tobytes()), "embedding_format": "float32"}
+    if storage_format == "int8":
+        peak = float(np.max(np.abs(vector))) if vector.size else 0.0
+        scale = peak / 127.0 if peak else 1.0
+        quantized = np.clip(np.round(vector / scale), -127, 127).astype(np.int8)
+        return {"embeddings": Binary(quantized.tobytes()), "embedding_format": "int8", "embedding_scale": scale}
+    if storage_format == "binary":
+        bits = np.packbits(vector > 0)
+        return {
+            "embeddings": Binary(bits.tobytes()),
+            "embedding_format": "binary",
+            "embedding_scale": float(np.mean(np.abs(vector))) if vector.size else 0.0,
+            "embedding_dim": int(vector.size)
+        }
+    raise ValueError(f"Unknown embedding storage format: {storage_format}")
+
+def decode_embedding(doc):
+    """Decode a stored embedding of any format to float32 (approximate for quantized formats)"""
+    storage_format = doc.get("embedding_format", "array")
+    data = doc["embeddings"]
+    if storage_format == "array":
+        return np.asarray(data, dtype=np.float32)
+    if storage_format == "float32":
+        return np.frombuffer(data, dtype=np.float32)
+    if storage_format == "int8":
+        return np.frombuffer(data, dtype=np.int8).astype(np.float32) * np.float32(doc["embedding_scale"])
+    if storage_format == "binary":
+        bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8))[:doc["embedding_dim"]]
+        return (bits.astype(np.float32) * 2.0 - 1.0) * np.float32(doc["embedding_scale"])
+    raise ValueError(f"Unknown embedding storage format: {storage_format}")
+
+def get_full_vectors_collection(collection):
+    """Side collection holding float32 vectors used to rescore quantized candidates"""
+    return collection.database[f"{collection.name}_full_vectors"]
+
+def store_full_vectors(collection, ids, vectors):
+    """Keep float32 copies of vectors whose main copy is quantized"""
+    if not ids:
+        return
+    get_full_vectors_collection(collection).bulk_write([
+        UpdateOne({"_id": doc_id}, {"$set": {"vector": Binary(np.asarray(vector, dtype=np.float32).tobytes())}}, upsert=True)
+        for doc_id, vector in zip(ids, vectors)
+    ], ordered=False)
+
+def delete_full_vectors(collection, ids):
+    if ids:
+        get_full_vectors_collection(collection).delete_many({"_id": {"$in": list(ids)}})
+
+def rescore(collection, query_embedding, candidates, k):
+    """Rerank (id, approximate score) candidates by exact dot product with float32 vectors.
+
+    Candidates without a stored float32 vector keep their approximate score.
+    """
+    if not candidates:
+        return []
+    query = np.asarray(query_embedding, dtype=np.float32)
+    ids = [doc_id for doc_id, _ in candidates]
+    full = {
+        doc["_id"]: np.frombuffer(doc["vector"], dtype=np.float32)
+        for doc in get_full_vectors_collection(collection).find({"_id": {"$in": ids}})
+    }
+    rescored = [
+        (doc_id, float(full[doc_id] @ query) if doc_id in full else score)
+        for doc_id, score in candidates
+    ]
+    rescored.sort(key=lambda hit: hit[1], reverse=True)
+    return rescored[:k]
+
+def uses_packed_embeddings(collection):
+    """True once any document stores its embedding in a non-array format"""
+    return collection.find_one({"embedding_format": {"$exists": True}}, {"_id": 1}) is not None
+
+def migrate_collection(collection, storage_format, batch_size=1000):
+    """Rewrite every embedding not already in storage_format. Returns the number migrated."""
+    if storage_format not in STORAGE_FORMATS:
+        raise ValueError(f"Unknown embedding storage format: {storage_format}")
+    if storage_format == "array":
+        query = {"embedding_format": {"$exists": True}}
+    else:
+        query = {"embedding_format": {"$ne": storage_format}}
+    query["embeddings"] = {"$exists": True}
+
+    migrated = 0
+    start = time.time()
+    batch = []
+
+    def flush():
+        nonlocal migrated
+        ids = [doc["_id"] for doc in batch]
+        full = {
+            doc["_id"]: np.frombuffer(doc["vector"], dtype=np.float32)
+            for doc in get_full_vectors_collection(collection).find({"_id": {"$in": ids}})
+        }
+        vectors = [full.get(doc["_id"], decode_embedding(doc)) for doc in batch]
+        updates = []
+        for doc, vector in zip(batch, vectors):
+            fields = encode_embedding(vector, storage_format)
+            unset = {field: "" for field in ("embedding_format", "embedding_scale", "embedding_dim") if field not in fields}
+            update = {"$set": fields}
+            if unset:
+                update["$unset"] = unset
+            updates.append(UpdateOne({"_id": doc["_id"]}, update))
+        collection.bulk_write(updates, ordered=False)
+        if storage_format in QUANTIZED_FORMATS:
+            store_full_vectors(collection, ids, vectors)
+        else:
+            delete_full_vectors(collection, ids)
+        migrated += len(batch)
+        logger.info(f"Migrated {migrated} embeddings to {storage_format} ({migrated / (time.time() - start):.0f}/s)")
+        batch.clear()
+
+    for doc in collection.find(query, EMBEDDING_PROJECTION).batch_size(batch_size):
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    return migrated
+
+if __name__ == "__main__":
+    # Usage (from backend/): python -m modules.embedding_storage --to float32
+    from modules.database import get_collection, get_shard_collections
+
+    parser = argparse.ArgumentParser(description="Convert stored embeddings to another storage format")
+    parser.add_argument("--to", required=True, choices=STORAGE_FORMATS, help="target storage format")
+    parser.add_argument("--collection", default=None, help="collection to migrate (defaults to every chunk shard)")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    targets = [get_collection(args.collection)] if args.collection else get_shard_collections()
+    for target in targets:
+        count = migrate_collection(target, args.to, args.batch_size)
+        logger.info(f"Migrated {count} documents in {target.full_name}")
+    logger.info(f"Set EMBEDDING_STORAGE_FORMAT={args.to} and restart the backend")
+    sys.exit(0)
@@ -0,0 +1,189 @@
+import os
+import time
+import uuid
+import threading
+from dotenv import load_dotenv
+from pymongo import ReturnDocument
+from modules.answer_cache import invalidate_answer_cache
+from modules.database import get_collection, get_shard_collections
+from modules.load_vectorstore import ingest_pdf_files, ingest_json_files, delete_chunks, forget_file_hashes
+from modules.vector_index import refresh_snapshot
+from modules.workers import submit_ingest
+from logger import logger
+
+load_dotenv()
+
+JOBS_COLLECTION_NAME = os.environ.get("JOBS_COLLECTION_NAME", "ingest_jobs")
+# A running job whose record has not been touched for this long is treated as orphaned
+JOB_STALE_SECONDS = int(os.environ.get("JOB_STALE_SECONDS", "300"))
+# How often a running job touches its record, so a live one never looks orphaned
+JOB_HEARTBEAT_SECONDS = float(os.environ.get("JOB_HEARTBEAT_SECONDS", str(JOB_STALE_SECONDS / 5)))
+
+# Identifies this process as the owner of the jobs it claims
+PROCESS_ID = uuid.uuid4().hex
+
+INGESTERS = {
+    "pdf": ingest_pdf_files,
+    "json": ingest_json_files
+}
+
+def get_jobs_collection():
+    """Get MongoDB collection holding ingestion job records"""
+    return get_collection(JOBS_COLLECTION_NAME)
+
+def enqueue_ingest_job(doc_type, file_paths, file_hashes=None):
+    """Record an ingestion job for files already on disk and queue it for the workers"""
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    get_jobs_collection().insert_one({
+        "_id": job_id,
+        "document_type": doc_type,
+        "files": file_paths,
+        # Hashes computed while the uploads were streamed to disk, aligned with files
+        "file_hashes": [(file_hashes or {}).get(path) for path in file_paths],
+        "stage": "queued",
+        "chunks_processed": 0,
+        "throughput": 0.0,
+        "error": None,
+        "attempts": 0,
+        "created_at": now,
+        "updated_at": now
+    })
+    submit_ingest(run_ingest_job, job_id)
+    logger.info(f"Queued {doc_type} ingestion job {job_id} for {len(file_paths)} files")
+    return job_id
+
+def get_job(job_id):
+    """Get an ingestion job record, or None if it does not exist"""
+    return get_jobs_collection().find_one({"_id": job_id})
+
+def run_ingest_job(job_id):
+    """Claim a queued (or orphaned) job and run it, recording progress in Mongo.
+
+    A job another process is running stays with it while its heartbeat is
+    fresh; this process checks again once the heartbeat could have gone stale,
+    so a job left running by a process that died is picked up after
+    JOB_STALE_SECONDS rather than never.
+    """
+    jobs = get_jobs_collection()
+    now = time.time()
+    job = jobs.find_one_and_update(
+        {
+            "_id": job_id,
+            "$or": [
+                {"stage": "queued"},
+                {"stage": "running", "updated_at": {"$lt": now - JOB_STALE_SECONDS}}
+            ]
+        },
+        {"$set": {"stage": "running", "owner": PROCESS_ID, "started_at": now, "updated_at": now},
+         "$inc": {"attempts": 1}},
+        return_document=ReturnDocument.AFTER
+    )
+    if job is None:
+        current = jobs.find_one({"_id": job_id}, {"stage": 1, "owner": 1, "updated_at": 1})
+        if current is not None and current["stage"] == "running" and current.get("owner") != PROCESS_ID:
+            # Another process holds it, alive or not yet known to be dead
+            _claim_later(job_id, current["updated_at"] + JOB_STALE_SECONDS - now)
+        # Otherwise finished, deleted or running in this process
+        return
+
+    if job["attempts"] > 1:
+        _discard_partial_results(job)
+
+    def progress(chunks_processed, elapsed):
+        jobs.update_one({"_id": job_id}, {"$set": {
+            "chunks_processed": chunks_processed,
+            "throughput": chunks_processed / elapsed if elapsed else 0.0,
+            "updated_at": time.time()
+        }})
+
+    stop_heartbeat = threading.Event()
+    threading.Thread(
+        target=_heartbeat, args=(job_id, stop_heartbeat), name=f"job-heartbeat-{job_id[:8]}", daemon=True
+    ).start()
+    try:
+        logger.info(f"Running {job['document_type']} ingestion job {job_id} (attempt {job['attempts']})")
+        file_hashes = dict(zip(job["files"], job.get("file_hashes") or []))
+        report = INGESTERS[job["document_type"]](job["files"], progress, job_id, file_hashes)
+        count = report["chunks_added"] + report["chunks_skipped"]
+        finished = time.time()
+        jobs.update_one({"_id": job_id}, {"$set": {
+            "stage": "completed",
+            "chunks_processed": count,
+            "report": report,
+            "throughput": report["chunks_added"] / (finished - now) if finished > now else 0.0,
+            "finished_at": finished,
+            "updated_at": finished
+        }})
+        logger.info(f"Ingestion job {job_id} completed with {count} chunks")
+        invalidate_answer_cache()
+        for collection in get_shard_collections():
+            refresh_snapshot(collection)
+    except Exception as e:
+        logger.exception(f"Ingestion job {job_id} failed")
+        # Drop what the failed attempt stored; what is left of each file stays searchable
+        try:
+            _discard_partial_results(job)
+        except Exception:
+            logger.exception(f"Could not discard chunks of failed ingestion job {job_id}")
+        jobs.update_one({"_id": job_id}, {"$set": {
+            "stage": "failed",
+            "error": str(e),
+            "finished_at": time.time(),
+            "updated_at": time.time()
+        }})
+    finally:
+        stop_heartbeat.set()
+
+def _heartbeat(job_id, stop):
+    """Touch the job's record every JOB_HEARTBEAT_SECONDS until stop is set"""
+    while not stop.wait(JOB_HEARTBEAT_SECONDS):
+        try:
+            get_jobs_collection().update_one(
+                {"_id": job_id, "stage": "running", "owner": PROCESS_ID}, {"$set": {"updated_at": time.time()}}
+            )
+        except Exception:
+            logger.exception(f"Could not update heartbeat of ingestion job {job_id}")
+
+def _claim_later(job_id, delay):
+    """Try run_ingest_job again once delay seconds have passed"""
+    def retry():
+        try:
+            submit_ingest(run_ingest_job, job_id)
+        except RuntimeError:
+            # Worker pools already shut down; the next start resumes the job
+            pass
+    timer = threading.Timer(max(delay, 0) + 1, retry)
+    timer.daemon = True
+    timer.start()
+    logger.info(f"Ingestion job {job_id} is held by another process, checking again in {max(delay, 0) + 1:.0f}s")
+
+def _discard_partial_results(job):
+    """Remove chunks stored by an interrupted attempt so the rerun does not duplicate them.
+
+    The attempt may already have stamped some files with their new hash and
+    retired their old chunks, so the job's files also lose their stored hash:
+    the rerun (or a later upload) reads them again instead of skipping them as
+    unchanged, and the registry is recounted from the chunks that remain.
+    """
+    job_id = job["_id"]
+    for collection in get_shard_collections():
+        ids = [doc["_id"] for doc in collection.find({"job_id": job_id}, {"_id": 1})]
+        if ids:
+            delete_chunks(collection, ids)
+            logger.info(f"Discarded {len(ids)} chunks in {collection.full_name} from interrupted attempt of job {job_id}")
+    forget_file_hashes(job["files"], job["document_type"])
+
+def resume_ingest_jobs():
+    """Re-queue jobs left queued or running by a previous process.
+
+    Running jobs are claimed once their heartbeat is older than JOB_STALE_SECONDS.
+    """
+    pending = [job["_id"] for job in get_jobs_collection().find(
+        {"stage": {"$in": ["queued", "running"]}}, {"_id": 1}
+    )]
+    for job_id in pending:
+        submit_ingest(run_ingest_job, job_id)
+    if pending:
+        logger.info(f"Resumed {len(pending)} ingestion jobs")
+    return len(pending)
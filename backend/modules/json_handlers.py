@@ -0,0 +1,104 @@
+import os
+import json
+
+# Bytes read from disk at a time; the buffer only ever holds the current item plus one read
+JSON_READ_SIZE = 1 << 20
+# Top-level objects larger than this are split into one document per key
+JSON_OBJECT_SPLIT_SIZE = 5000
+NDJSON_EXTENSIONS = (".ndjson", ".jsonl")
+
+class _JSONStream:
+    """Decode consecutive JSON values from a text file without loading the whole file"""
+    def __init__(self, f, read_size=JSON_READ_SIZE):
+        self.f = f
+        self.read_size = read_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self, size):
+        data = self.f.read(size)
+        if not data:
+            self.eof = True
+            return
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+
+    def peek(self):
+        """Next non-whitespace character, or "" at end of file"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buffer) or self.eof:
+                return self.buffer[self.pos:self.pos + 1]
+            self._fill(self.read_size)
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise json.JSONDecodeError(f"Expected {char!r}, found {found!r}", self.buffer, self.pos)
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        size = self.read_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A value ending exactly at the buffer end may be a truncated number or literal
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # The value continues past the buffer; grow reads so a huge item is not re-parsed per megabyte
+            self._fill(size)
+            size *= 2
+
+def iter_json_items(path):
+    """Yield (kind, key, value) for each top-level item of a JSON or NDJSON file.
+
+    kind is "json_array_item" (key is the item index), "json_object_part" (key
+    is the object key, for objects over JSON_OBJECT_SPLIT_SIZE bytes),
+    "json_object" or "json_value". Memory use depends on the largest item,
+    not on the file size.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        if str(path).lower().endswith(NDJSON_EXTENSIONS):
+            index = 0
+            for line in f:
+                if line.strip():
+                    yield "json_array_item", index, json.loads(line)
+                    index += 1
+            return
+
+        stream = _JSONStream(f)
+        first = stream.peek()
+        if first == "[":
+            stream.expect("[")
+            if stream.peek() == "]":
+                return
+            index = 0
+            while True:
+                yield "json_array_item", index, stream.value()
+                index += 1
+                if stream.peek() == "]":
+                    return
+                stream.expect(",")
+        elif first == "{" and os.path.getsize(path) > JSON_OBJECT_SPLIT_SIZE:
+            stream.expect("{")
+            if stream.peek() == "}":
+                return
+            while True:
+                key = stream.value()
+                stream.expect(":")
+                yield "json_object_part", key, stream.value()
+                if stream.peek() == "}":
+                    return
+                stream.expect(",")
+        elif first == "{":
+            yield "json_object", None, stream.value()
+        else:
+            yield "json_value", None, stream.value()
@@ -1,62 +1,236 @@
 import os
+import re
+import threading
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from dotenv import load_dotenv
 from langchain.prompts import PromptTemplate
 from langchain.chains import LLMChain
-from langchain_groq import ChatGroq
-from langchain_huggingface import HuggingFaceEmbeddings  
-from modules.load_vectorstore import similarity_search
+from modules.load_vectorstore import similarity_search, similarity_search_batch, lexical_search, vector_similarities
+from modules.database import SHARD_COUNT, get_shard_collections
+from modules.document_registry import get_corpus_version
+from modules.resources import get_embeddings, get_llm
+from modules.sharding import (
+    sharded_similarity_search, sharded_similarity_search_batch, sharded_lexical_search, sharded_vector_similarities,
+    sync_shard_indexes, sharded_corpus_version
+)
+from modules.vector_index import get_vector_index, sync_vector_index
+from modules.workers import submit_retrieval
+from modules.metrics import span
 from logger import logger
 
 load_dotenv()
 
-GROQ_API_KEY = os.environ.get("GROQ_API_KEY")
+# "hybrid" ($text + vector, fused), "vector" or "lexical"
+RETRIEVAL_MODE = os.environ.get("RETRIEVAL_MODE", "hybrid").lower()
+VECTOR_K = int(os.environ.get("VECTOR_K", "10"))
+LEXICAL_K = int(os.environ.get("LEXICAL_K", "10"))
+RRF_K = int(os.environ.get("RRF_K", "60"))
+
+# Single tokens like part numbers, file names or JSON keys ("AB-1234", "user_id", "v2.1")
+KEYWORD_QUERY = re.compile(r"^(?=\S*[\d_.\-/])\S+$")
+
+_chains = {}
+_chains_lock = threading.Lock()
+
+def reciprocal_rank_fusion(result_lists, rrf_k=RRF_K):
+    """Merge ranked document lists by summing 1 / (rrf_k + rank) per document"""
+    fused = {}
+    for results in result_lists:
+        for rank, doc in enumerate(results, start=1):
+            entry = fused.setdefault(doc["_id"], {**doc, "rrf_score": 0.0})
+            entry["rrf_score"] += 1.0 / (rrf_k + rank)
+            if "similarity" in doc:
+                entry["similarity"] = doc["similarity"]
+    return sorted(fused.values(), key=lambda doc: doc["rrf_score"], reverse=True)
 
 class HybridRetriever:
-    def __init__(self, collection, embeddings_model, k=3):
+    def __init__(self, collection, embeddings_model, k=3, vector_index=None,
+                 mode=RETRIEVAL_MODE, vector_k=VECTOR_K, lexical_k=LEXICAL_K, shards=None):
         self.collection = collection
+        # Chunk collections searched scatter-gather (see modules.sharding); with more than
+        # one, collection and vector_index are unused and each shard's own index is searched
+        self.shards = shards or [collection]
         self.embeddings_model = embeddings_model
         self.k = k
+        self.vector_index = vector_index
+        self.mode = mode
+        self.vector_k = max(vector_k, k)
+        self.lexical_k = max(lexical_k, k)
+    
+    def corpus_version(self):
+        """Corpus version of the collection, or a combined version over the shards"""
+        if len(self.shards) > 1:
+            return sharded_corpus_version(self.shards)
+        return get_corpus_version(self.collection)
+    
+    def embed_query(self, query):
+        """Embed a query once so callers can reuse it for caching and retrieval"""
+        with span("embed_query"):
+            return self.embeddings_model.embed_query(query)
     
-    def get_relevant_documents(self, query):
-        """Retrieve relevant documents from MongoDB, return None if no good matches"""
+    def embed_queries(self, queries):
+        """Embed many queries in one forward pass"""
+        with span("embed_queries"):
+            if hasattr(self.embeddings_model, "embed_queries"):
+                return self.embeddings_model.embed_queries(queries)
+            return self.embeddings_model.embed_documents(list(queries))
+    
+    def get_relevant_documents(self, query, query_embedding=None, filters=None, deadline=None):
+        """Retrieve relevant documents from MongoDB, return None if no good matches.
+
+        deadline (see modules.deadline) bounds the searches; a text search still
+        running at the deadline is left out of the fusion.
+        """
         try:
-            results = similarity_search(query, self.collection, self.embeddings_model, self.k)
-            
-            # Check if we have any results and if they have good similarity scores
-            if not results:
-                return None
-            
-            # Filter results with decent similarity (this is a simple threshold approach)
-            # In a real implementation, you might want to use a more sophisticated approach
-            good_results = []
-            for result in results:
-                similarity = result.get('similarity', 0)
-                # Only include if similarity is above a threshold (adjust as needed)
-                if similarity > 0.1:  # Adjust this threshold based on your needs
-                    good_results.append(result)
-            
-            return good_results if good_results else None
+            # Pick up chunks other workers added or removed since the last query
+            self._sync_indexes()
+            if self.mode == "vector":
+                results = self._similarity_search(query, self.k, query_embedding, filters, deadline)
+            else:
+                results = self._hybrid_search(query, query_embedding, filters, deadline)
+            return self._good_results(results)
             
         except Exception as e:
             logger.error(f"Error in document retrieval: {e}")
             return None
+    
+    def get_relevant_documents_batch(self, queries, query_embeddings, filters=None):
+        """get_relevant_documents for many queries: vector top-k for all of them is one
+        matrix product (see similarity_search_batch); text searches run concurrently."""
+        try:
+            self._sync_indexes()
+            if len(self.shards) > 1:
+                vector = sharded_similarity_search_batch(query_embeddings, self.shards, self.vector_k, filters)
+            else:
+                vector = similarity_search_batch(query_embeddings, self.collection, self.vector_k, self.vector_index, filters)
+            if self.mode == "vector":
+                return [self._good_results(results) for results in vector]
+            lexical = [
+                future.result() for future in
+                [submit_retrieval(self._lexical_search, query, self.lexical_k, filters) for query in queries]
+            ]
+        except Exception as e:
+            logger.error(f"Error in batch document retrieval: {e}")
+            return [None] * len(queries)
+        
+        results = []
+        for query, query_embedding, vector_hits, lexical_hits in zip(queries, query_embeddings, vector, lexical):
+            if self.mode == "lexical" or (KEYWORD_QUERY.match(query.strip()) and lexical_hits):
+                fused = lexical_hits
+            else:
+                fused = reciprocal_rank_fusion([vector_hits, lexical_hits])
+            try:
+                results.append(self._good_results(self._with_similarity(fused, query_embedding)))
+            except Exception as e:
+                logger.error(f"Error in batch document retrieval: {e}")
+                results.append(None)
+        return results
+    
+    def get_lexical_documents(self, query, query_embedding=None, filters=None, deadline=None):
+        """Cheaper text-index-only retrieval, used when the full search overran its deadline.
+
+        Without a query embedding the similarity threshold cannot be applied, so
+        text hits are taken as they rank.
+        """
+        try:
+            results = self._lexical_search(query, self.k, filters, deadline)
+            if query_embedding is None:
+                return results or None
+            return self._good_results(self._with_similarity(results, query_embedding))
+        except Exception as e:
+            logger.error(f"Error in lexical retrieval: {e}")
+            return None
+    
+    def _good_results(self, results):
+        """Top k results above the similarity threshold, or None"""
+        # Check if we have any results and if they have good similarity scores
+        if not results:
+            return None
+        
+        # Filter results with decent similarity (this is a simple threshold approach)
+        # In a real implementation, you might want to use a more sophisticated approach
+        good_results = []
+        for result in results:
+            similarity = result.get('similarity', 0)
+            # Only include if similarity is above a threshold (adjust as needed)
+            if similarity > 0.1:  # Adjust this threshold based on your needs
+                good_results.append(result)
+        
+        return good_results[:self.k] if good_results else None
+    
+    def _hybrid_search(self, query, query_embedding=None, filters=None, deadline=None):
+        """Run $text and vector top-k concurrently and fuse them with reciprocal rank fusion"""
+        if query_embedding is None:
+            query_embedding = self.embed_query(query)
+        
+        if self.mode == "lexical" or KEYWORD_QUERY.match(query.strip()):
+            # Exact-keyword queries are answered by the text index alone when it finds anything
+            lexical = self._lexical_search(query, self.lexical_k, filters, deadline)
+            if lexical or self.mode == "lexical":
+                return self._with_similarity(lexical, query_embedding)
+            vector = self._similarity_search(query, self.vector_k, query_embedding, filters, deadline)
+            return vector
+        
+        lexical_future = submit_retrieval(self._lexical_search, query, self.lexical_k, filters, deadline)
+        vector = self._similarity_search(query, self.vector_k, query_embedding, filters, deadline)
+        try:
+            lexical = lexical_future.result(timeout=deadline.remaining() if deadline is not None else None)
+        except FutureTimeoutError:
+            logger.warning("Text search missed the retrieval deadline, using vector results only")
+            lexical = []
+        logger.debug(f"Hybrid search: {len(vector)} vector hits, {len(lexical)} text hits")
+        return self._with_similarity(reciprocal_rank_fusion([vector, lexical]), query_embedding)
+    
+    def _with_similarity(self, results, query_embedding):
+        """Fill in vector similarity for text-only hits so the similarity threshold applies to every result"""
+        missing = [doc["_id"] for doc in results if "similarity" not in doc]
+        if len(self.shards) > 1:
+            similarities = sharded_vector_similarities(self.shards, missing, query_embedding)
+        else:
+            similarities = vector_similarities(self.collection, missing, query_embedding)
+        for doc in results:
+            if "similarity" not in doc:
+                doc["similarity"] = similarities.get(doc["_id"], 0)
+        return results
+    
+    def _sync_indexes(self):
+        if len(self.shards) > 1:
+            sync_shard_indexes(self.shards)
+        elif self.vector_index is not None:
+            # Follow the index if a rebuild swapped in a new one
+            self.vector_index = sync_vector_index(self.collection) or self.vector_index
+    
+    def _similarity_search(self, query, k, query_embedding=None, filters=None, deadline=None):
+        if len(self.shards) > 1:
+            return sharded_similarity_search(query, self.shards, self.embeddings_model, k, query_embedding, filters, deadline)
+        return similarity_search(query, self.collection, self.embeddings_model, k, self.vector_index, query_embedding, filters, deadline)
+    
+    def _lexical_search(self, query, k, filters=None, deadline=None):
+        if len(self.shards) > 1:
+            return sharded_lexical_search(query, self.shards, k, filters, deadline)
+        return lexical_search(query, self.collection, k, filters, deadline)
 
 def get_llm_chain(collection):
+    """Get the shared chain components for a collection, creating them on first use"""
+    with _chains_lock:
+        chain = _chains.get(collection.full_name)
+        if chain is None:
+            chain = _create_llm_chain(collection)
+            _chains[collection.full_name] = chain
+        return chain
+
+def _create_llm_chain(collection):
     """Create LLM chain with hybrid approach (documents + general knowledge)"""
     try:
-        # Initialize LLM
-        print("Loaded GROQ_API_KEY:", GROQ_API_KEY)
-        llm = ChatGroq(
-            groq_api_key=GROQ_API_KEY,
-            model_name="llama-3.1-8b-instant",
-            temperature=0.1
-        )
-        
-        # Initialize embeddings
-        embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L12-v2")
+        # Shared LLM client and embeddings model
+        llm = get_llm()
+        embeddings = get_embeddings()
         
-        # Create hybrid retriever
-        retriever = HybridRetriever(collection, embeddings, k=3)
+        # Create hybrid retriever, over every shard when the corpus is sharded
+        if SHARD_COUNT > 1:
+            retriever = HybridRetriever(collection, embeddings, k=3, shards=get_shard_collections())
+        else:
+            retriever = HybridRetriever(collection, embeddings, k=3, vector_index=get_vector_index(collection))
         
         # Create prompt templates for different scenarios
         document_based_template = """
@@ -74,6 +248,9 @@ def get_llm_chain(collection):
         Document Context:
         {context}
         
+        Conversation so far:
+        {history}
+        
         Question: {question}
         
         Answer: Please provide a helpful and accurate answer.
@@ -90,6 +267,9 @@ def get_llm_chain(collection):
         - Do not mention documents, PDFs, or context.
         - Always give a natural, straightforward answer.
         
+        Conversation so far:
+        {history}
+        
         Question: {question}
         
         Answer: Please provide a helpful and accurate answer using your general knowledge. 
@@ -100,12 +280,12 @@ def get_llm_chain(collection):
         
         document_prompt = PromptTemplate(
             template=document_based_template,
-            input_variables=["context", "question"]
+            input_variables=["context", "history", "question"]
         )
         
         general_prompt = PromptTemplate(
             template=general_knowledge_template,
-            input_variables=["question"]
+            input_variables=["history", "question"]
         )
         
         # Create chains
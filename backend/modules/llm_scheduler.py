@@ -0,0 +1,281 @@
+import os
+import time
+import random
+import asyncio
+from collections import deque
+from dotenv import load_dotenv
+from groq import APIConnectionError
+from modules.metrics import Counter, Gauge, Histogram, register
+from logger import logger
+
+load_dotenv()
+
+# Groq requests in flight at once per process; further calls wait in the queue
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", "8"))
+# Calls allowed to wait for a slot; beyond this they are rejected at once
+LLM_MAX_QUEUE = int(os.environ.get("LLM_MAX_QUEUE", "32"))
+# Longest a call waits for a slot before it is rejected
+LLM_QUEUE_TIMEOUT = float(os.environ.get("LLM_QUEUE_TIMEOUT", "10"))
+# Per-attempt limit on one Groq call
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", "60"))
+# Retries after a 429, 5xx, timeout or connection error, with full-jitter exponential backoff
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "3"))
+LLM_BACKOFF_BASE = float(os.environ.get("LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_MAX = float(os.environ.get("LLM_BACKOFF_MAX", "8"))
+# A second (hedged) call is issued when the first has not answered by this percentile of
+# recent call latencies; 0 disables hedging
+LLM_HEDGE_PERCENTILE = float(os.environ.get("LLM_HEDGE_PERCENTILE", "95"))
+# Completed calls needed before the percentile is trusted, and how many recent ones it covers
+LLM_HEDGE_MIN_SAMPLES = int(os.environ.get("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_LATENCY_WINDOW = int(os.environ.get("LLM_LATENCY_WINDOW", "500"))
+
+LLM_QUEUE_DEPTH = register(Gauge(
+    "ragbot_llm_queue_depth", "LLM calls waiting for a concurrency slot"
+))
+LLM_IN_FLIGHT = register(Gauge(
+    "ragbot_llm_in_flight", "LLM calls holding a concurrency slot"
+))
+LLM_QUEUE_WAIT = register(Histogram(
+    "ragbot_llm_queue_wait_seconds", "Time an LLM call waited for a concurrency slot"
+))
+LLM_CALLS = register(Counter(
+    "ragbot_llm_calls_total", "LLM calls by outcome (upstream, coalesced, rejected, failed, cancelled)", ["result"]
+))
+LLM_RETRIES = register(Counter(
+    "ragbot_llm_retries_total", "LLM attempts retried after a transient error", ["reason"]
+))
+LLM_HEDGES = register(Counter(
+    "ragbot_llm_hedges_total", "Hedged LLM calls issued, and how many answered first", ["result"]
+))
+
+class LLMOverloaded(Exception):
+    """Raised when the LLM queue is full or a call waited too long for a slot"""
+
+def _retry_reason(error):
+    """Short reason if error is worth retrying, otherwise None"""
+    if isinstance(error, asyncio.TimeoutError):
+        return "timeout"
+    if isinstance(error, (APIConnectionError, ConnectionError)):
+        return "connection"
+    status = getattr(error, "status_code", None)
+    if status == 429:
+        return "rate_limited"
+    if isinstance(status, int) and status >= 500:
+        return "server_error"
+    return None
+
+def _retry_after(error):
+    """Seconds from a Retry-After header on the error's response, if any"""
+    response = getattr(error, "response", None)
+    try:
+        return float(response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+class LLMScheduler:
+    """Coalesces identical in-flight LLM calls and bounds concurrent upstream requests.
+
+    Calls with the same key share one upstream request, which is cancelled once
+    every caller awaiting it has been. At most max_concurrency requests run at
+    once; up to max_queue more wait, and anything past that, or waiting longer
+    than queue_timeout, raises LLMOverloaded.
+    """
+    def __init__(self, max_concurrency=LLM_MAX_CONCURRENCY, max_queue=LLM_MAX_QUEUE,
+                 queue_timeout=LLM_QUEUE_TIMEOUT, timeout=LLM_TIMEOUT, max_retries=LLM_MAX_RETRIES):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._waiting = 0
+        self._running = 0
+        self._inflight = {}
+        self._latencies = deque(maxlen=LLM_LATENCY_WINDOW)
+        # The event loop the scheduler serves; worker threads hand calls to it through run_threadsafe
+        try:
+            self._loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._loop = None
+
+    async def run(self, key, call):
+        """Await call() (a coroutine factory) once per distinct in-flight key"""
+        entry = self._inflight.get(key)
+        if entry is None:
+            task = asyncio.ensure_future(self._call(call))
+            # The task and how many callers are awaiting it
+            entry = self._inflight[key] = [task, 0]
+            task.add_done_callback(lambda _: self._forget(key, entry))
+        else:
+            LLM_CALLS.inc("coalesced")
+        task = entry[0]
+        entry[1] += 1
+        try:
+            # Shielded so one waiter disconnecting does not cancel the others' answer
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if entry[1] == 1 and not task.done():
+                # Nobody else wants the answer; free the slot instead of finishing the call.
+                # Forgotten first, so a caller arriving before the task ends starts a fresh call
+                self._forget(key, entry)
+                task.cancel()
+                LLM_CALLS.inc("cancelled")
+            raise
+        finally:
+            entry[1] -= 1
+
+    def _forget(self, key, entry):
+        """Drop key from the in-flight calls if it still maps to entry"""
+        if self._inflight.get(key) is entry:
+            del self._inflight[key]
+
+    def run_threadsafe(self, key, call):
+        """run() from a worker thread: schedule it on the scheduler's event loop and block for the result"""
+        if self._loop is None or self._loop.is_closed():
+            raise RuntimeError("LLM scheduler has no running event loop to call from a worker thread")
+        return asyncio.run_coroutine_threadsafe(self.run(key, call), self._loop).result()
+
+    def hedge_delay(self):
+        """Seconds after which a call is hedged, or None while hedging is off or samples are few"""
+        if LLM_HEDGE_PERCENTILE <= 0 or len(self._latencies) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * LLM_HEDGE_PERCENTILE / 100))]
+
+    async def run_hedged(self, key, call, deadline=None):
+        """Like run, but issue one more upstream call if the first is slower than hedge_delay().
+
+        Whichever answers first wins. Raises asyncio.TimeoutError when deadline
+        (see modules.deadline) passes first. The losing call, or both on a
+        timeout, is cancelled unless other callers are coalesced on it.
+        """
+        remaining = lambda: deadline.remaining() if deadline is not None else None
+        primary = asyncio.ensure_future(self.run(key, call))
+        tasks = {primary}
+        hedge_after = self.hedge_delay()
+        try:
+            if hedge_after is not None and (deadline is None or hedge_after < deadline.remaining()):
+                done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+                if not done:
+                    LLM_HEDGES.inc("issued")
+                    logger.info(f"LLM call slower than p{LLM_HEDGE_PERCENTILE:g} ({hedge_after:.2f}s), hedging")
+                    tasks.add(asyncio.ensure_future(self.run((key, "hedge"), call)))
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, timeout=remaining(), return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise asyncio.TimeoutError("LLM call missed the request deadline")
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            LLM_HEDGES.inc("won")
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def stream(self, factory):
+        """Yield from factory() (an async iterator factory) within a concurrency slot.
+
+        Streams are not coalesced; a transient error is retried only before the
+        first item has been yielded.
+        """
+        async with _Slot(self):
+            for attempt in range(self.max_retries + 1):
+                started = False
+                try:
+                    async for item in factory():
+                        started = True
+                        yield item
+                    return
+                except Exception as e:
+                    if started or not await self._backoff(e, attempt):
+                        LLM_CALLS.inc("failed")
+                        raise
+
+    async def _call(self, call):
+        async with _Slot(self):
+            for attempt in range(self.max_retries + 1):
+                try:
+                    start = time.perf_counter()
+                    result = await asyncio.wait_for(call(), self.timeout)
+                    self._latencies.append(time.perf_counter() - start)
+                    LLM_CALLS.inc("upstream")
+                    return result
+                except Exception as e:
+                    if not await self._backoff(e, attempt):
+                        LLM_CALLS.inc("failed")
+                        raise
+
+    async def _backoff(self, error, attempt):
+        """Sleep before the next attempt; False if error is not transient or retries are used up"""
+        reason = _retry_reason(error)
+        if reason is None or attempt >= self.max_retries:
+            return False
+        delay = random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt))
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, LLM_BACKOFF_MAX))
+        LLM_RETRIES.inc(reason)
+        logger.warning(f"LLM call failed ({reason}), retry {attempt + 1}/{self.max_retries} in {delay:.2f}s")
+        await asyncio.sleep(delay)
+        return True
+
+    def _update_gauges(self):
+        LLM_QUEUE_DEPTH.set(value=self._waiting)
+        LLM_IN_FLIGHT.set(value=self._running)
+
+class _Slot:
+    """Async context manager holding one of the scheduler's concurrency slots"""
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
+    async def __aenter__(self):
+        scheduler = self.scheduler
+        if scheduler._semaphore.locked():
+            await self._wait()
+        else:
+            # A free slot is taken without yielding to the event loop
+            await scheduler._semaphore.acquire()
+            LLM_QUEUE_WAIT.observe(value=0.0)
+        scheduler._running += 1
+        scheduler._update_gauges()
+
+    async def _wait(self):
+        scheduler = self.scheduler
+        if scheduler._waiting >= scheduler.max_queue:
+            LLM_CALLS.inc("rejected")
+            raise LLMOverloaded(f"LLM queue is full ({scheduler._waiting} waiting)")
+        scheduler._waiting += 1
+        scheduler._update_gauges()
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(scheduler._semaphore.acquire(), scheduler.queue_timeout)
+        except asyncio.TimeoutError:
+            LLM_CALLS.inc("rejected")
+            raise LLMOverloaded(f"No LLM slot free after {scheduler.queue_timeout:.0f}s")
+        finally:
+            scheduler._waiting -= 1
+            scheduler._update_gauges()
+            LLM_QUEUE_WAIT.observe(value=time.perf_counter() - start)
+
+    async def __aexit__(self, *exc_info):
+        scheduler = self.scheduler
+        scheduler._running -= 1
+        scheduler._semaphore.release()
+        scheduler._update_gauges()
+
+_scheduler = None
+
+def get_llm_scheduler():
+    """Process-wide scheduler; created on first use inside the event loop"""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = LLMScheduler()
+    return _scheduler
+
+def chain_key(chain, inputs):
+    """Identical inputs to the same chain render the same prompt"""
+    return (id(chain), tuple(sorted(inputs.items())))
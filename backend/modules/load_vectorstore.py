@@ -1,13 +1,25 @@
 import os
 import time
 import json
+import hashlib
+from collections import deque
 from pathlib import Path
+import numpy as np
 from dotenv import load_dotenv
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_community.document_loaders import PyMuPDFLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.schema import Document
-from modules.database import get_collection
+from modules.database import get_shard_collection
+from modules.metrics import span, traced, observe_stage
+from modules.embedding_storage import (
+    EMBEDDING_STORAGE_FORMAT, QUANTIZED_FORMATS, RESCORE_FACTOR, EMBEDDING_PROJECTION,
+    encode_embedding, decode_embedding, store_full_vectors, delete_full_vectors, rescore, uses_packed_embeddings
+)
+from modules.document_registry import record_change, register_file, unregister_file
+from modules.json_handlers import iter_json_items
+from modules.pdf_handlers import pdf_page_ranges, timed_parse_pdf_pages
+from modules.resources import get_embeddings
+from modules.vector_index import index_documents, unindex_documents, merge_top_k
+from modules.workers import get_parse_pool, PARSE_WORKERS
 from logger import logger
 
 UPLOAD_DIR = "./uploaded_documents"
@@ -15,160 +27,509 @@ os.makedirs(UPLOAD_DIR, exist_ok=True)
 
 load_dotenv()
 
-def load_vectorstore(uploaded_files):
-    """Load PDF documents into MongoDB vectorstore"""
-    file_paths = []
+EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", "64"))
+INSERT_BATCH_SIZE = int(os.environ.get("INSERT_BATCH_SIZE", "512"))
+PARSE_PAGES_PER_TASK = int(os.environ.get("PARSE_PAGES_PER_TASK", "16"))
+CHUNK_SIZE = 3000
+CHUNK_OVERLAP = 200
+UPLOAD_COPY_BUFFER_SIZE = 1 << 20
+# Largest single uploaded file accepted; 0 disables the limit
+UPLOAD_MAX_FILE_BYTES = int(os.environ.get("UPLOAD_MAX_FILE_BYTES", str(512 * 1024 * 1024)))
+
+class UploadTooLarge(ValueError):
+    """An uploaded file exceeded UPLOAD_MAX_FILE_BYTES"""
+
+def save_uploaded_file(file, max_bytes=UPLOAD_MAX_FILE_BYTES):
+    """Stream one upload to UPLOAD_DIR in fixed-size blocks, hashing it in the same pass.
+
+    The file is written under a temporary name and renamed into place only once
+    complete, so a rejected or interrupted upload never leaves a partial file.
+    Returns (path, sha256 hex digest).
+    """
+    save_path = Path(UPLOAD_DIR) / Path(file.filename).name
+    part_path = save_path.with_name(save_path.name + ".part")
+    digest = hashlib.sha256()
+    size = 0
+    buffer = bytearray(UPLOAD_COPY_BUFFER_SIZE)
+    view = memoryview(buffer)
+    # SpooledTemporaryFile (UploadFile.file) only has readinto from Python 3.11
+    readinto = getattr(file.file, "readinto", None)
+    try:
+        with open(part_path, "wb") as f:
+            while True:
+                if readinto is not None:
+                    block = view[:readinto(buffer)]
+                else:
+                    block = file.file.read(UPLOAD_COPY_BUFFER_SIZE)
+                if not block:
+                    break
+                size += len(block)
+                if max_bytes and size > max_bytes:
+                    raise UploadTooLarge(f"{file.filename} exceeds the {max_bytes} byte upload limit")
+                digest.update(block)
+                f.write(block)
+        os.replace(part_path, save_path)
+    except BaseException:
+        part_path.unlink(missing_ok=True)
+        raise
+    logger.info(f"Saved file: {save_path} ({size} bytes)")
+    return str(save_path), digest.hexdigest()
 
-    # Save uploaded files
+def save_uploaded_files(uploaded_files):
+    """Persist uploaded files to UPLOAD_DIR; returns their paths and a {path: sha256} map"""
+    file_paths = []
+    file_hashes = {}
     for file in uploaded_files:
-        save_path = Path(UPLOAD_DIR) / file.filename
-        with open(save_path, "wb") as f:
-            f.write(file.file.read())
-        file_paths.append(str(save_path))
-        logger.info(f"Saved PDF file: {save_path}")
-
-    # Load documents
-    docs = []
+        path, file_hash = save_uploaded_file(file)
+        file_paths.append(path)
+        file_hashes[path] = file_hash
+    return file_paths, file_hashes
+
+def load_vectorstore(uploaded_files, progress_callback=None):
+    """Load PDF documents into MongoDB vectorstore"""
+    file_paths, file_hashes = save_uploaded_files(uploaded_files)
+    return ingest_pdf_files(file_paths, progress_callback, file_hashes=file_hashes)
+
+def load_json_data(uploaded_files, progress_callback=None):
+    """Load JSON documents into MongoDB vectorstore"""
+    file_paths, file_hashes = save_uploaded_files(uploaded_files)
+    return ingest_json_files(file_paths, progress_callback, file_hashes=file_hashes)
+
+def ingest_pdf_files(file_paths, progress_callback=None, job_id=None, file_hashes=None):
+    """Parse, split, embed and store PDF files that are already on disk"""
+    return _ingest_files(file_paths, "pdf", _iter_pdf_chunks, progress_callback, job_id, file_hashes)
+
+def ingest_json_files(file_paths, progress_callback=None, job_id=None, file_hashes=None):
+    """Parse, split, embed and store JSON files that are already on disk"""
+    return _ingest_files(file_paths, "json", _iter_json_chunks, progress_callback, job_id, file_hashes)
+
+def _iter_pdf_chunks(file_paths):
+    """Yield (path, chunk) for every PDF in file and page order, parsing ahead in the process pool.
+
+    Each task parses one range of PARSE_PAGES_PER_TASK pages. At most
+    PARSE_WORKERS * 2 ranges are in flight, so memory stays bounded while the
+    embedding stage consumes chunks.
+    """
+    pool = get_parse_pool()
+    tasks = (
+        (path, start, end)
+        for path in file_paths
+        for start, end in pdf_page_ranges(path, PARSE_PAGES_PER_TASK)
+    )
+    pending = deque()
+
+    def drain_one():
+        path, start, end, result = pending.popleft()
+        seconds, chunks = result.result() if pool is not None else result
+        observe_stage("pdf_parse", seconds)
+        logger.debug(f"Parsed pages {start}-{end - 1} of {path} into {len(chunks)} chunks")
+        for text, metadata in chunks:
+            yield path, Document(page_content=text, metadata=dict(metadata))
+
+    for path, start, end in tasks:
+        if pool is None:
+            result = timed_parse_pdf_pages(path, start, end, CHUNK_SIZE, CHUNK_OVERLAP)
+        else:
+            result = pool.submit(timed_parse_pdf_pages, path, start, end, CHUNK_SIZE, CHUNK_OVERLAP)
+        pending.append((path, start, end, result))
+        if len(pending) >= max(PARSE_WORKERS * 2, 1):
+            yield from drain_one()
+    while pending:
+        yield from drain_one()
+
+def _iter_json_chunks(file_paths):
+    """Yield (path, chunk) for every JSON file in order"""
+    # Split large documents if needed
+    splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
     for path in file_paths:
-        loader = PyMuPDFLoader(path)
-        loaded_docs = loader.load()
-        docs.extend(loaded_docs)
-        logger.info(f"Loaded {len(loaded_docs)} pages from {path}")
+        for doc in _iter_json_documents(path):
+            for chunk in splitter.split_documents([doc]):
+                yield path, chunk
 
-    # Split documents
-    splitter = RecursiveCharacterTextSplitter(chunk_size=3000, chunk_overlap=200)
-    texts = splitter.split_documents(docs)
-    logger.info(f"Split into {len(texts)} chunks")
+def file_sha256(path):
+    """Content hash of a file on disk, read in blocks"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
 
-    # Create embeddings and store
-    return _store_documents_in_mongodb(texts, "pdf")
+def content_sha256(text):
+    """Content hash of a chunk's text"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
 
-def load_json_data(uploaded_files):
-    """Load JSON documents into MongoDB vectorstore"""
-    file_paths = []
+def _is_unchanged_file(collection, path, file_hash):
+    """True when every chunk stored for this source came from a byte-identical file"""
+    return (
+        collection.find_one({"source": path, "file_hash": file_hash}, {"_id": 1}) is not None
+        and collection.find_one({"source": path, "file_hash": {"$ne": file_hash}}, {"_id": 1}) is None
+    )
 
-    # Save uploaded files
-    for file in uploaded_files:
-        save_path = Path(UPLOAD_DIR) / file.filename
-        with open(save_path, "wb") as f:
-            f.write(file.file.read())
-        file_paths.append(str(save_path))
-        logger.info(f"Saved JSON file: {save_path}")
-
-    # Load and process JSON documents
-    docs = []
+def delete_chunks(collection, ids):
+    """Delete chunks by _id from the collection, the vector index and the rescoring vectors"""
+    if not ids:
+        return 0
+    result = collection.delete_many({"_id": {"$in": ids}})
+    unindex_documents(collection, ids)
+    delete_full_vectors(collection, ids)
+    record_change(collection, "remove", ids)
+    return result.deleted_count
+
+def forget_file_hashes(file_paths, doc_type):
+    """Clear the stored file hash of each file and re-register whatever chunks it has left.
+
+    Used after an ingest attempt that may have stamped and registered a file
+    before failing: the next upload or retry of the file is then re-read instead
+    of being skipped as unchanged, and the registry matches the chunks.
+    """
     for path in file_paths:
-        try:
-            with open(path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            # Process JSON data based on structure
-            if isinstance(data, list):
-                for i, item in enumerate(data):
-                    content = json.dumps(item, indent=2) if isinstance(item, dict) else str(item)
-                    doc = Document(
-                        page_content=content,
-                        metadata={
-                            "source": str(path),
-                            "item_index": i,
-                            "type": "json_array_item"
-                        }
-                    )
-                    docs.append(doc)
-            elif isinstance(data, dict):
-                # If it's a dict, create documents for each key-value pair or the whole object
-                if len(str(data)) > 5000:  # Split large objects
-                    for key, value in data.items():
-                        content = f"Key: {key}\nValue: {json.dumps(value, indent=2) if isinstance(value, (dict, list)) else str(value)}"
-                        doc = Document(
-                            page_content=content,
-                            metadata={
-                                "source": str(path),
-                                "key": key,
-                                "type": "json_object_part"
-                            }
-                        )
-                        docs.append(doc)
-                else:
-                    # Small object, keep as one document
-                    content = json.dumps(data, indent=2)
-                    doc = Document(
-                        page_content=content,
-                        metadata={
-                            "source": str(path),
-                            "type": "json_object"
-                        }
-                    )
-                    docs.append(doc)
+        collection = get_shard_collection(path)
+        collection.update_many({"source": path}, {"$unset": {"file_hash": ""}})
+        if collection.find_one({"source": path}, {"_id": 1}) is None:
+            unregister_file(collection, path)
+        else:
+            register_file(collection, path, doc_type, None)
+
+def _ingest_files(file_paths, doc_type, iter_chunks, progress_callback=None, job_id=None, known_hashes=None):
+    """Incrementally ingest files, embedding only chunks whose content hash is new.
+
+    Byte-identical files are skipped outright. For a changed file, chunks already
+    stored for the same source are kept, new ones are embedded and stored, and
+    ones that vanished from the new version are removed once everything is stored.
+    A file that fails to parse raises before any chunk is retired or the file is
+    registered, so the previous version stays searchable.
+    iter_chunks(paths) must yield (path, chunk) pairs grouped by file.
+    known_hashes maps paths to file hashes computed while saving the upload.
+    Returns an ingest report with skipped, added and removed counts.
+    Every chunk of a file goes to the shard owning its source (see get_shard_collection).
+    """
+    report = {"files_skipped": 0, "chunks_skipped": 0, "chunks_added": 0, "chunks_removed": 0}
+
+    file_hashes = {}
+    for path in file_paths:
+        file_hash = (known_hashes or {}).get(path) or file_sha256(path)
+        if _is_unchanged_file(get_shard_collection(path), path, file_hash):
+            report["files_skipped"] += 1
+            logger.info(f"Skipping unchanged file {path}")
+        else:
+            file_hashes[path] = file_hash
+
+    # Content hashes already stored and seen in the new version, per source
+    existing = {}
+    seen = {path: set() for path in file_hashes}
+
+    def existing_chunks(path):
+        if path not in existing:
+            existing[path] = {}
+            for doc in get_shard_collection(path).find({"source": path}, {"content_hash": 1}):
+                existing[path].setdefault(doc.get("content_hash"), []).append(doc["_id"])
+        return existing[path]
+
+    def iter_new_chunks():
+        for path, chunk in iter_chunks(list(file_hashes)):
+            content_hash = content_sha256(chunk.page_content)
+            if content_hash in seen[path] or content_hash in existing_chunks(path):
+                seen[path].add(content_hash)
+                report["chunks_skipped"] += 1
+                continue
+            seen[path].add(content_hash)
+            chunk.metadata["content_hash"] = content_hash
+            chunk.metadata["file_hash"] = file_hashes[path]
+            yield chunk
+
+    report["chunks_added"] = _store_documents_in_mongodb(iter_new_chunks(), doc_type, progress_callback, job_id)
+
+    # Only retire old chunks and mark files current once every new chunk is stored,
+    # so an interrupted run leaves the previous version intact
+    for path, file_hash in file_hashes.items():
+        collection = get_shard_collection(path)
+        # Chunks missing from the new version, plus extra copies left by earlier duplicate uploads
+        stale_ids = []
+        for content_hash, ids in existing_chunks(path).items():
+            stale_ids.extend(ids if content_hash not in seen[path] else ids[1:])
+        if stale_ids:
+            report["chunks_removed"] += delete_chunks(collection, stale_ids)
+        collection.update_many({"source": path}, {"$set": {"file_hash": file_hash}})
+        register_file(collection, path, doc_type, file_hash)
+
+    logger.info(f"Ingest report for {doc_type} files: {report}")
+    return report
+
+def _iter_json_documents(path):
+    """Yield one Document per JSON array item, object part or value in a file, streaming the file.
+
+    Raises if the file cannot be parsed to the end.
+    """
+    count = 0
+    try:
+        for kind, key, value in iter_json_items(path):
+            metadata = {"source": str(path), "type": kind}
+            if kind == "json_array_item":
+                content = json.dumps(value, indent=2) if isinstance(value, dict) else str(value)
+                metadata["item_index"] = key
+            elif kind == "json_object_part":
+                content = f"Key: {key}\nValue: {json.dumps(value, indent=2) if isinstance(value, (dict, list)) else str(value)}"
+                metadata["key"] = key
+            elif kind == "json_object":
+                content = json.dumps(value, indent=2)
             else:
-                # Simple value
-                doc = Document(
-                    page_content=str(data),
-                    metadata={
-                        "source": str(path),
-                        "type": "json_value"
-                    }
-                )
-                docs.append(doc)
-                
-            logger.info(f"Processed JSON file {path} into {len(docs)} documents")
-            
-        except json.JSONDecodeError as e:
-            logger.error(f"Error parsing JSON file {path}: {e}")
-            continue
-        except Exception as e:
-            logger.error(f"Error processing JSON file {path}: {e}")
-            continue
+                content = str(value)
+            count += 1
+            yield Document(page_content=content, metadata=metadata)
 
-    # Split large documents if needed
-    splitter = RecursiveCharacterTextSplitter(chunk_size=3000, chunk_overlap=200)
-    texts = splitter.split_documents(docs)
-    logger.info(f"Split JSON data into {len(texts)} chunks")
-
-    # Create embeddings and store
-    return _store_documents_in_mongodb(texts, "json")
-
-def _store_documents_in_mongodb(texts, doc_type):
-    """Store documents in MongoDB with embeddings"""
-    # Create embeddings
-    embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L12-v2")
-
-    # Get MongoDB collection
-    collection = get_collection()
-
-    # Process and store documents
-    documents_to_insert = []
-    for i, doc in enumerate(texts):
-        embedding = embeddings.embed_query(doc.page_content)
-
-        doc_dict = {
-            "content": doc.page_content,
-            "source": doc.metadata.get("source", ""),
-            "page": doc.metadata.get("page", 0),
-            "document_type": doc_type,
-            "embeddings": embedding,
-            "created_at": time.time(),
-            "metadata": doc.metadata
-        }
-        documents_to_insert.append(doc_dict)
-
-    # Insert into MongoDB
-    if documents_to_insert:
-        result = collection.insert_many(documents_to_insert)
-        logger.info(f"Inserted {len(result.inserted_ids)} {doc_type} documents into MongoDB")
-
-    return len(documents_to_insert)
-
-def similarity_search(query, collection, embeddings_model, k=3):
-    """Perform similarity search in MongoDB"""
+        logger.info(f"Processed JSON file {path} into {count} documents")
+
+    except json.JSONDecodeError as e:
+        # A truncated file must fail the ingest, or its missing tail would be retired as vanished chunks
+        logger.error(f"Error parsing JSON file {path} after {count} documents: {e}")
+        raise
+    except Exception as e:
+        logger.error(f"Error processing JSON file {path}: {e}")
+        raise
+
+def _batched(iterable, size):
+    """Group an iterable into lists of at most size items"""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _store_documents_in_mongodb(texts, doc_type, progress_callback=None, job_id=None):
+    """Embed and store documents in MongoDB in bounded batches.
+
+    texts may be any iterable (including a generator), so memory stays bounded
+    by INSERT_BATCH_SIZE regardless of upload size. progress_callback, if given,
+    is called as progress_callback(chunks_stored, elapsed_seconds) after each batch.
+    job_id tags every stored chunk so an interrupted ingestion job can be undone.
+    Each chunk is stored in the shard owning its source.
+    """
+    # Shared embeddings model
+    embeddings = get_embeddings()
+
+    start = time.time()
+    stored = 0
+    for batch in _batched(texts, INSERT_BATCH_SIZE):
+        # (collection, documents, full vectors) per shard the batch touches
+        shard_batches = {}
+        for embed_batch in _batched(batch, EMBED_BATCH_SIZE):
+            with span("embed_documents"):
+                vectors = embeddings.embed_documents([doc.page_content for doc in embed_batch])
+            for doc, embedding in zip(embed_batch, vectors):
+                content_hash = doc.metadata.pop("content_hash", None)
+                file_hash = doc.metadata.pop("file_hash", None)
+                doc_dict = {
+                    "content": doc.page_content,
+                    "source": doc.metadata.get("source", ""),
+                    "page": doc.metadata.get("page", 0),
+                    "document_type": doc_type,
+                    **encode_embedding(embedding),
+                    "created_at": time.time(),
+                    "metadata": doc.metadata
+                }
+                if content_hash:
+                    doc_dict["content_hash"] = content_hash
+                    doc_dict["file_hash"] = file_hash
+                if job_id:
+                    doc_dict["job_id"] = job_id
+                collection = get_shard_collection(doc_dict["source"])
+                _, documents_to_insert, full_vectors = shard_batches.setdefault(collection.full_name, (collection, [], []))
+                documents_to_insert.append(doc_dict)
+                full_vectors.append(embedding)
+
+        for collection, documents_to_insert, full_vectors in shard_batches.values():
+            with span("insert_many"):
+                result = collection.insert_many(documents_to_insert)
+            if EMBEDDING_STORAGE_FORMAT in QUANTIZED_FORMATS:
+                store_full_vectors(collection, result.inserted_ids, full_vectors)
+            # The index holds what build_index would decode from Mongo, so rebuilds rank the same
+            index_documents(collection, result.inserted_ids, [decode_embedding(d) for d in documents_to_insert])
+            record_change(collection, "add", result.inserted_ids)
+            stored += len(result.inserted_ids)
+
+        elapsed = time.time() - start
+        logger.info(f"Stored {stored} {doc_type} chunks ({stored / elapsed if elapsed else 0:.1f} chunks/s)")
+        if progress_callback:
+            progress_callback(stored, elapsed)
+
+    elapsed = time.time() - start
+    logger.info(f"Inserted {stored} {doc_type} documents into MongoDB in {elapsed:.1f}s")
+    return stored
+
+RESULT_PROJECTION = {"content": 1, "source": 1, "page": 1, "document_type": 1, "metadata": 1}
+
+def _fetch_hits(collection, hits):
+    """Fetch the documents for (id, similarity) hits, preserving their order"""
+    if not hits:
+        return []
+    scores = dict(hits)
+    docs = {doc["_id"]: doc for doc in collection.find({"_id": {"$in": list(scores)}}, RESULT_PROJECTION)}
+    results = []
+    for doc_id, similarity in hits:
+        doc = docs.get(doc_id)
+        if doc is not None:
+            doc["similarity"] = similarity
+            results.append(doc)
+    return results
+
+def _fetch_hits_batch(collection, hits_lists):
+    """_fetch_hits for several hit lists with a single query for all their documents"""
+    ids = {doc_id for hits in hits_lists for doc_id, _ in hits}
+    if not ids:
+        return [[] for _ in hits_lists]
+    docs = {doc["_id"]: doc for doc in collection.find({"_id": {"$in": list(ids)}}, RESULT_PROJECTION)}
+    # Copies, since the same document can be a hit for several queries with different similarities
+    return [
+        [{**docs[doc_id], "similarity": similarity} for doc_id, similarity in hits if doc_id in docs]
+        for hits in hits_lists
+    ]
+
+def build_filter(sources=None, document_type=None, created_after=None, created_before=None):
+    """Build a MongoDB query restricting retrieval by source, document type and created_at.
+
+    Sources may be given as uploaded filenames or as stored source paths.
+    Returns None when no filter is set.
+    """
+    query = {}
+    if sources:
+        query["source"] = {"$in": sorted({_source_key(source) for source in sources})}
+    if document_type:
+        query["document_type"] = document_type
+    if created_after is not None or created_before is not None:
+        query["created_at"] = {}
+        if created_after is not None:
+            query["created_at"]["$gte"] = created_after
+        if created_before is not None:
+            query["created_at"]["$lt"] = created_before
+    return query or None
+
+def _source_key(source):
+    """Map an uploaded filename to the source path stored on its chunks"""
+    stored = str(Path(source))
+    if stored.startswith(str(Path(UPLOAD_DIR)) + os.sep):
+        return stored
+    return str(Path(UPLOAD_DIR) / Path(source).name)
+
+def _index_search(query_embedding, collection, vector_index, k, filters=None):
+    """Take top-k ids from the in-memory index and fetch only those documents.
+
+    With filters, the matching ids come from an indexed Mongo query and only
+    those vectors are scored.
+    """
+    quantized = EMBEDDING_STORAGE_FORMAT in QUANTIZED_FORMATS
+    keep = k * RESCORE_FACTOR if quantized else k
+    if filters:
+        ids = [doc["_id"] for doc in collection.find(filters, {"_id": 1})]
+        hits = vector_index.search_subset(query_embedding, keep, ids)
+    else:
+        hits = vector_index.search(query_embedding, keep)
+    if quantized:
+        hits = rescore(collection, query_embedding, hits, k)
+    return _fetch_hits(collection, hits)
+
+def _scan_search(query_embedding, collection, k, filters=None, batch_size=5000, deadline=None):
+    """Exact client-side scan that decodes every storage format, for when the
+    $reduce pipeline cannot read packed embeddings.
+
+    Past deadline the scan stops and ranks the documents read so far.
+    """
+    return _scan_search_batch([query_embedding], collection, k, filters, batch_size, deadline)[0]
+
+def _scan_search_batch(query_embeddings, collection, k, filters=None, batch_size=5000, deadline=None):
+    """_scan_search for many queries in one pass over the collection, one matrix product per batch"""
+    queries = np.asarray(query_embeddings, dtype=np.float32)
+    quantized = EMBEDDING_STORAGE_FORMAT in QUANTIZED_FORMATS
+    keep = k * RESCORE_FACTOR if quantized else k
+    best_scores = best_ids = None
+    ids, vectors = [], []
+
+    def score_batch():
+        nonlocal best_scores, best_ids
+        batch_ids = np.empty(len(ids), dtype=object)
+        batch_ids[:] = ids
+        best_scores, best_ids = merge_top_k(best_scores, best_ids, queries @ np.stack(vectors).T, batch_ids, keep)
+        ids.clear()
+        vectors.clear()
+
+    for doc in collection.find({**(filters or {}), "embeddings": {"$exists": True}}, EMBEDDING_PROJECTION).batch_size(batch_size):
+        ids.append(doc["_id"])
+        vectors.append(decode_embedding(doc))
+        if len(ids) >= batch_size:
+            score_batch()
+            if deadline is not None and deadline.expired():
+                logger.warning("Scan search stopped at its deadline, results are partial")
+                break
+    if ids:
+        score_batch()
+    if best_scores is None:
+        return [[] for _ in queries]
+
+    hits = [
+        [(doc_id, float(score)) for doc_id, score in zip(row_ids, row_scores)]
+        for row_ids, row_scores in zip(best_ids, best_scores)
+    ]
+    if quantized:
+        hits = [rescore(collection, query, query_hits, k) for query, query_hits in zip(queries, hits)]
+    return _fetch_hits_batch(collection, hits)
+
+def similarity_search_batch(query_embeddings, collection, k=3, vector_index=None, filters=None):
+    """Top-k documents for many query embeddings, scored together as one matrix product.
+
+    Uses the in-memory index when there is one, otherwise a single client-side
+    scan of the collection. Returns one result list per query.
+    """
+    if not len(query_embeddings):
+        return []
+    with span("similarity_search_batch"):
+        if vector_index is None:
+            return _scan_search_batch(query_embeddings, collection, k, filters)
+
+        quantized = EMBEDDING_STORAGE_FORMAT in QUANTIZED_FORMATS
+        keep = k * RESCORE_FACTOR if quantized else k
+        if filters:
+            ids = [doc["_id"] for doc in collection.find(filters, {"_id": 1})]
+            hits = vector_index.search_subset_batch(query_embeddings, keep, ids)
+        else:
+            hits = vector_index.search_batch(query_embeddings, keep)
+        if quantized:
+            hits = [rescore(collection, query, query_hits, k) for query, query_hits in zip(query_embeddings, hits)]
+        return _fetch_hits_batch(collection, hits)
+
+@traced("similarity_search")
+def similarity_search(query, collection, embeddings_model, k=3, vector_index=None, query_embedding=None, filters=None,
+                      deadline=None):
+    """Perform similarity search in MongoDB (query_embedding skips re-embedding the query).
+
+    filters (see build_filter) is applied before any vector is scored. With a
+    deadline (see modules.deadline), Mongo work is capped with maxTimeMS and the
+    client-side scan stops early.
+    """
     try:
-        logger.debug("Generating query embedding...")
-        query_embedding = embeddings_model.embed_query(query)
-        logger.debug("Query embedding created")
+        if query_embedding is None:
+            logger.debug("Generating query embedding...")
+            query_embedding = embeddings_model.embed_query(query)
+            logger.debug("Query embedding created")
+
+        if vector_index is not None:
+            logger.debug("Running similarity search against in-memory vector index...")
+            results = _index_search(query_embedding, collection, vector_index, k, filters)
+            logger.debug(f"Vector index search returned {len(results)} docs")
+            return results
+
+        # The $reduce pipeline only understands BSON arrays
+        if uses_packed_embeddings(collection):
+            logger.debug("Running client-side scan over packed embeddings...")
+            results = _scan_search(query_embedding, collection, k, filters, deadline=deadline)
+            logger.debug(f"Scan search returned {len(results)} docs")
+            return results
 
         # MongoDB aggregation pipeline for vector similarity search
         logger.debug("Running similarity search in MongoDB...")
-        pipeline = [
+        pipeline = [{"$match": filters}] if filters else []
+        pipeline += [
             {
                 "$addFields": {
                     "similarity": {
@@ -199,19 +560,42 @@ def similarity_search(query, collection, embeddings_model, k=3):
             },
             {"$sort": {"similarity": -1}},
             {"$limit": k},
-            {"$project": {"content": 1, "source": 1, "page": 1, "document_type": 1, "similarity": 1, "metadata": 1}}
+            {"$project": {**RESULT_PROJECTION, "similarity": 1}}
         ]
 
-        results = list(collection.aggregate(pipeline))
+        options = {"maxTimeMS": deadline.max_time_ms()} if deadline is not None else {}
+        results = list(collection.aggregate(pipeline, **options))
         logger.debug(f"Similarity search returned {len(results)} docs")
         return results
 
     except Exception as e:
         logger.error(f"Error in similarity search: {e}")
         # fallback: text search
-        results = list(collection.find(
-            {"$text": {"$search": query}},
-            {"score": {"$meta": "textScore"}}
-        ).sort([("score", {"$meta": "textScore"})]).limit(k))
+        results = lexical_search(query, collection, k, filters, deadline)
         logger.debug(f"Fallback text search returned {len(results)} docs")
-        return results
\ No newline at end of file
+        return results
+
+@traced("lexical_search")
+def lexical_search(query, collection, k=3, filters=None, deadline=None):
+    """Full-text ($text index) search, best textScore first"""
+    try:
+        cursor = collection.find(
+            {**(filters or {}), "$text": {"$search": query}},
+            {**RESULT_PROJECTION, "score": {"$meta": "textScore"}}
+        ).sort([("score", {"$meta": "textScore"})]).limit(k)
+        if deadline is not None:
+            cursor = cursor.max_time_ms(deadline.max_time_ms())
+        return list(cursor)
+    except Exception as e:
+        logger.error(f"Error in text search: {e}")
+        return []
+
+def vector_similarities(collection, ids, query_embedding):
+    """Dot product between the query and the stored embeddings of specific documents"""
+    if not ids:
+        return {}
+    query = np.asarray(query_embedding, dtype=np.float32)
+    return {
+        doc["_id"]: float(decode_embedding(doc) @ query)
+        for doc in collection.find({"_id": {"$in": list(ids)}}, EMBEDDING_PROJECTION)
+    }
\ No newline at end of file
@@ -0,0 +1,148 @@
+import os
+import time
+import bisect
+import functools
+import threading
+from contextlib import contextmanager
+from dotenv import load_dotenv
+from logger import logger
+
+load_dotenv()
+
+# Set METRICS_ENABLED=false to turn every span into a no-op
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() not in ("0", "false", "no")
+# Spans slower than this are logged with their request id
+SLOW_SPAN_SECONDS = float(os.environ.get("SLOW_SPAN_SECONDS", "5"))
+
+# Seconds; covers sub-millisecond index lookups up to slow LLM calls
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _label_text(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{value}"' for name, value in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    """Monotonic counter with optional labels, rendered in Prometheus text format"""
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1.0):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def render(self):
+        with self._lock:
+            values = dict(self._values)
+        return [f"{self.name}{_label_text(self.labelnames, labels)} {value}" for labels, value in sorted(values.items())]
+
+class Gauge(Counter):
+    """Value that can go up and down"""
+    kind = "gauge"
+
+    def set(self, *labels, value):
+        with self._lock:
+            self._values[labels] = float(value)
+
+class Histogram:
+    """Cumulative-bucket histogram; observe() is a bisect and three additions under a lock"""
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, *labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        with self._lock:
+            series = {labels: (list(counts), total, count) for labels, (counts, total, count) in self._series.items()}
+        lines = []
+        for labels, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_label_text(self.labelnames, labels, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_label_text(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_label_text(self.labelnames, labels)} {count}")
+        return lines
+
+_registry = []
+
+def register(metric):
+    _registry.append(metric)
+    return metric
+
+def render_metrics():
+    """Every registered metric in Prometheus text exposition format"""
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+STAGE_DURATION = register(Histogram(
+    "ragbot_stage_duration_seconds", "Time spent in one pipeline stage", ["stage"]
+))
+STAGE_ERRORS = register(Counter(
+    "ragbot_stage_errors_total", "Pipeline stages that raised", ["stage"]
+))
+HTTP_DURATION = register(Histogram(
+    "ragbot_http_request_duration_seconds", "Time to produce the response headers", ["method", "route", "status"]
+))
+
+def observe_stage(stage, seconds):
+    """Record a duration measured elsewhere, e.g. inside a worker process"""
+    if METRICS_ENABLED:
+        STAGE_DURATION.observe(stage, value=seconds)
+
+@contextmanager
+def span(stage):
+    """Time a block as one pipeline stage and count it as an error if it raises"""
+    if not METRICS_ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_DURATION.observe(stage, value=elapsed)
+        if elapsed >= SLOW_SPAN_SECONDS:
+            logger.warning(f"Slow stage {stage}: {elapsed:.2f}s")
+
+def traced(stage):
+    """Decorator form of span"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
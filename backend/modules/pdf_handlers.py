@@ -1,16 +1,40 @@
-import os
-import shutil
-from fastapi import UploadFile
-import tempfile
+import time
+import pymupdf
+from langchain.text_splitter import RecursiveCharacterTextSplitter
 
-UPLOAD_DIR = "./uploaded_pdfs"
+def pdf_page_ranges(path: str, pages_per_task: int) -> list[tuple[int, int]]:
+    """Split a PDF's pages into [start, end) ranges of at most pages_per_task pages"""
+    with pymupdf.open(path) as doc:
+        total = doc.page_count
+    return [(start, min(start + pages_per_task, total)) for start in range(0, total, pages_per_task)]
 
-def save_uploaded_files(files: list[UploadFile]) -> list[str]:
-    os.makedirs(UPLOAD_DIR, exist_ok=True)
-    file_paths = []
-    for file in files:
-        temp_path = os.path.join(UPLOAD_DIR, file.filename)
-        with open(temp_path, "wb") as f:
-            shutil.copyfileobj(file.file, f)
-        file_paths.append(temp_path)
-    return file_paths
\ No newline at end of file
+def parse_pdf_pages(path: str, start: int, end: int, chunk_size: int, chunk_overlap: int) -> list[tuple[str, dict]]:
+    """Extract and split pages [start, end) of a PDF.
+
+    Runs in a worker process, so it only returns plain (text, metadata) pairs.
+    Metadata matches what PyMuPDFLoader produces, page numbers included.
+    """
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    chunks = []
+    with pymupdf.open(path) as doc:
+        doc_metadata = {
+            key: value for key, value in (doc.metadata or {}).items()
+            if isinstance(value, (str, int))
+        }
+        for page in doc.pages(start, end):
+            metadata = {
+                "source": path,
+                "file_path": path,
+                "page": page.number,
+                "total_pages": doc.page_count,
+                **doc_metadata
+            }
+            for text in splitter.split_text(page.get_text()):
+                chunks.append((text, metadata))
+    return chunks
+
+def timed_parse_pdf_pages(path: str, start: int, end: int, chunk_size: int, chunk_overlap: int) -> tuple[float, list[tuple[str, dict]]]:
+    """parse_pdf_pages plus the seconds it took, measured inside the worker process"""
+    started = time.perf_counter()
+    chunks = parse_pdf_pages(path, start, end, chunk_size, chunk_overlap)
+    return time.perf_counter() - started, chunks
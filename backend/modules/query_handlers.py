@@ -1,82 +1,339 @@
+import os
+import asyncio
+from dotenv import load_dotenv
+from modules.answer_cache import get_answer_cache
+from modules.context_builder import CONTEXT_TOKEN_BUDGET, pack_passages
+from modules.deadline import RETRIEVAL_BUDGET_SHARE, LEXICAL_FALLBACK_SHARE, within
+from modules.llm_scheduler import LLMOverloaded, get_llm_scheduler, chain_key
+from modules.workers import run_in_query_pool
+from modules.metrics import Counter, register, span
 from logger import logger
 
-def query_chain(chain_components, user_input: str):
-    """Process user query using hybrid approach (documents + general knowledge)"""
+load_dotenv()
+
+# Questions of a batch embedded and retrieved together (one forward pass, one matrix product)
+BATCH_RETRIEVAL_SIZE = int(os.environ.get("BATCH_RETRIEVAL_SIZE", "64"))
+# LLM calls a batch keeps in flight; kept below LLM_MAX_CONCURRENCY so interactive questions still get slots
+BATCH_LLM_CONCURRENCY = int(os.environ.get("BATCH_LLM_CONCURRENCY", "4"))
+# Seconds a batch question waits before retrying when the LLM queue is full
+BATCH_OVERLOAD_RETRY_SECONDS = 2.0
+BATCH_OVERLOAD_RETRIES = 5
+
+DEADLINE_MESSAGE = "Sorry, generating this answer is taking longer than expected. Please try again in a moment."
+
+DEGRADED_ANSWERS = register(Counter(
+    "ragbot_degraded_answers_total", "Answers that took a degraded path to meet the request deadline", ["response_type"]
+))
+
+def build_context(relevant_docs, question=None, token_budget=CONTEXT_TOKEN_BUDGET):
+    """Build the LLM context string and deduplicated source labels from retrieved documents.
+
+    The most relevant sentences of the top documents are packed into
+    token_budget tokens (see context_builder.pack_passages).
+    """
+    context = ""
+    sources = []
+    for doc, passage in pack_passages(relevant_docs, question, token_budget):
+        context += passage + "\n\n"
+        source = doc.get("source", "")
+        doc_type = doc.get("document_type", "document")
+        page = doc.get("page", 0) if doc.get("page") else ""
+        
+        if source:
+            if doc_type == "pdf" and page:
+                source_info = f"{source} (page {page})"
+            elif doc_type == "json":
+                metadata = doc.get("metadata", {})
+                if metadata.get("key"):
+                    source_info = f"{source} (key: {metadata['key']})"
+                else:
+                    source_info = source
+            else:
+                source_info = source
+            sources.append(source_info)
+
+    return context, list(set(sources))  # deduplicate
+
+async def _lookup_or_retrieve(retriever, cache, user_input, filters=None, deadline=None):
+    """Return (cached_response, query_embedding, relevant_docs); the last two are None on a cache hit"""
+    # Reuse a recent answer to the same question, then to a near-identical one
+    if cache is not None:
+        cache.set_corpus_version(await run_in_query_pool(retriever.corpus_version))
+        cached = await run_in_query_pool(cache.get_exact, user_input)
+        if cached is not None:
+            logger.debug("Answer cache hit (exact)")
+            return cached, None, None
+
+    query_embedding = await run_in_query_pool(retriever.embed_query, user_input)
+    if cache is not None:
+        cached = await run_in_query_pool(cache.get_similar, query_embedding)
+        if cached is not None:
+            logger.debug("Answer cache hit (semantic)")
+            return cached, None, None
+
+    # First, try to get relevant documents
+    logger.debug("Starting document retrieval...")
+    with span("retrieval"):
+        relevant_docs = await run_in_query_pool(retriever.get_relevant_documents, user_input, query_embedding, filters, deadline)
+    return None, query_embedding, relevant_docs
+
+async def _lexical_fallback(retriever, user_input, filters, deadline):
+    """Text-index-only retrieval within deadline, or None"""
     try:
-        logger.info(f"User input: {user_input}")
+        with span("retrieval_lexical_fallback"):
+            return await within(deadline, run_in_query_pool(retriever.get_lexical_documents, user_input, None, filters, deadline))
+    except asyncio.TimeoutError:
+        logger.warning("Lexical fallback also missed its deadline")
+        return None
 
-        document_chain = chain_components["document_chain"]
-        general_chain = chain_components["general_chain"]
-        retriever = chain_components["retriever"]
+async def _astream_chain(chain, inputs):
+    """Yield LLM tokens for an LLMChain's prompt as the model produces them"""
+    async for chunk in (chain.prompt | chain.llm).astream(inputs):
+        if chunk.content:
+            yield chunk.content
 
-        # First, try to get relevant documents
-        logger.debug("Starting document retrieval...")
-        relevant_docs = retriever.get_relevant_documents(user_input)
+async def _run_chain(chain, inputs, deadline=None):
+    """Run an LLMChain through the scheduler; identical concurrent prompts share one Groq call,
+    and a call slower than usual is hedged"""
+    return await get_llm_scheduler().run_hedged(chain_key(chain, inputs), lambda: chain.arun(**inputs), deadline)
+
+async def _generate_answer(chain_components, user_input, relevant_docs, history="", deadline=None,
+                           document_response_type="document_based", general_response_type="general_knowledge"):
+    """Answer from the retrieved documents, or from general knowledge when there are none"""
+    if relevant_docs:
+        # We have relevant documents, use document-based chain
+        logger.debug(f"Found {len(relevant_docs)} relevant documents, using document-based response")
+        
+        with span("prompt_assembly"):
+            context, sources = build_context(relevant_docs, user_input)
+
+        logger.debug("Calling LLM with document context...")
+        chain = chain_components["document_chain"]
+        inputs = {"context": context, "history": history, "question": user_input}
+        response_type = document_response_type
         
-        if relevant_docs:
-            # We have relevant documents, use document-based chain
-            logger.debug(f"Found {len(relevant_docs)} relevant documents, using document-based response")
-            
-            # Build context from documents
-            context = ""
-            sources = []
-            for doc in relevant_docs:
-                snippet = doc.get("content", "")[:800]  # Increased snippet size
-                context += snippet + "\n\n"
-                source = doc.get("source", "")
-                doc_type = doc.get("document_type", "document")
-                page = doc.get("page", 0) if doc.get("page") else ""
-                
-                if source:
-                    if doc_type == "pdf" and page:
-                        source_info = f"{source} (page {page})"
-                    elif doc_type == "json":
-                        metadata = doc.get("metadata", {})
-                        if metadata.get("key"):
-                            source_info = f"{source} (key: {metadata['key']})"
-                        else:
-                            source_info = source
-                    else:
-                        source_info = source
-                    sources.append(source_info)
-
-            logger.debug("Calling LLM with document context...")
-            result = document_chain.run(context=context, question=user_input)
-            
-            response = {
-                "response": result,
-                "sources": list(set(sources)),  # deduplicate
-                "response_type": "document_based"
-            }
-            
-        else:
-            # No relevant documents found, use general knowledge
-            logger.debug("No relevant documents found, using general knowledge response")
-            
-            logger.debug("Calling LLM for general knowledge...")
-            result = general_chain.run(question=user_input)
-            
-            response = {
-                "response": result,
-                "sources": [],
-                "response_type": "general_knowledge"
-            }
-
-        logger.debug(f"Final response type: {response['response_type']}")
-        return response
+    else:
+        # No relevant documents found, use general knowledge
+        logger.debug("No relevant documents found, using general knowledge response")
+        
+        logger.debug("Calling LLM for general knowledge...")
+        chain = chain_components["general_chain"]
+        inputs = {"history": history, "question": user_input}
+        sources = []
+        response_type = general_response_type
+
+    try:
+        with span("llm"):
+            result = await _run_chain(chain, inputs, deadline)
+    except asyncio.TimeoutError:
+        logger.warning("LLM call missed the request deadline")
+        result = DEADLINE_MESSAGE
+        response_type = "degraded_timeout"
+
+    return {
+        "response": result,
+        "sources": sources,
+        "response_type": response_type
+    }
+
+async def query_chain(chain_components, user_input: str, filters=None, history="", deadline=None):
+    """Process user query using hybrid approach (documents + general knowledge).
+
+    history is the conversation window from chat_history.get_context_window.
+    LLM errors (after the scheduler's retries) and LLMOverloaded propagate to
+    the caller; only a retrieval failure falls back to general knowledge.
+
+    With a deadline (see modules.deadline) the answer is returned by then.
+    Retrieval gets RETRIEVAL_BUDGET_SHARE of it; if it overruns, the text index
+    alone is searched ("degraded_lexical") or the question is answered from
+    general knowledge ("degraded_general"). An LLM call still running at the
+    deadline gives a "degraded_timeout" answer. Degraded answers are not cached.
+    """
+    logger.info(f"User input: {user_input}")
 
+    retriever = chain_components["retriever"]
+
+    # Cached answers were produced without filters or conversation context, so those questions bypass the cache
+    cache = None if filters or history else get_answer_cache()
+    retrieval_deadline = deadline.share(RETRIEVAL_BUDGET_SHARE) if deadline is not None else None
+    document_response_type = "document_based"
+    try:
+        cached, query_embedding, relevant_docs = await within(
+            retrieval_deadline, _lookup_or_retrieve(retriever, cache, user_input, filters, retrieval_deadline)
+        )
+        general_response_type = "general_knowledge"
+    except asyncio.TimeoutError:
+        logger.warning("Retrieval overran its share of the deadline, searching the text index only")
+        cached, query_embedding = None, None
+        relevant_docs = await _lexical_fallback(retriever, user_input, filters, deadline.share(LEXICAL_FALLBACK_SHARE))
+        document_response_type = "degraded_lexical"
+        general_response_type = "degraded_general"
+    except Exception:
+        logger.exception("Error in retrieval, falling back to general knowledge")
+        cached, query_embedding, relevant_docs = None, None, None
+        general_response_type = "fallback_general"
+    if cached is not None:
+        return cached
+    
+    response = await _generate_answer(
+        chain_components, user_input, relevant_docs, history, deadline, document_response_type, general_response_type
+    )
+    response_type = response["response_type"]
+
+    logger.debug(f"Final response type: {response_type}")
+    if response_type.startswith("degraded_"):
+        DEGRADED_ANSWERS.inc(response_type)
+    elif cache is not None and query_embedding is not None:
+        await run_in_query_pool(cache.put, user_input, query_embedding, response)
+    return response
+
+async def stream_query_chain(chain_components, user_input: str, filters=None, history=""):
+    """Streaming variant of query_chain.
+
+    Yields a "meta" event with sources and response_type as soon as retrieval
+    finishes, then one "token" event per LLM token and a final "done" event.
+    Closing the generator stops the upstream LLM call.
+    """
+    logger.info(f"User input (streaming): {user_input}")
+
+    retriever = chain_components["retriever"]
+    cache = None if filters or history else get_answer_cache()
+    try:
+        cached, query_embedding, relevant_docs = await _lookup_or_retrieve(retriever, cache, user_input, filters)
+    except Exception:
+        logger.exception("Error in retrieval, streaming general knowledge answer")
+        cached, query_embedding, relevant_docs = None, None, None
+
+    if cached is not None:
+        yield {"type": "meta", "sources": cached["sources"], "response_type": cached["response_type"]}
+        yield {"type": "token", "content": cached["response"]}
+        yield {"type": "done"}
+        return
+
+    if relevant_docs:
+        with span("prompt_assembly"):
+            context, sources = build_context(relevant_docs, user_input)
+        chain = chain_components["document_chain"]
+        inputs = {"context": context, "history": history, "question": user_input}
+        response_type = "document_based"
+    else:
+        chain = chain_components["general_chain"]
+        inputs = {"history": history, "question": user_input}
+        sources = []
+        response_type = "general_knowledge"
+
+    yield {"type": "meta", "sources": sources, "response_type": response_type}
+
+    tokens = []
+    try:
+        with span("llm_stream"):
+            async for token in get_llm_scheduler().stream(lambda: _astream_chain(chain, inputs)):
+                tokens.append(token)
+                yield {"type": "token", "content": token}
     except Exception as e:
-        logger.exception("Error in query_chain")
-        # Fallback to general knowledge in case of error
+        logger.exception("Error streaming LLM response")
+        yield {"type": "error", "error": str(e)}
+        return
+
+    if cache is not None and query_embedding is not None:
+        response = {"response": "".join(tokens), "sources": sources, "response_type": response_type}
+        await run_in_query_pool(cache.put, user_input, query_embedding, response)
+    yield {"type": "done"}
+
+def _batch_cache_lookup(cache, retriever, questions, query_embeddings):
+    """Cached answers for a block of questions (None where there is none)"""
+    cache.set_corpus_version(retriever.corpus_version())
+    return [
+        cache.get_exact(question) or cache.get_similar(query_embedding)
+        for question, query_embedding in zip(questions, query_embeddings)
+    ]
+
+async def batch_query_chain(chain_components, questions, filters=None, concurrency=BATCH_LLM_CONCURRENCY):
+    """Answer many questions, yielding {"index", "question", **response} as each one completes.
+
+    Questions are embedded and retrieved BATCH_RETRIEVAL_SIZE at a time (one
+    embedding forward pass and one vector matrix product per block), and at
+    most concurrency LLM calls run at once. A question whose answer failed is
+    yielded with an "error" instead. Results arrive out of order; closing the
+    generator cancels the remaining work.
+    """
+    retriever = chain_components["retriever"]
+    cache = None if filters else get_answer_cache()
+    results = asyncio.Queue()
+    llm_slots = asyncio.Semaphore(concurrency)
+    # Retrieval runs at most two blocks ahead of the LLM calls
+    backlog = asyncio.Semaphore(2 * max(BATCH_RETRIEVAL_SIZE, concurrency))
+    tasks = []
+
+    async def answer(index, question, query_embedding, relevant_docs, general_response_type):
+        try:
+            async with llm_slots:
+                for attempt in range(BATCH_OVERLOAD_RETRIES + 1):
+                    try:
+                        response = await _generate_answer(
+                            chain_components, question, relevant_docs, general_response_type=general_response_type
+                        )
+                        break
+                    except LLMOverloaded:
+                        # Interactive traffic has filled the LLM queue; batch work waits its turn
+                        if attempt == BATCH_OVERLOAD_RETRIES:
+                            raise
+                        await asyncio.sleep(BATCH_OVERLOAD_RETRY_SECONDS * (attempt + 1))
+            if cache is not None and query_embedding is not None:
+                await run_in_query_pool(cache.put, question, query_embedding, response)
+            await results.put({"index": index, "question": question, **response})
+        except Exception as e:
+            logger.exception(f"Error answering batch question {index}")
+            await results.put({"index": index, "question": question, "error": str(e)})
+        finally:
+            backlog.release()
+
+    async def produce():
         try:
-            logger.info("Attempting fallback to general knowledge...")
-            general_chain = chain_components["general_chain"]
-            result = general_chain.run(question=user_input)
-            return {
-                "response": result,
-                "sources": [],
-                "response_type": "fallback_general"
-            }
-        except Exception as fallback_error:
-            logger.exception("Fallback also failed")
-            raise e
\ No newline at end of file
+            for start in range(0, len(questions), BATCH_RETRIEVAL_SIZE):
+                block = questions[start:start + BATCH_RETRIEVAL_SIZE]
+                general_response_type = "general_knowledge"
+                try:
+                    query_embeddings = await run_in_query_pool(retriever.embed_queries, block)
+                    cached = [None] * len(block)
+                    if cache is not None:
+                        cached = await run_in_query_pool(_batch_cache_lookup, cache, retriever, block, query_embeddings)
+                    with span("retrieval_batch"):
+                        relevant = await run_in_query_pool(
+                            retriever.get_relevant_documents_batch,
+                            [q for q, hit in zip(block, cached) if hit is None],
+                            [e for e, hit in zip(query_embeddings, cached) if hit is None],
+                            filters
+                        )
+                except Exception:
+                    logger.exception("Error in batch retrieval, answering the block from general knowledge")
+                    query_embeddings = cached = [None] * len(block)
+                    relevant = [None] * len(block)
+                    general_response_type = "fallback_general"
+                relevant = iter(relevant)
+                for offset, (question, query_embedding, hit) in enumerate(zip(block, query_embeddings, cached)):
+                    await backlog.acquire()
+                    if hit is not None:
+                        backlog.release()
+                        await results.put({"index": start + offset, "question": question, **hit})
+                        continue
+                    tasks.append(asyncio.ensure_future(
+                        answer(start + offset, question, query_embedding, next(relevant), general_response_type)
+                    ))
+            await asyncio.gather(*tasks)
+        finally:
+            await results.put(None)
+
+    logger.info(f"Answering a batch of {len(questions)} questions")
+    producer = asyncio.ensure_future(produce())
+    try:
+        while True:
+            item = await results.get()
+            if item is None:
+                break
+            yield item
+        await producer
+    finally:
+        producer.cancel()
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,79 @@
+import os
+import threading
+from dotenv import load_dotenv
+from langchain_groq import ChatGroq
+from langchain_huggingface import HuggingFaceEmbeddings
+from modules.embedding_service import EMBEDDING_BACKEND, CachedEmbeddings, RemoteEmbeddings
+from modules.context_builder import load_encoding
+from modules.database import get_mongo_client, get_shard_collections, close_connection, create_indexes
+from modules.document_registry import ensure_registry
+from modules.vector_index import get_vector_index
+from logger import logger
+
+load_dotenv()
+
+GROQ_API_KEY = os.environ.get("GROQ_API_KEY")
+EMBEDDING_MODEL_NAME = os.environ.get("EMBEDDING_MODEL_NAME", "all-MiniLM-L12-v2")
+LLM_MODEL_NAME = os.environ.get("LLM_MODEL_NAME", "llama-3.1-8b-instant")
+LLM_TEMPERATURE = float(os.environ.get("LLM_TEMPERATURE", "0.1"))
+
+_embeddings = None
+_llm = None
+_lock = threading.Lock()
+
+def create_local_embeddings():
+    """Load the sentence-transformer model into this process"""
+    logger.info(f"Loading embeddings model {EMBEDDING_MODEL_NAME}")
+    return HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME)
+
+def get_embeddings():
+    """Get the shared embeddings model (loads once, or talks to the embedding worker), with cached query embeddings"""
+    global _embeddings
+    if _embeddings is None:
+        with _lock:
+            if _embeddings is None:
+                if EMBEDDING_BACKEND == "remote":
+                    logger.info("Using the shared embedding worker")
+                    model = RemoteEmbeddings()
+                else:
+                    model = create_local_embeddings()
+                _embeddings = CachedEmbeddings(model)
+    return _embeddings
+
+def get_llm():
+    """Get the shared Groq chat client (reuses one HTTP connection pool)"""
+    global _llm
+    if _llm is None:
+        with _lock:
+            if _llm is None:
+                logger.info(f"Creating Groq client for {LLM_MODEL_NAME}")
+                _llm = ChatGroq(
+                    groq_api_key=GROQ_API_KEY,
+                    model_name=LLM_MODEL_NAME,
+                    temperature=LLM_TEMPERATURE,
+                    # Retries and backoff are done by llm_scheduler, which also bounds concurrency
+                    max_retries=0
+                )
+    return _llm
+
+def warm_up():
+    """Create every shared resource up front so no request pays for model loading"""
+    load_encoding()
+    get_mongo_client().admin.command("ping")
+    create_indexes()
+    for collection in get_shard_collections():
+        ensure_registry(collection)
+    get_embeddings().embed_query("warm up")
+    get_llm()
+    for collection in get_shard_collections():
+        get_vector_index(collection)
+    logger.info("Shared resources ready")
+
+def shutdown():
+    """Release shared resources on application shutdown"""
+    global _embeddings, _llm
+    with _lock:
+        _embeddings = None
+        _llm = None
+    close_connection()
+    logger.info("Shared resources released")
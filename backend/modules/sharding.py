@@ -0,0 +1,146 @@
+import time
+import heapq
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from modules.database import SHARD_COUNT, shard_number
+from modules.document_registry import get_corpus_version, corpus_stats
+from modules.load_vectorstore import similarity_search, similarity_search_batch, lexical_search, vector_similarities
+from modules.vector_index import get_vector_index, sync_vector_index
+from modules.workers import submit_shard_search
+from modules.metrics import METRICS_ENABLED, Counter, Histogram, register, span
+from logger import logger
+
+SHARD_SEARCH_DURATION = register(Histogram(
+    "ragbot_shard_search_duration_seconds", "Time one shard took to answer its part of a scatter-gather search",
+    ["search", "shard"]
+))
+SHARD_SEARCH_MISSES = register(Counter(
+    "ragbot_shard_search_misses_total", "Shard searches left out of a merged result", ["search", "shard", "reason"]
+))
+
+def _timed(search, shard, call):
+    start = time.perf_counter()
+    try:
+        return call(shard)
+    finally:
+        elapsed = time.perf_counter() - start
+        if METRICS_ENABLED:
+            SHARD_SEARCH_DURATION.observe(search, shard.name, value=elapsed)
+        logger.debug(f"{search} search of {shard.full_name} took {elapsed * 1000:.1f}ms")
+
+def scatter_gather(search, shards, call, deadline=None):
+    """Run call(shard) on every shard in parallel and return one result per shard.
+
+    A shard that raises or is still running at deadline (see modules.deadline)
+    gives None, so the merged answer covers the other shards instead of failing.
+    Each shard's latency goes to ragbot_shard_search_duration_seconds{search, shard}.
+    """
+    futures = [submit_shard_search(_timed, search, shard, call) for shard in shards]
+    results = []
+    for shard, future in zip(shards, futures):
+        try:
+            results.append(future.result(timeout=deadline.remaining() if deadline is not None else None))
+        except FutureTimeoutError:
+            logger.warning(f"Shard {shard.full_name} missed the {search} search deadline, leaving it out")
+            SHARD_SEARCH_MISSES.inc(search, shard.name, "deadline")
+            results.append(None)
+        except Exception as e:
+            logger.error(f"Error in {search} search of shard {shard.full_name}: {e}")
+            SHARD_SEARCH_MISSES.inc(search, shard.name, "error")
+            results.append(None)
+    return results
+
+def merge_shard_results(result_lists, k, score_field="similarity"):
+    """Global top k from per-shard top-k lists (None for a missing shard), best first.
+
+    Every chunk lives on exactly one shard, so the global top k is within the
+    union of the per-shard top k. Equal scores are ordered by _id, so the
+    ranking does not depend on shard count or on which shard answered first.
+    """
+    return heapq.nsmallest(
+        k,
+        (doc for results in result_lists if results for doc in results),
+        key=lambda doc: (-doc.get(score_field, 0.0), str(doc["_id"]))
+    )
+
+def shards_for(shards, filters):
+    """The shards that can hold chunks matching filters.
+
+    Chunks are placed by source hash, so a source filter only needs the shards
+    owning those sources. shards must be get_shard_collections() in shard order.
+    """
+    sources = ((filters or {}).get("source") or {}).get("$in")
+    if not sources or len(shards) != SHARD_COUNT:
+        return shards
+    owners = {shard_number(source) for source in sources}
+    return [shard for number, shard in enumerate(shards) if number in owners]
+
+def sharded_similarity_search(query, shards, embeddings_model, k=3, query_embedding=None, filters=None, deadline=None):
+    """similarity_search on every shard in parallel, merged into one top k"""
+    if query_embedding is None:
+        # Embed once rather than once per shard
+        query_embedding = embeddings_model.embed_query(query)
+    with span("sharded_similarity_search"):
+        results = scatter_gather("vector", shards_for(shards, filters), lambda shard: similarity_search(
+            query, shard, embeddings_model, k, get_vector_index(shard), query_embedding, filters, deadline
+        ), deadline)
+        return merge_shard_results(results, k)
+
+def sharded_similarity_search_batch(query_embeddings, shards, k=3, filters=None):
+    """similarity_search_batch on every shard in parallel; one merged top k per query"""
+    if not len(query_embeddings):
+        return []
+    with span("sharded_similarity_search_batch"):
+        results = scatter_gather("vector_batch", shards_for(shards, filters), lambda shard: similarity_search_batch(
+            query_embeddings, shard, k, get_vector_index(shard), filters
+        ))
+        results = [shard_results for shard_results in results if shard_results is not None]
+        return [
+            merge_shard_results([shard_results[i] for shard_results in results], k)
+            for i in range(len(query_embeddings))
+        ]
+
+def sharded_lexical_search(query, shards, k=3, filters=None, deadline=None):
+    """lexical_search on every shard in parallel, merged by textScore.
+
+    textScore depends only on the matched document, not on collection-wide
+    statistics, so scores from different shards are comparable.
+    """
+    results = scatter_gather("lexical", shards_for(shards, filters), lambda shard: lexical_search(
+        query, shard, k, filters, deadline
+    ), deadline)
+    return merge_shard_results(results, k, "score")
+
+def sharded_vector_similarities(shards, ids, query_embedding):
+    """vector_similarities for ids that may live on any shard"""
+    if not ids:
+        return {}
+    similarities = {}
+    for result in scatter_gather("similarities", shards, lambda shard: vector_similarities(shard, ids, query_embedding)):
+        similarities.update(result or {})
+    return similarities
+
+def sync_shard_indexes(shards):
+    """sync_vector_index for every shard's index"""
+    for shard in shards:
+        sync_vector_index(shard)
+
+def sharded_corpus_version(shards):
+    """A version that changes whenever any shard's corpus version does"""
+    # Each shard's version only grows, so their sum does too
+    return sum(get_corpus_version(shard) for shard in shards)
+
+def sharded_corpus_stats(shards):
+    """corpus_stats summed over the shards, plus each shard's own stats by collection"""
+    per_shard = [corpus_stats(shard) for shard in shards]
+    if len(per_shard) == 1:
+        return per_shard[0]
+    files_by_type = {}
+    for stats in per_shard:
+        for doc_type, count in stats["files_by_type"].items():
+            files_by_type[doc_type] = files_by_type.get(doc_type, 0) + count
+    return {
+        **{field: sum(stats[field] for stats in per_shard)
+           for field in ("total_documents", "pdf_documents", "json_documents", "total_files", "corpus_version")},
+        "files_by_type": files_by_type,
+        "shards": {shard.full_name: stats for shard, stats in zip(shards, per_shard)}
+    }
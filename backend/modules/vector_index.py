@@ -0,0 +1,542 @@
+import os
+import time
+import threading
+import numpy as np
+from dotenv import load_dotenv
+from modules.corpus_snapshot import ID_DTYPE, open_snapshot, export_snapshot, update_snapshot, decode_id
+from modules.document_registry import get_corpus_version, changes_since
+from modules.embedding_storage import EMBEDDING_PROJECTION, decode_embedding
+from modules.workers import submit_background
+from logger import logger
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+load_dotenv()
+
+# "hnsw" (approximate, needs hnswlib), "exact" (numpy brute force), "mmap" (exact over a memory-mapped
+# corpus snapshot shared by every worker, see corpus_snapshot) or "mongo" (legacy $reduce pipeline)
+VECTOR_INDEX_BACKEND = os.environ.get("VECTOR_INDEX_BACKEND", "hnsw").lower()
+HNSW_M = int(os.environ.get("HNSW_M", "16"))
+HNSW_EF_CONSTRUCTION = int(os.environ.get("HNSW_EF_CONSTRUCTION", "200"))
+HNSW_EF_SEARCH = int(os.environ.get("HNSW_EF_SEARCH", "64"))
+INDEX_BUILD_BATCH_SIZE = 5000
+# Corpus rows scored per matrix product in batched search; bounds the scores matrix to queries x rows
+SEARCH_BLOCK_ROWS = 65536
+
+def merge_top_k(best_scores, best_keys, scores, keys, k):
+    """Merge a block of scores (queries x block) into the running per-query top k.
+
+    best_scores/best_keys are (queries x <=k) arrays or None; keys labels the
+    block's columns. Returns the new (best_scores, best_keys), best first.
+    """
+    keys = np.broadcast_to(np.asarray(keys), scores.shape)
+    if best_scores is not None:
+        scores = np.hstack([best_scores, scores])
+        keys = np.hstack([best_keys, keys])
+    k = min(k, scores.shape[1])
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1, kind="stable")
+    top = np.take_along_axis(top, order, axis=1)
+    return np.take_along_axis(scores, top, axis=1), np.take_along_axis(keys, top, axis=1)
+
+class VectorIndex:
+    """Base class for in-memory vector indexes keyed by MongoDB _id"""
+    def __init__(self, dim=None):
+        self.dim = dim
+        # Corpus version (see document_registry) whose changes the index reflects
+        self.version = 0
+        self._lock = threading.RLock()
+        self._sync_lock = threading.Lock()
+
+    def add(self, ids, vectors):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def remove(self, ids):
+        raise NotImplementedError
+
+    def search(self, query_vector, k):
+        """Return a list of (id, similarity) pairs, best first"""
+        raise NotImplementedError
+
+    def search_batch(self, query_vectors, k):
+        """search() for many queries at once; one list of (id, similarity) pairs per query"""
+        return [self.search(query_vector, k) for query_vector in self._as_matrix(query_vectors)]
+
+    def search_subset(self, query_vector, k, ids):
+        """Exact top-k restricted to the given ids, in time proportional to len(ids)"""
+        return self.search_subset_batch([query_vector], k, ids)[0]
+
+    def search_subset_batch(self, query_vectors, k, ids):
+        """search_subset() for many queries, scoring the subset with one matrix product per block"""
+        with self._lock:
+            queries = self._as_matrix(query_vectors)
+            ids = [doc_id for doc_id in ids if self._contains(doc_id)]
+            if not ids or k <= 0:
+                return [[] for _ in queries]
+            best_scores = best_rows = None
+            for start in range(0, len(ids), SEARCH_BLOCK_ROWS):
+                block = ids[start:start + SEARCH_BLOCK_ROWS]
+                scores = queries @ self._vectors_for(block).T
+                best_scores, best_rows = merge_top_k(best_scores, best_rows, scores, np.arange(start, start + len(block)), k)
+            return [
+                [(ids[row], float(score)) for row, score in zip(rows, row_scores)]
+                for rows, row_scores in zip(best_rows, best_scores)
+            ]
+
+    def _contains(self, doc_id):
+        raise NotImplementedError
+
+    def _vectors_for(self, ids):
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def _as_matrix(self, vectors):
+        matrix = np.asarray(vectors, dtype=np.float32)
+        if matrix.ndim == 1:
+            matrix = matrix.reshape(1, -1)
+        if self.dim is None:
+            self.dim = matrix.shape[1]
+        elif matrix.shape[1] != self.dim:
+            raise ValueError(f"Expected {self.dim}-dim vectors, got {matrix.shape[1]}")
+        return matrix
+
+class ExactIndex(VectorIndex):
+    """Brute-force dot product over a contiguous float32 matrix.
+
+    Ranks exactly like the MongoDB $reduce pipeline, so it doubles as the
+    reference for measuring recall of the approximate backends.
+    """
+    def __init__(self, dim=None):
+        super().__init__(dim)
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._ids = []
+            self._rows = {}
+            self._matrix = None
+            self._size = 0
+
+    def add(self, ids, vectors):
+        with self._lock:
+            matrix = self._as_matrix(vectors)
+            if self._matrix is None:
+                self._matrix = np.empty((max(len(matrix), 1024), self.dim), dtype=np.float32)
+            for doc_id, vector in zip(ids, matrix):
+                row = self._rows.get(doc_id)
+                if row is None:
+                    if self._size == len(self._matrix):
+                        grown = np.empty((len(self._matrix) * 2, self.dim), dtype=np.float32)
+                        grown[:self._size] = self._matrix[:self._size]
+                        self._matrix = grown
+                    row = self._size
+                    self._size += 1
+                    self._rows[doc_id] = row
+                    self._ids.append(doc_id)
+                self._matrix[row] = vector
+
+    def remove(self, ids):
+        with self._lock:
+            for doc_id in ids:
+                row = self._rows.pop(doc_id, None)
+                if row is None:
+                    continue
+                # Swap the last row into the hole to keep the matrix contiguous
+                last = self._size - 1
+                if row != last:
+                    last_id = self._ids[last]
+                    self._matrix[row] = self._matrix[last]
+                    self._ids[row] = last_id
+                    self._rows[last_id] = row
+                self._ids.pop()
+                self._size -= 1
+
+    def search(self, query_vector, k):
+        with self._lock:
+            if self._size == 0 or k <= 0:
+                return []
+            query = self._as_matrix(query_vector)[0]
+            scores = self._matrix[:self._size] @ query
+            k = min(k, self._size)
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top], kind="stable")]
+            return [(self._ids[i], float(scores[i])) for i in top]
+
+    def search_batch(self, query_vectors, k):
+        """Score every query against the whole matrix, SEARCH_BLOCK_ROWS rows per product"""
+        with self._lock:
+            queries = self._as_matrix(query_vectors)
+            if self._size == 0 or k <= 0:
+                return [[] for _ in queries]
+            best_scores = best_rows = None
+            for start in range(0, self._size, SEARCH_BLOCK_ROWS):
+                end = min(start + SEARCH_BLOCK_ROWS, self._size)
+                scores = queries @ self._matrix[start:end].T
+                best_scores, best_rows = merge_top_k(best_scores, best_rows, scores, np.arange(start, end), k)
+            return [
+                [(self._ids[row], float(score)) for row, score in zip(rows, row_scores)]
+                for rows, row_scores in zip(best_rows, best_scores)
+            ]
+
+    def _contains(self, doc_id):
+        return doc_id in self._rows
+
+    def _vectors_for(self, ids):
+        return self._matrix[[self._rows[doc_id] for doc_id in ids]]
+
+    def __len__(self):
+        return self._size
+
+class MappedIndex(VectorIndex):
+    """Exact search over a memory-mapped corpus snapshot plus an in-memory ExactIndex for later changes.
+
+    Workers mapping the same snapshot share one copy of the vectors in the OS
+    page cache, and opening it costs no Mongo reads. Chunks removed since the
+    snapshot are masked out; chunks added since live in the overlay.
+    """
+    def __init__(self, snapshot):
+        super().__init__(snapshot.dim)
+        self.snapshot = snapshot
+        self.clear()
+        self._base = snapshot.vectors
+        self._base_ids = snapshot.ids
+        self._deleted = np.zeros(len(snapshot.ids), dtype=bool)
+        for added_ids, added_vectors, removed_ids in snapshot.deltas:
+            self.remove(removed_ids)
+            if added_ids:
+                self.add(added_ids, added_vectors)
+        self.version = snapshot.version
+
+    def clear(self):
+        with self._lock:
+            self._base = np.empty((0, self.dim or 0), dtype=np.float32)
+            self._base_ids = np.empty(0, dtype=ID_DTYPE)
+            self._deleted = np.zeros(0, dtype=bool)
+            self._deleted_count = 0
+            self._overlay = ExactIndex(self.dim)
+
+    def _base_row(self, doc_id):
+        """Row of a live snapshot chunk, or None"""
+        binary = getattr(doc_id, "binary", None)
+        if binary is None or not len(self._base_ids):
+            return None
+        row = int(np.searchsorted(self._base_ids, np.array(binary, dtype=ID_DTYPE)))
+        # numpy drops trailing zero bytes of S12 values
+        if row < len(self._base_ids) and self._base_ids[row].ljust(12, b"\0") == binary and not self._deleted[row]:
+            return row
+        return None
+
+    def add(self, ids, vectors):
+        with self._lock:
+            ids = list(ids)
+            # Re-adding a snapshot chunk replaces its vector
+            self._mask(ids)
+            self._overlay.add(ids, vectors)
+
+    def remove(self, ids):
+        with self._lock:
+            ids = list(ids)
+            self._mask(ids)
+            self._overlay.remove(ids)
+
+    def _mask(self, ids):
+        for doc_id in ids:
+            row = self._base_row(doc_id)
+            if row is not None:
+                self._deleted[row] = True
+                self._deleted_count += 1
+
+    def search(self, query_vector, k):
+        return self.search_batch(query_vector, k)[0]
+
+    def search_batch(self, query_vectors, k):
+        with self._lock:
+            queries = self._as_matrix(query_vectors)
+            if k <= 0:
+                return [[] for _ in queries]
+            results = self._overlay.search_batch(queries, k)
+            best_scores = best_rows = None
+            for start in range(0, len(self._base), SEARCH_BLOCK_ROWS):
+                end = min(start + SEARCH_BLOCK_ROWS, len(self._base))
+                scores = queries @ self._base[start:end].T
+                if self._deleted_count:
+                    scores[:, self._deleted[start:end]] = -np.inf
+                best_scores, best_rows = merge_top_k(best_scores, best_rows, scores, np.arange(start, end), k)
+            if best_scores is None:
+                return results
+            merged = []
+            for overlay_hits, rows, row_scores in zip(results, best_rows, best_scores):
+                hits = overlay_hits + [
+                    (decode_id(self._base_ids[row]), float(score))
+                    for row, score in zip(rows, row_scores) if score != -np.inf
+                ]
+                hits.sort(key=lambda hit: hit[1], reverse=True)
+                merged.append(hits[:k])
+            return merged
+
+    def _contains(self, doc_id):
+        return self._base_row(doc_id) is not None or self._overlay._contains(doc_id)
+
+    def _vectors_for(self, ids):
+        rows = []
+        for doc_id in ids:
+            row = self._base_row(doc_id)
+            rows.append(self._base[row] if row is not None else self._overlay._vectors_for([doc_id])[0])
+        return np.asarray(rows, dtype=np.float32)
+
+    def __len__(self):
+        return len(self._base) - self._deleted_count + len(self._overlay)
+
+class HNSWIndex(VectorIndex):
+    """Approximate nearest neighbour index backed by hnswlib (inner product space).
+
+    Removed ids are tombstoned with mark_deleted, and later adds take over the
+    tombstoned slots (allow_replace_deleted), so churn does not grow the index.
+    Labels themselves are never reused: hnswlib requires a replacing label to
+    be new, and uint64 labels do not run out.
+    """
+    def __init__(self, dim=None, m=HNSW_M, ef_construction=HNSW_EF_CONSTRUCTION, ef_search=HNSW_EF_SEARCH):
+        if hnswlib is None:
+            raise ImportError("hnswlib is required for the hnsw vector index backend")
+        super().__init__(dim)
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._index = None
+            self._labels = {}
+            self._ids = {}
+            self._next_label = 0
+            # Tombstoned slots the next adds take over
+            self._deleted = 0
+
+    def _ensure_capacity(self, extra):
+        if self._index is None:
+            self._index = hnswlib.Index(space="ip", dim=self.dim)
+            self._index.init_index(max_elements=max(extra, 1024), M=self.m, ef_construction=self.ef_construction,
+                                   allow_replace_deleted=True)
+            self._index.set_ef(self.ef_search)
+            return
+        needed = self._index.get_current_count() + extra
+        capacity = self._index.get_max_elements()
+        if needed > capacity:
+            self._index.resize_index(max(needed, capacity * 2))
+
+    def add(self, ids, vectors):
+        with self._lock:
+            matrix = self._as_matrix(vectors)
+            ids = list(ids)
+            if not ids:
+                return
+            # Re-adding an id replaces its vector
+            self._remove_locked(doc_id for doc_id in ids if doc_id in self._labels)
+            # Tombstoned slots are all filled before any new one is needed
+            replaced = min(len(ids), self._deleted)
+            self._ensure_capacity(len(ids) - replaced)
+            labels = np.arange(self._next_label, self._next_label + len(ids))
+            self._next_label += len(ids)
+            self._index.add_items(matrix, labels, replace_deleted=True)
+            self._deleted -= replaced
+            for doc_id, label in zip(ids, labels):
+                self._labels[doc_id] = int(label)
+                self._ids[int(label)] = doc_id
+
+    def remove(self, ids):
+        with self._lock:
+            self._remove_locked(ids)
+
+    def _remove_locked(self, ids):
+        for doc_id in list(ids):
+            label = self._labels.pop(doc_id, None)
+            if label is None:
+                continue
+            self._ids.pop(label, None)
+            self._index.mark_deleted(label)
+            self._deleted += 1
+
+    def search(self, query_vector, k):
+        return self.search_batch(query_vector, k)[0]
+
+    def search_batch(self, query_vectors, k):
+        """One knn_query call for all queries (hnswlib spreads them over its threads)"""
+        with self._lock:
+            queries = self._as_matrix(query_vectors)
+            if not self._labels or k <= 0:
+                return [[] for _ in queries]
+            k = min(k, len(self._labels))
+            self._index.set_ef(max(self.ef_search, k))
+            labels, distances = self._index.knn_query(queries, k=k)
+            # hnswlib reports inner product distance as 1 - dot
+            return [
+                [
+                    (self._ids[int(label)], float(1.0 - distance))
+                    for label, distance in zip(row_labels, row_distances)
+                    if int(label) in self._ids
+                ]
+                for row_labels, row_distances in zip(labels, distances)
+            ]
+
+    def _contains(self, doc_id):
+        return doc_id in self._labels
+
+    def _vectors_for(self, ids):
+        return np.asarray(self._index.get_items([self._labels[doc_id] for doc_id in ids]), dtype=np.float32)
+
+    def __len__(self):
+        return len(self._labels)
+
+def create_index(backend=VECTOR_INDEX_BACKEND, dim=None):
+    """Instantiate an empty index for the configured backend"""
+    if backend == "hnsw":
+        if hnswlib is not None:
+            return HNSWIndex(dim)
+        logger.warning("hnswlib is not installed, falling back to exact vector index")
+    elif backend != "exact":
+        raise ValueError(f"Unknown vector index backend: {backend}")
+    return ExactIndex(dim)
+
+def build_index(collection, backend=VECTOR_INDEX_BACKEND):
+    """Build an index from the embeddings field of every document in the collection"""
+    if backend == "mmap":
+        index = open_mapped_index(collection)
+        if index is not None:
+            return index
+        logger.warning(f"No corpus snapshot of {collection.full_name} could be opened, building an exact index")
+        backend = "exact"
+    index = create_index(backend)
+    _fill_index(index, collection)
+    return index
+
+def open_mapped_index(collection):
+    """Map the collection's snapshot, exporting one first if there is none.
+
+    Returns None when no snapshot exists and another process is exporting it.
+    Changes newer than the snapshot are replayed by sync_vector_index.
+    """
+    snapshot = open_snapshot(collection)
+    if snapshot is None and export_snapshot(collection) is not None:
+        snapshot = open_snapshot(collection)
+    if snapshot is None:
+        return None
+    start = time.time()
+    index = MappedIndex(snapshot)
+    logger.info(f"Mapped snapshot of {len(index)} documents in {collection.full_name} "
+                f"at corpus version {index.version} in {time.time() - start:.2f}s")
+    return index
+
+def refresh_snapshot(collection):
+    """Write a snapshot delta after ingestion or deletion, so new workers map current vectors"""
+    if VECTOR_INDEX_BACKEND == "mmap":
+        submit_background(update_snapshot, collection)
+
+def _fill_index(index, collection):
+    # Changes committed during the scan are replayed by the next sync, which is idempotent
+    index.version = get_corpus_version(collection, max_age=0)
+    ids, vectors = [], []
+    for doc in collection.find({"embeddings": {"$exists": True}}, EMBEDDING_PROJECTION):
+        ids.append(doc["_id"])
+        vectors.append(decode_embedding(doc))
+        if len(ids) >= INDEX_BUILD_BATCH_SIZE:
+            index.add(ids, vectors)
+            ids, vectors = [], []
+    if ids:
+        index.add(ids, vectors)
+    logger.info(f"Built {type(index).__name__} over {len(index)} documents in {collection.full_name}")
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def get_vector_index(collection):
+    """Get the process-wide index for a collection, building it on first use.
+
+    Returns None when the legacy MongoDB pipeline is configured.
+    """
+    if VECTOR_INDEX_BACKEND == "mongo":
+        return None
+    with _indexes_lock:
+        index = _indexes.get(collection.full_name)
+        if index is None:
+            index = build_index(collection)
+            _indexes[collection.full_name] = index
+        return index
+
+def index_documents(collection, ids, vectors):
+    """Add freshly inserted documents to the collection's index, if one has been built"""
+    index = _indexes.get(collection.full_name)
+    if index is not None and ids:
+        index.add(ids, vectors)
+
+def unindex_documents(collection, ids):
+    """Drop deleted documents from the collection's index, if one has been built"""
+    index = _indexes.get(collection.full_name)
+    if index is not None and ids:
+        index.remove(ids)
+
+def sync_vector_index(collection):
+    """Replay chunk changes made by other processes since the index was built or last synced.
+
+    Checks the corpus version at most once per CORPUS_VERSION_POLL_SECONDS. When
+    the change log no longer reaches back far enough, a replacement is built in
+    the background while searches keep using the current index. Returns the
+    collection's current index, or None if none has been built.
+    """
+    index = _indexes.get(collection.full_name)
+    if index is None or get_corpus_version(collection) <= index.version:
+        return index
+    # One thread syncs; the others keep searching the slightly older index
+    if not index._sync_lock.acquire(blocking=False):
+        return index
+    rebuilding = False
+    try:
+        changes = changes_since(collection, index.version)
+        if changes is None:
+            logger.warning(f"Change log for {collection.full_name} expired, rebuilding vector index in the background")
+            # The rebuild releases _sync_lock, so no other sync starts a second one
+            submit_background(_rebuild_index, collection, index)
+            rebuilding = True
+            return index
+        for change in changes:
+            if change["op"] == "remove":
+                index.remove(change["ids"])
+            else:
+                with index._lock:
+                    missing = [doc_id for doc_id in change["ids"] if not index._contains(doc_id)]
+                if missing:
+                    docs = list(collection.find({"_id": {"$in": missing}}, EMBEDDING_PROJECTION))
+                    if docs:
+                        index.add([doc["_id"] for doc in docs], [decode_embedding(doc) for doc in docs])
+            index.version = change["version"]
+        logger.debug(f"Synced vector index of {collection.full_name} to corpus version {index.version}")
+        return index
+    finally:
+        if not rebuilding:
+            index._sync_lock.release()
+
+def _rebuild_index(collection, stale):
+    """Build a replacement for a stale index off to the side, then swap it in as one reference assignment"""
+    try:
+        start = time.time()
+        if isinstance(stale, MappedIndex):
+            # The snapshot is at least as old as the index; map a fresh export instead
+            export_snapshot(collection)
+        fresh = build_index(collection)
+        # Changes committed during the build are replayed onto fresh by the next sync
+        with _indexes_lock:
+            if _indexes.get(collection.full_name) is stale:
+                _indexes[collection.full_name] = fresh
+        logger.info(f"Swapped in rebuilt vector index of {collection.full_name} after {time.time() - start:.1f}s")
+    except Exception:
+        logger.exception(f"Rebuilding the vector index of {collection.full_name} failed")
+    finally:
+        stale._sync_lock.release()
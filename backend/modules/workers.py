@@ -0,0 +1,96 @@
+import os
+import asyncio
+import functools
+import contextvars
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from dotenv import load_dotenv
+from logger import logger
+
+load_dotenv()
+
+# Blocking work on the request path: query embedding and pymongo calls
+QUERY_WORKERS = int(os.environ.get("QUERY_WORKERS", "16"))
+# PDF parsing, chunking and batch embedding for uploads, kept apart so it cannot starve chat traffic
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", "2"))
+# Copying uploaded files to disk; apart from ingestion so a save never queues behind a running job
+UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", "4"))
+# Per-shard searches of a scatter-gather query; leaf tasks, so they never wait on another pool
+SHARD_SEARCH_WORKERS = int(os.environ.get("SHARD_SEARCH_WORKERS", str(QUERY_WORKERS * 2)))
+# Writes that must not delay a response, such as chat history appends and summaries
+BACKGROUND_WORKERS = int(os.environ.get("BACKGROUND_WORKERS", "2"))
+# Processes used to parse and split PDFs in parallel; 0 parses in the ingesting thread
+PARSE_WORKERS = int(os.environ.get("PARSE_WORKERS", str(os.cpu_count() or 1)))
+
+_query_executor = ThreadPoolExecutor(max_workers=QUERY_WORKERS, thread_name_prefix="query")
+_ingest_executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix="ingest")
+_upload_executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="upload")
+# Sub-queries fanned out from inside query pool work; a separate pool so they can never wait on their own parent
+_retrieval_executor = ThreadPoolExecutor(max_workers=QUERY_WORKERS, thread_name_prefix="retrieval")
+_shard_executor = ThreadPoolExecutor(max_workers=SHARD_SEARCH_WORKERS, thread_name_prefix="shard")
+_background_executor = ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS, thread_name_prefix="background")
+_parse_executor = None
+_parse_executor_lock = threading.Lock()
+
+def _with_context(func, *args, **kwargs):
+    # Carry the caller's context (request id for logs) into the worker thread
+    return functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+
+async def _run_in_executor(executor, func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, _with_context(func, *args, **kwargs))
+
+async def run_in_query_pool(func, *args, **kwargs):
+    """Run a blocking retrieval/database call without blocking the event loop"""
+    return await _run_in_executor(_query_executor, func, *args, **kwargs)
+
+async def run_in_ingest_pool(func, *args, **kwargs):
+    """Run a blocking ingestion call on the dedicated ingestion workers"""
+    return await _run_in_executor(_ingest_executor, func, *args, **kwargs)
+
+async def run_in_upload_pool(func, *args, **kwargs):
+    """Run blocking upload file I/O off both the event loop and the query workers"""
+    return await _run_in_executor(_upload_executor, func, *args, **kwargs)
+
+def submit_ingest(func, *args, **kwargs):
+    """Queue fire-and-forget ingestion work, bounded by INGEST_WORKERS"""
+    return _ingest_executor.submit(_with_context(func, *args, **kwargs))
+
+def submit_retrieval(func, *args, **kwargs):
+    """Run one retrieval stage concurrently with another, from inside a query pool thread"""
+    return _retrieval_executor.submit(_with_context(func, *args, **kwargs))
+
+def submit_shard_search(func, *args, **kwargs):
+    """Run one shard's part of a scatter-gather search, from a query or retrieval pool thread"""
+    return _shard_executor.submit(_with_context(func, *args, **kwargs))
+
+def submit_background(func, *args, **kwargs):
+    """Queue fire-and-forget work that runs after the response has been sent"""
+    return _background_executor.submit(_with_context(func, *args, **kwargs))
+
+def get_parse_pool():
+    """Get the shared PDF parsing process pool, or None when PARSE_WORKERS is 0"""
+    global _parse_executor
+    if PARSE_WORKERS <= 0:
+        return None
+    with _parse_executor_lock:
+        if _parse_executor is None:
+            # spawn rather than fork: the parent holds threads and a loaded model
+            _parse_executor = ProcessPoolExecutor(
+                max_workers=PARSE_WORKERS, mp_context=multiprocessing.get_context("spawn")
+            )
+        return _parse_executor
+
+def shutdown_workers():
+    """Wait for running work and stop the worker pools"""
+    _query_executor.shutdown(wait=True)
+    _upload_executor.shutdown(wait=True)
+    _retrieval_executor.shutdown(wait=True)
+    _shard_executor.shutdown(wait=True)
+    _background_executor.shutdown(wait=True)
+    # Queued ingestion jobs are persisted and resumed on the next start
+    _ingest_executor.shutdown(wait=True, cancel_futures=True)
+    if _parse_executor is not None:
+        _parse_executor.shutdown(wait=True, cancel_futures=True)
+    logger.info("Worker pools stopped")
@@ -4,6 +4,7 @@ import Header from './components/Header';
 import ChatSection from './components/ChatSection';
 import Sidebar from './components/Sidebar';
 import AdminPanel from './components/AdminPanel';
+import { resetSession } from './services/api';
 
 function App() {
   const [messages, setMessages] = useState([]);
@@ -14,8 +15,18 @@ function App() {
     setMessages(prev => [...prev, message]);
   };
 
+  const updateLastMessage = (update) => {
+    setMessages(prev => {
+      if (prev.length === 0) return prev;
+      const last = prev[prev.length - 1];
+      return [...prev.slice(0, -1), { ...last, ...update(last) }];
+    });
+  };
+
   const clearChat = () => {
     setMessages([]);
+    // Start a fresh server-side conversation as well
+    resetSession();
   };
 
   const downloadHistory = () => {
@@ -63,6 +74,7 @@ function App() {
           <ChatSection 
             messages={messages} 
             onAddMessage={addMessage} 
+            onUpdateLastMessage={updateLastMessage}
           />
         </div>
       </div>
@@ -99,7 +99,8 @@ const AdminPanel = ({ isOpen, onClose }) => {
   const { getRootProps: getJsonRootProps, getInputProps: getJsonInputProps, isDragActive: isJsonDragActive } = useDropzone({
     onDrop: onJsonDrop,
     accept: {
-      'application/json': ['.json']
+      'application/json': ['.json'],
+      'application/x-ndjson': ['.ndjson', '.jsonl']
     },
     multiple: true
   });
@@ -127,7 +128,7 @@ const AdminPanel = ({ isOpen, onClose }) => {
         headers: { 'Content-Type': 'multipart/form-data' }
       });
 
-      showMessage('success', `Successfully uploaded ${pdfFiles.length} PDF files!`);
+      showMessage('success', `Uploaded ${pdfFiles.length} PDF files, processing in background (job ${response.data.job_id})`);
       setPdfFiles([]);
       fetchStats(); // Refresh stats
     } catch (error) {
@@ -152,7 +153,7 @@ const AdminPanel = ({ isOpen, onClose }) => {
         headers: { 'Content-Type': 'multipart/form-data' }
       });
 
-      showMessage('success', `Successfully uploaded ${jsonFiles.length} JSON files!`);
+      showMessage('success', `Uploaded ${jsonFiles.length} JSON files, processing in background (job ${response.data.job_id})`);
       setJsonFiles([]);
       fetchStats(); // Refresh stats
     } catch (error) {
@@ -1,8 +1,8 @@
 import React, { useState, useRef, useEffect } from 'react';
 import { Send, Bot, User, FileText, Sparkles, Brain, Zap } from 'lucide-react';
-import { askQuestion } from '../services/api';
+import { askQuestionStream } from '../services/api';
 
-const ChatSection = ({ messages, onAddMessage }) => {
+const ChatSection = ({ messages, onAddMessage, onUpdateLastMessage }) => {
   const [input, setInput] = useState('');
   const [isLoading, setIsLoading] = useState(false);
   const messagesEndRef = useRef(null);
@@ -25,22 +25,34 @@ const ChatSection = ({ messages, onAddMessage }) => {
     setInput('');
     setIsLoading(true);
 
+    let started = false;
     try {
-      const response = await askQuestion(input.trim());
-      const assistantMessage = {
-        role: 'assistant',
-        content: response.data.response,
-        sources: response.data.sources || [],
-        responseType: response.data.response_type || 'general'
-      };
-      onAddMessage(assistantMessage);
+      await askQuestionStream(input.trim(), {
+        onMeta: (meta) => {
+          started = true;
+          setIsLoading(false);
+          onAddMessage({
+            role: 'assistant',
+            content: '',
+            sources: meta.sources || [],
+            responseType: meta.response_type || 'general'
+          });
+        },
+        onToken: (token) => {
+          onUpdateLastMessage((last) => ({ content: last.content + token }));
+        }
+      });
     } catch (error) {
       const errorMessage = {
         role: 'assistant',
         content: 'I encountered an error while processing your question. Please try again.',
         error: true
       };
-      onAddMessage(errorMessage);
+      if (started) {
+        onUpdateLastMessage(() => errorMessage);
+      } else {
+        onAddMessage(errorMessage);
+      }
     } finally {
       setIsLoading(false);
       inputRef.current?.focus();
@@ -31,6 +31,22 @@ api.interceptors.response.use(
   }
 );
 
+// Conversation id sent with every question so the backend can keep chat history
+const SESSION_KEY = 'chat_session_id';
+
+export const getSessionId = () => {
+  let sessionId = localStorage.getItem(SESSION_KEY);
+  if (!sessionId) {
+    sessionId = crypto.randomUUID();
+    localStorage.setItem(SESSION_KEY, sessionId);
+  }
+  return sessionId;
+};
+
+export const resetSession = () => {
+  localStorage.removeItem(SESSION_KEY);
+};
+
 export const uploadFiles = async (files) => {
   const formData = new FormData();
   files.forEach((file) => {
@@ -47,6 +63,7 @@ export const uploadFiles = async (files) => {
 export const askQuestion = async (question) => {
   const formData = new FormData();
   formData.append('question', question);
+  formData.append('session_id', getSessionId());
 
   return api.post('/ask/', formData, {
     headers: {
@@ -55,12 +72,52 @@ export const askQuestion = async (question) => {
   });
 };
 
-export const getChatHistory = async () => {
-  return api.get('/chat_history/');
+// Streams /ask_stream/ NDJSON events: onMeta({sources, response_type}) once, then onToken(text) per token.
+// Pass an AbortController signal to cancel the generation server-side.
+export const askQuestionStream = async (question, { onMeta, onToken, signal } = {}) => {
+  const formData = new FormData();
+  formData.append('question', question);
+  formData.append('session_id', getSessionId());
+
+  const response = await fetch(`${API_BASE_URL}/ask_stream/`, {
+    method: 'POST',
+    body: formData,
+    signal,
+  });
+  if (!response.ok || !response.body) {
+    throw new Error(`Streaming request failed with status ${response.status}`);
+  }
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+
+    const lines = buffer.split('\n');
+    buffer = lines.pop();
+    for (const line of lines) {
+      if (!line.trim()) continue;
+      const event = JSON.parse(line);
+      if (event.type === 'meta') onMeta?.(event);
+      else if (event.type === 'token') onToken?.(event.content);
+      else if (event.type === 'error') throw new Error(event.error);
+    }
+  }
+};
+
+// Pages backwards from the newest message; pass the returned next_cursor as before for older messages
+export const getChatHistory = async (before = null, limit = 50) => {
+  return api.get('/chat_history/', {
+    params: { session_id: getSessionId(), before, limit },
+  });
 };
 
-export const saveChat = async (chatData) => {
-  return api.post('/save_chat/', chatData);
+export const saveChat = async (messages) => {
+  return api.post('/save_chat/', { session_id: getSessionId(), messages });
 };
 
 export const testConnection = async () => {